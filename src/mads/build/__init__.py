@@ -1,8 +1,9 @@
 from .logging import log
-from .shell import shell, proc
+from .shell import shell, proc, stream
 
 __all__ = [
     "log",
     "proc",
     "shell",
+    "stream",
 ]
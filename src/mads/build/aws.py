@@ -0,0 +1,74 @@
+"""
+Shared AWS clients, created lazily so that commands which never talk to AWS
+don't pay to import boto3.
+"""
+
+import os
+import threading
+
+# Connection pool and retry settings for every client
+MAX_POOL_CONNECTIONS = int(os.environ.get("MADS_AWS_MAX_POOL_CONNECTIONS", 50))
+RETRY_MODE = os.environ.get("MADS_AWS_RETRY_MODE", "standard")
+MAX_ATTEMPTS = int(os.environ.get("MADS_AWS_MAX_ATTEMPTS", 5))
+
+_lock = threading.RLock()
+_session = None
+_clients: dict[tuple[str, str | None], object] = {}
+
+
+def session():
+    """The boto3 session all clients are created from."""
+
+    global _session
+
+    with _lock:
+        if _session is None:
+            import boto3
+
+            _session = boto3.session.Session()
+
+    return _session
+
+
+def client(service: str, region_name: str | None = None):
+    """
+    Return the shared client for a service, creating it on first use. boto3
+    clients are thread safe, so one client and its connection pool can serve
+    every thread.
+    """
+
+    key = (service, region_name)
+
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                from botocore.config import Config
+
+                config = Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS,
+                    retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+                )
+                _clients[key] = session().client(
+                    service, region_name=region_name, config=config
+                )
+
+    return _clients[key]
+
+
+def configure(
+    max_pool_connections: int | None = None,
+    retry_mode: str | None = None,
+    max_attempts: int | None = None,
+):
+    """Change the client settings. Clients are recreated on their next use."""
+
+    global MAX_POOL_CONNECTIONS, RETRY_MODE, MAX_ATTEMPTS
+
+    with _lock:
+        if max_pool_connections is not None:
+            MAX_POOL_CONNECTIONS = max_pool_connections
+        if retry_mode is not None:
+            RETRY_MODE = retry_mode
+        if max_attempts is not None:
+            MAX_ATTEMPTS = max_attempts
+        _clients.clear()
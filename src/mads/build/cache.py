@@ -0,0 +1,177 @@
+"""
+Save and restore build caches (pip, npm, data) as compressed tarballs in S3,
+keyed on hashes of the files that determine their contents.
+"""
+
+import os
+import re
+import glob
+import shlex
+import shutil
+import hashlib
+import platform
+
+from mads.environ import Git, Runner
+from mads.lib.path import current_repo
+from . import s3
+from .logging import log
+from .shell import stream
+
+# Where caches are kept, e.g. s3://bucket/build-cache
+CACHE_URL = os.environ.get("MADS_CACHE_URL")
+
+
+def hash_files(*patterns: str) -> str:
+    """
+    Hash the contents of every file matching the glob patterns. A pattern that
+    matches nothing is likely a typo, which would leave the key unchanged
+    forever, so it's warned about, and an error if no pattern matches.
+    """
+
+    digest = hashlib.sha256()
+    paths = set()
+    for pattern in patterns:
+        matches = [
+            path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)
+        ]
+        if not matches:
+            log.warning("Cache key pattern %r matches no files", pattern)
+        paths.update(matches)
+
+    if not paths:
+        raise ValueError(f"No files match {', '.join(map(repr, patterns))}")
+
+    for path in sorted(paths):
+        digest.update(path.encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            while chunk := f.read(1024**2):
+                digest.update(chunk)
+
+    return digest.hexdigest()[:16]
+
+
+def render_key(template: str) -> str:
+    """
+    Fill in a cache key template. Supported fields are {hash:GLOB,GLOB...},
+    {runner}, {branch}, {os}, {arch} and {python}, for example
+    "pip-{os}-{python}-{hash:requirements*.txt}".
+    """
+
+    def field(match: re.Match) -> str:
+        name, arg = match.group(1), match.group(2)
+
+        if name == "hash":
+            return hash_files(*(arg or "").split(","))
+        if name == "runner":
+            return Runner.current().name
+        if name == "branch":
+            return re.sub(r"[^\w.-]", "_", Git().branch or "none")
+        if name == "os":
+            return platform.system().lower()
+        if name == "arch":
+            return platform.machine()
+        if name == "python":
+            return platform.python_version()
+
+        raise ValueError(f"Unknown cache key field {{{name}}} in {template!r}")
+
+    return re.sub(r"\{(\w+)(?::([^}]*))?\}", field, template)
+
+
+def _location(url: str | None) -> tuple[str, str]:
+    """The bucket and key prefix caches for this repository live under."""
+
+    url = url or CACHE_URL
+    if not url:
+        raise RuntimeError("No cache location. Set $MADS_CACHE_URL to an s3:// URL.")
+
+    if not shutil.which("zstd"):
+        raise RuntimeError("zstd is required to use the build cache.")
+
+    # Runners without a source URL have no repo, so fall back on the checkout
+    repo = Runner.current().repo or current_repo()
+    if not repo:
+        raise RuntimeError("Unable to tell which repository the cache belongs to.")
+
+    bucket, prefix = s3.parse_url(url.rstrip("/"))
+    return bucket, f"{prefix}/{repo}/".lstrip("/")
+
+
+def save(key: str, paths: list[str], url: str | None = None) -> bool:
+    """
+    Stream the paths into a compressed tarball in S3 under the key. Like other
+    CI caches, entries are immutable: an existing key is never overwritten.
+    Returns whether anything was saved.
+    """
+
+    bucket, prefix = _location(url)
+    key = render_key(key)
+    object_key = f"{prefix}{key}.tar.zst"
+
+    if s3.exists(bucket, object_key):
+        log.info("Cache %s already exists, not saving it again", key)
+        return False
+
+    paths = [os.path.expanduser(path) for path in paths]
+    present = [path for path in paths if os.path.exists(path)]
+    for path in set(paths) - set(present):
+        log.warning("Cache path %s doesn't exist", path)
+
+    if not present:
+        return False
+
+    log.info("Saving cache %s to s3://%s/%s", key, bucket, object_key)
+    args = " ".join(shlex.quote(path) for path in present)
+
+    try:
+        with stream(f"tar -P -cf - {args} | zstd -T0 -3 -q -c") as tarball:
+            s3.upload_stream(tarball, bucket, object_key)
+    except BaseException:
+        # The upload finishes before the pipeline's exit status is known, and
+        # a truncated entry would block every later save under the key
+        s3.delete_keys(bucket, [object_key])
+        raise
+
+    return True
+
+
+def restore(
+    key: str,
+    fallback_prefixes: list[str] = [],
+    url: str | None = None,
+) -> str | None:
+    """
+    Restore the cache saved under the key, or failing that, the most recent
+    cache whose key starts with one of the fallback prefixes. Returns the key
+    that was restored, if any.
+    """
+
+    bucket, prefix = _location(url)
+    key = render_key(key)
+    object_key = f"{prefix}{key}.tar.zst"
+
+    if not s3.exists(bucket, object_key):
+        object_key = None
+
+        for fallback in fallback_prefixes:
+            candidates = [
+                entry
+                for entry in s3.iter_objects(bucket, prefix + render_key(fallback))
+                if entry["Key"].endswith(".tar.zst")
+            ]
+            if candidates:
+                newest = max(candidates, key=lambda entry: entry["LastModified"])
+                object_key = newest["Key"]
+                break
+
+    if object_key is None:
+        log.info("No cache found for %s", key)
+        return None
+
+    restored = object_key.removeprefix(prefix).removesuffix(".tar.zst")
+    log.info("Restoring cache %s from s3://%s/%s", restored, bucket, object_key)
+
+    with stream("zstd -d -q -c | tar -P -xf -", "w") as tarball:
+        s3.download_stream(bucket, object_key, tarball)
+
+    return restored
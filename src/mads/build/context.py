@@ -0,0 +1,404 @@
+"""
+Helpers for inspecting Docker build contexts.
+"""
+
+import os
+import re
+import json
+import shlex
+import tarfile
+import hashlib
+from pathlib import Path
+from typing import Iterator, Union
+
+from pydantic import BaseModel
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class PatternSet:
+    """Match context paths against Docker-style glob patterns."""
+
+    __slots__ = ("patterns",)
+
+    patterns: list[tuple[re.Pattern, bool]]
+
+    def __init__(self, lines: list[str]):
+        self.patterns = []
+
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            exclude = line.startswith("!")
+            if exclude:
+                line = line[1:].strip()
+
+            # Patterns are always relative to the root of the context
+            line = os.path.normpath(line).lstrip("/")
+            if line in ("", "."):
+                continue
+
+            self.patterns.append((re.compile(_translate(line)), exclude))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self.patterns)} patterns)"
+
+    @property
+    def has_exceptions(self) -> bool:
+        """Are there any ! patterns that can re-include an ignored path?"""
+
+        return any(exclude for _, exclude in self.patterns)
+
+    def matches(self, path: str) -> bool:
+        """Does the last pattern matching this context-relative path include it?"""
+
+        # A pattern that matches a parent directory also matches its contents.
+        parts = path.split("/")
+        candidates = ["/".join(parts[: i + 1]) for i in range(len(parts))]
+
+        matched = False
+        for pattern, exclude in self.patterns:
+            if any(pattern.match(candidate) for candidate in candidates):
+                matched = not exclude
+
+        return matched
+
+
+class DockerIgnore(PatternSet):
+    """Match context paths against the patterns of a .dockerignore file."""
+
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, context: Union[str, Path] = ".") -> "DockerIgnore":
+        """Read the .dockerignore file at the root of the context, if any."""
+
+        path = Path(context).joinpath(".dockerignore")
+        if not path.is_file():
+            return cls([])
+
+        return cls(path.read_text().splitlines())
+
+    def ignored(self, path: str) -> bool:
+        """Is the given context-relative path excluded from the context?"""
+
+        return self.matches(path)
+
+
+def _translate(pattern: str) -> str:
+    """Convert a .dockerignore glob into a regular expression."""
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+
+        if pattern.startswith("**/", i):
+            regex += "(.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                group = pattern[i + 1 : end].replace("\\", "\\\\")
+                regex += f"[{group}]"
+                i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+
+        i += 1
+
+    return f"^{regex}$"
+
+
+def walk(
+    context: Union[str, Path] = ".",
+    ignore: DockerIgnore | None = None,
+) -> Iterator[Path]:
+    """
+    Yield every file that would be sent to the Docker daemon, relative to the
+    context, in a stable order.
+    """
+
+    root = Path(context)
+    if ignore is None:
+        ignore = DockerIgnore.load(root)
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        here = Path(dirpath).relative_to(root)
+        dirnames.sort()
+
+        # Without exceptions, an ignored directory can't contain anything we need.
+        if not ignore.has_exceptions:
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if not ignore.ignored(here.joinpath(name).as_posix())
+            ]
+
+        # Symlinks to directories are sent as links, not followed
+        links = [name for name in dirnames if Path(dirpath, name).is_symlink()]
+
+        for name in sorted(filenames + links):
+            relpath = here.joinpath(name)
+            if not ignore.ignored(relpath.as_posix()):
+                yield relpath
+
+
+def file_hash(path: Path) -> str:
+    """Hash the contents of a file without reading it all into memory."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(
+    context: Union[str, Path] = ".",
+    dockerfile: Union[str, Path, None] = None,
+    build_args: dict[str, str] | None = None,
+) -> str:
+    """
+    Compute a deterministic hash of everything that goes into a docker build:
+    the files in the context (respecting .dockerignore), the Dockerfile, and
+    the build args.
+    """
+
+    root = Path(context)
+    dockerfile = Path(dockerfile) if dockerfile else root.joinpath("Dockerfile")
+
+    digest = hashlib.sha256()
+    digest.update(b"dockerfile\0" + dockerfile.read_bytes() + b"\0")
+
+    for key, val in sorted((build_args or {}).items()):
+        digest.update(f"arg\0{key}={val}\0".encode("utf-8"))
+
+    for relpath in walk(root):
+        path = root.joinpath(relpath)
+        digest.update(f"file\0{relpath.as_posix()}\0".encode("utf-8"))
+
+        if path.is_symlink():
+            digest.update(f"link\0{os.readlink(path)}\0".encode("utf-8"))
+            continue
+
+        mode = "x" if os.access(path, os.X_OK) else "-"
+        digest.update(f"{mode}\0{file_hash(path)}\0".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def dockerfile_sources(dockerfile: Union[str, Path]) -> list[str]:
+    """
+    List the context paths a Dockerfile reads from: the sources of its COPY and
+    ADD instructions and any bind mounts of the context in RUN instructions.
+    Variables can't be resolved here, so they are treated as wildcards.
+    """
+
+    text = Path(dockerfile).read_text()
+
+    # Join continuation lines and drop comments
+    text = re.sub(r"\\[ \t]*\r?\n", " ", text)
+    lines = [line.strip() for line in text.splitlines()]
+    lines = [line for line in lines if line and not line.startswith("#")]
+
+    sources = []
+    for line in lines:
+        instruction, _, rest = line.partition(" ")
+        instruction = instruction.upper()
+
+        if instruction in ("COPY", "ADD"):
+            sources.extend(_copy_sources(rest))
+        elif instruction == "RUN":
+            sources.extend(_mount_sources(rest))
+
+    # The whole context is "." to Docker, but patterns are relative to it.
+    sources = [re.sub(r"\$\{?\w+\}?", "*", source) for source in sources]
+    return ["**" if os.path.normpath(src) in (".", "/") else src for src in sources]
+
+
+def _copy_sources(args: str) -> list[str]:
+    """Parse the context sources out of the arguments to COPY or ADD."""
+
+    args = args.strip()
+    flags = []
+    while args.startswith("--"):
+        flag, _, args = args.partition(" ")
+        flags.append(flag)
+        args = args.strip()
+
+    # Copying from another stage or image doesn't touch the context
+    if any(flag.startswith("--from=") for flag in flags):
+        return []
+
+    if args.startswith("["):
+        try:
+            paths = json.loads(args)
+        except ValueError:
+            paths = shlex.split(args)
+    else:
+        paths = shlex.split(args)
+
+    # The last path is the destination; skip remote sources.
+    return [
+        path
+        for path in paths[:-1]
+        if not re.match(r"^([a-z]+://|git@)", path) and not path.startswith("<<")
+    ]
+
+
+def _mount_sources(args: str) -> list[str]:
+    """Parse the context paths bind mounted into a RUN instruction."""
+
+    sources = []
+    for flag in re.findall(r"--mount=(\S+)", args):
+        options = dict(
+            option.partition("=")[::2] for option in flag.split(",") if option
+        )
+        if options.get("type") != "bind" or "from" in options:
+            continue
+        sources.append(options.get("source", options.get("src", ".")))
+
+    return sources
+
+
+class ContextPath(BaseModel):
+    """A path in the build context and how much of it the Dockerfile uses."""
+
+    path: str
+    size: int = 0
+    referenced: int = 0
+
+
+class ContextReport(BaseModel):
+    """What a build context contains and how much of it is actually used."""
+
+    files: dict[str, ContextPath] = {}
+    dirs: dict[str, ContextPath] = {}
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self.files.values())
+
+    @property
+    def referenced(self) -> int:
+        return sum(entry.referenced for entry in self.files.values())
+
+
+def analyze(
+    context: Union[str, Path] = ".",
+    dockerfile: Union[str, Path, None] = None,
+) -> ContextReport:
+    """
+    Walk the context as the daemon would receive it and note which paths are
+    read by the Dockerfile's COPY and ADD instructions.
+    """
+
+    root = Path(context)
+    dockerfile = Path(dockerfile) if dockerfile else root.joinpath("Dockerfile")
+    sources = PatternSet(dockerfile_sources(dockerfile))
+
+    report = ContextReport()
+    for relpath in walk(root):
+        path = relpath.as_posix()
+        size = root.joinpath(relpath).lstat().st_size
+        used = size if sources.matches(path) else 0
+
+        report.files[path] = ContextPath(path=path, size=size, referenced=used)
+
+        for parent in relpath.parents:
+            if parent == Path("."):
+                break
+            entry = report.dirs.setdefault(
+                parent.as_posix(), ContextPath(path=parent.as_posix())
+            )
+            entry.size += size
+            entry.referenced += used
+
+    return report
+
+
+def log_report(
+    context: Union[str, Path] = ".",
+    dockerfile: Union[str, Path, None] = None,
+    min_size: int = 10 * 1024**2,
+) -> ContextReport:
+    """Log the paths in the context that are at least min_size bytes."""
+
+    from .logging import log, human_size
+
+    root = Path(context)
+    report = analyze(root, dockerfile)
+
+    def lookup(path: Path) -> ContextPath | None:
+        relpath = path.relative_to(root).as_posix()
+        return report.files.get(relpath) or report.dirs.get(relpath)
+
+    def include(path: Path) -> bool:
+        entry = lookup(path)
+        return entry is not None and entry.size >= min_size
+
+    def annotate(path: Path) -> str:
+        entry = lookup(path)
+        if entry.referenced == entry.size:
+            note = "referenced"
+        elif entry.referenced == 0:
+            note = "not referenced"
+        else:
+            note = f"{human_size(entry.referenced)} referenced"
+
+        # The tree already shows the size of files, but not directories
+        if entry.path in report.dirs:
+            note = f"{human_size(entry.size)}, {note}"
+        return note
+
+    log.start("Build context %s", root.resolve())
+    log.info("Context size: %s", human_size(report.size))
+    log.info("Referenced by the Dockerfile: %s", human_size(report.referenced))
+    log.info("Paths of at least %s:", human_size(min_size))
+    log.tree(root, hidden=True, include=include, annotate=annotate)
+    log.end()
+
+    return report
+
+
+def pack(
+    output: Union[str, Path],
+    context: Union[str, Path] = ".",
+    dockerfile: Union[str, Path, None] = None,
+    compresslevel: int = 6,
+) -> ContextReport:
+    """
+    Write a gzipped tarball with only the parts of the context the Dockerfile
+    reads, ready to be piped into `docker build -`.
+    """
+
+    root = Path(context)
+    dockerfile = Path(dockerfile) if dockerfile else root.joinpath("Dockerfile")
+    report = analyze(root, dockerfile)
+
+    with tarfile.open(output, "w:gz", compresslevel=compresslevel) as tarball:
+        tarball.add(dockerfile, arcname="Dockerfile")
+
+        for path, entry in report.files.items():
+            if entry.referenced and path != "Dockerfile":
+                tarball.add(root.joinpath(path), arcname=path, recursive=False)
+
+    return report
@@ -3,11 +3,17 @@ Helpers for interacting with Docker.
 """
 
 import os
+import re
+import json
 import base64
-import boto3
-from mads.environ import Git, Runner
-from .shell import proc
-from .ecr import get_image_tags
+import shutil
+import psutil
+from pathlib import Path
+from datetime import datetime, timezone
+from mads.environ import Docker, Git, Resources, Runner
+from .logging import log, human_size
+from .shell import proc, shell, stream
+from . import aws, context, ecr, s3
 
 
 def host() -> str:
@@ -45,8 +51,7 @@ def login() -> bool:
     Log into the Docker registry.
     """
 
-    ecr = boto3.client("ecr")
-    token = ecr.get_authorization_token()
+    token = aws.client("ecr").get_authorization_token()
     user, passwd = (
         base64.b64decode(token["authorizationData"][0]["authorizationToken"])
         .decode("utf-8")
@@ -57,27 +62,83 @@ def login() -> bool:
     return result.returncode == 0
 
 
+# How many pulls were made or avoided because the local image was current
+PULLS = {"pulled": 0, "skipped": 0}
+
+
+def local_digests(image: str) -> set[str]:
+    """The registry digests of a local image, if we have it at all."""
+
+    result = proc(f"docker image inspect --format '{{{{json .RepoDigests}}}}' {image}")
+    if result.returncode != 0:
+        return set()
+
+    repo_digests = json.loads(result.stdout.decode("utf-8") or "[]") or []
+    return {digest.split("@")[-1] for digest in repo_digests}
+
+
+def pull(image_name: str, tag: str, digest: str | None = None) -> bool:
+    """
+    Pull the tagged image unless the local copy already matches the digest of
+    the tag in the registry.
+    """
+
+    if digest is None:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            digest = ecr.get_image_digest(image_name.split("/")[-1], tag)
+        except (BotoCoreError, ClientError) as e:
+            log.debug("Unable to look up the digest of %s:%s: %s", image_name, tag, e)
+
+    if digest and digest in local_digests(f"{image_name}:{tag}"):
+        log.info("Local image %s:%s is already at %s", image_name, tag, digest)
+        PULLS["skipped"] += 1
+        return True
+
+    result = proc(f"docker pull {image_name}:{tag}")
+    if result.returncode == 0:
+        PULLS["pulled"] += 1
+    return result.returncode == 0
+
+
+def report_pulls():
+    """Log how many pulls were avoided."""
+
+    total = PULLS["pulled"] + PULLS["skipped"]
+    if total:
+        log.info("Avoided %s of %s docker pulls", PULLS["skipped"], total)
+
+
 def try_pull(image_name: str, tag: str) -> bool:
     """
     Pull the tagged docker image if it exists. If it doesn't, pull the latest
     version and re-tag it instead.
     """
 
-    result = proc(f"docker pull {image_name}:{tag}")
-    if result.returncode == 0:
+    if pull(image_name, tag):
+        report_pulls()
         return True
 
-    result = proc(f"docker pull {image_name}:latest")
-    if result.returncode != 0:
+    if not pull(image_name, "latest"):
         raise RuntimeError("It appears the requested image doesn't exist at all.")
 
-    result = proc(f"docker tag {image_name}:latest {image_name}{tag}")
+    result = proc(f"docker tag {image_name}:latest {image_name}:{tag}")
     if result.returncode != 0:
         raise RuntimeError(f"Unable to tag the latest image as :{tag}")
 
+    report_pulls()
     return True
 
 
+def push(image_name: str, tag: str) -> bool:
+    """Push a tagged image and forget the repository's cached tag index."""
+
+    result = proc(f"docker push {image_name}:{tag}")
+    ecr.invalidate(image_name.split("/")[-1])
+    return result.returncode == 0
+
+
 def pull_first(image_name: str, *tags: str) -> str | bool:
     """
     Try pulling specified tags until one is found.
@@ -85,14 +146,19 @@ def pull_first(image_name: str, *tags: str) -> str | bool:
     """
 
     repo = image_name.split("/")[-1]
-    all_tags = get_image_tags(repo)
+    digests = ecr.get_image_digests(repo)
+
+    # A preferred tag missing from the cached index may have been pushed since
+    if tags and tags[0] not in digests:
+        digests = ecr.get_image_digests(repo, refresh=True)
 
     for tag in tags:
-        if tag not in all_tags:
+        if tag not in digests:
             continue
 
-        result = proc(f"docker pull {image_name}:{tag}")
-        if result.returncode == 0:
+        pulled = pull(image_name, tag, digest=digests[tag])
+        report_pulls()
+        if pulled:
             return f"{image_name}:{tag}"
         else:
             return False
@@ -121,3 +187,267 @@ def determine_tag(*, use_branch: bool = False, default: str = "dev") -> str:
 
     else:
         return default
+
+
+def content_tag(
+    context_dir: str = ".",
+    dockerfile: str | None = None,
+    build_args: dict[str, str] | None = None,
+    prefix: str = "content",
+) -> str:
+    """
+    Generate a tag that only changes when the inputs to the build change.
+    """
+
+    digest = context.content_hash(context_dir, dockerfile, build_args)
+    return f"{prefix}-{digest[:16]}"
+
+
+def reuse(image_name: str, content_tag: str, tag: str) -> bool:
+    """
+    If an image was already built from identical inputs, tag it as the
+    requested tag in the registry so the build can be skipped entirely.
+    Returns False if the image needs to be built.
+    """
+
+    repo = image_name.split("/")[-1]
+
+    if not ecr.retag(repo, content_tag, tag):
+        log.info("No existing image %s:%s. A build is required.", repo, content_tag)
+        return False
+
+    log.info("Reusing %s:%s as %s:%s", repo, content_tag, repo, tag)
+    return True
+
+
+# Evict images and build cache unused for longer than each of these, oldest first.
+PRUNE_AGES_HOURS = [24 * 30, 24 * 7, 24 * 3, 24, 12, 6, 1, 0]
+
+
+def _parse_time(value: str) -> datetime:
+    """Parse a Docker timestamp, which may have nanosecond precision."""
+
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value).replace("Z", "+00:00")
+    return datetime.fromisoformat(value)
+
+
+def data_root() -> str:
+    """The directory where Docker keeps its images and build cache."""
+
+    result = proc("docker info --format '{{.DockerRootDir}}'")
+    root = result.stdout.decode("utf-8").strip()
+    return root if result.returncode == 0 and os.path.exists(root) else "/"
+
+
+def local_images() -> list[dict]:
+    """
+    List the images on this machine, least recently used first. Docker doesn't
+    track when an image was last used, so fall back on when it was last tagged
+    or pulled, then when it was created.
+    """
+
+    ids = set(shell("docker image ls --quiet --no-trunc", silent=True).split())
+    if not ids:
+        return []
+
+    images = []
+    for image in json.loads(
+        shell(f"docker image inspect {' '.join(ids)}", silent=True)
+    ):
+        last_used = _parse_time(image["Created"])
+        tagged = image.get("Metadata", {}).get("LastTagTime")
+        if tagged and not tagged.startswith("0001-"):
+            last_used = max(last_used, _parse_time(tagged))
+
+        images.append(
+            {
+                "id": image["Id"],
+                "tags": image.get("RepoTags") or [],
+                "size": image["Size"],
+                "last_used": last_used,
+            }
+        )
+
+    return sorted(images, key=lambda image: image["last_used"])
+
+
+def prune(
+    free_gb: float | None = None,
+    protect: list[str] = [],
+    image_name: str | None = None,
+    dry_run: bool = False,
+) -> int:
+    """
+    Evict images and build cache, least recently used first, until at least
+    free_gb gigabytes are free on Docker's disk. By default, aim to keep a fifth
+    of the machine's storage free. Images tagged with anything in protect (full
+    repo:tag references) or, given image_name, with the current build's tags of
+    it are never removed. Returns the bytes reclaimed, or with dry_run, about
+    how many would be from images alone.
+    """
+
+    if free_gb is None:
+        free_gb = Resources().storage / 5
+
+    root = data_root()
+    target = free_gb * 1024**3
+    before = psutil.disk_usage(root).free
+
+    log.start("Pruning Docker storage on %s", root)
+    log.info("Free: %s, target: %s", human_size(before), human_size(target))
+
+    if before >= target:
+        log.end("Nothing to prune")
+        return 0
+
+    keep = set(protect)
+    if image_name:
+        keep |= {
+            f"{image_name}:{determine_tag()}",
+            f"{image_name}:{determine_tag(use_branch=True)}",
+        }
+    log.info("Protecting: %s", ", ".join(sorted(keep)) or "nothing")
+
+    def protected(image: dict) -> bool:
+        return any(tag in keep for tag in image["tags"])
+
+    images = [image for image in local_images() if not protected(image)]
+    now = datetime.now(timezone.utc)
+
+    # A dry run can't measure what it frees, so count the size of each image
+    # instead. Images share layers, so this is an upper bound.
+    estimated = 0
+
+    def satisfied() -> bool:
+        if dry_run:
+            return before + estimated >= target
+        return psutil.disk_usage(root).free >= target
+
+    for hours in PRUNE_AGES_HOURS:
+        if satisfied():
+            break
+
+        # Images unused for this long, oldest first
+        while images and (now - images[0]["last_used"]).total_seconds() >= hours * 3600:
+            image = images.pop(0)
+            log.info(
+                "%s image %s (%s, last used %s)",
+                "Would remove" if dry_run else "Removing",
+                ", ".join(image["tags"]) or image["id"][7:19],
+                human_size(image["size"]),
+                image["last_used"].isoformat(timespec="seconds"),
+            )
+            if dry_run:
+                estimated += image["size"]
+            else:
+                for ref in image["tags"] or [image["id"]]:
+                    proc(f"docker image rm {ref}")
+            if satisfied():
+                break
+
+        # Then build cache records unused for this long
+        if not satisfied():
+            if dry_run:
+                log.info("Would remove build cache unused for %sh", hours)
+            else:
+                log.info("Removing build cache unused for %sh", hours)
+                proc(f"docker builder prune --force --filter until={hours}h")
+
+    if dry_run:
+        log.end("Would reclaim about %s", human_size(estimated))
+        return estimated
+
+    after = psutil.disk_usage(root).free
+    reclaimed = max(after - before, 0)
+
+    if after < target:
+        log.warning("Unable to reach the free space target of %s", human_size(target))
+
+    log.end("Reclaimed %s, %s now free", human_size(reclaimed), human_size(after))
+    return reclaimed
+
+
+def cache_key(image: str) -> str:
+    """The key an image is cached under, based on its repository and tag."""
+
+    name, _, tag = image.split("/")[-1].partition(":")
+    return f"{name}/{tag or 'latest'}"
+
+
+def _cache_url(key: str, dest: str | None) -> str:
+    dest = dest or Docker().image_cache
+    if not dest:
+        raise RuntimeError("No image cache location. Set $DOCKER_IMAGE_CACHE.")
+
+    if not shutil.which("zstd"):
+        raise RuntimeError("zstd is required to use the image cache.")
+
+    return f"{dest.rstrip('/')}/{key}.tar.zst"
+
+
+def cache_save(image: str, dest: str | None = None, key: str | None = None) -> str:
+    """
+    Stream `docker save` through zstd into a local directory or to S3. Nothing
+    is written to an intermediate file. If the pipeline fails, whatever was
+    written is removed rather than left to be loaded. Returns the key it was
+    saved under.
+    """
+
+    key = key or cache_key(image)
+    url = _cache_url(key, dest)
+    log.info("Saving %s to %s", image, url)
+
+    if url.startswith("s3://"):
+        bucket, object_key = s3.parse_url(url)
+    else:
+        path = Path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".partial")
+
+    try:
+        with stream(f"docker save {image} | zstd -T0 -3 -q -c") as tarball:
+            if url.startswith("s3://"):
+                s3.upload_stream(tarball, bucket, object_key)
+            else:
+                with open(partial, "wb") as f:
+                    shutil.copyfileobj(tarball, f, length=s3.PART_SIZE)
+    except BaseException:
+        # The upload finishes before the pipeline's exit status is known
+        if url.startswith("s3://"):
+            s3.delete_keys(bucket, [object_key])
+        else:
+            partial.unlink(missing_ok=True)
+        raise
+
+    if not url.startswith("s3://"):
+        partial.replace(path)
+
+    return key
+
+
+def cache_load(key: str, dest: str | None = None) -> bool:
+    """
+    Stream a cached image tarball back through zstd into `docker load`.
+    Returns False if nothing is cached under the key.
+    """
+
+    url = _cache_url(key, dest)
+
+    if url.startswith("s3://"):
+        if not s3.exists(*s3.parse_url(url)):
+            log.info("No cached image at %s", url)
+            return False
+    elif not Path(url).exists():
+        log.info("No cached image at %s", url)
+        return False
+
+    log.info("Loading %s", url)
+
+    with stream("zstd -d -q -c | docker load", "w") as loader:
+        if url.startswith("s3://"):
+            s3.download_stream(*s3.parse_url(url), loader)
+        else:
+            with open(url, "rb") as f:
+                shutil.copyfileobj(f, loader, length=s3.PART_SIZE)
+
+    return True
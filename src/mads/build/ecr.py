@@ -1,14 +1,342 @@
-import boto3
+import os
+import re
+import json
+import time
+import fnmatch
+from functools import cache
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
 
-ecr = boto3.client("ecr")
+from mads.lib.cache import cache_dir
+from . import aws
+from .logging import log
+
+# How many seconds a cached tag index is trusted before it's fetched again
+INDEX_TTL = int(os.environ.get("MADS_ECR_INDEX_TTL", 5 * 60))
+
+# The most image ids batch_delete_image accepts in one request
+DELETE_BATCH_SIZE = 100
+
+
+def client():
+    """The shared ECR client."""
+
+    return aws.client("ecr")
 
 
 def __getattr__(name):
-    return getattr(ecr, name)
+    if name == "ecr":
+        return client()
+    return getattr(client(), name)
+
+
+@cache
+def registry() -> tuple[str, str]:
+    """The account and region of the registry the shared client talks to."""
+
+    account = aws.client("sts").get_caller_identity()["Account"]
+    return account, client().meta.region_name
+
+
+def _index_path(repository_name: str) -> Path:
+    account, region = registry()
+    name = repository_name.replace("/", "%2F")
+    return cache_dir("ecr", account, region).joinpath(name + ".json")
+
+
+def index(
+    repository_name: str,
+    ttl: int = INDEX_TTL,
+    refresh: bool = False,
+) -> dict[str, dict]:
+    """
+    Map each tag in the repository to the digest, push time and size of its
+    image. The listing is cached on disk for ttl seconds so repeated lookups
+    within a build don't each page through describe_images. mads.build.docker
+    invalidates it after pushing or retagging; tags pushed by anything else
+    aren't seen until it expires, or it's listed again with refresh.
+    """
+
+    path = _index_path(repository_name)
+
+    if not refresh and path.exists():
+        try:
+            cached = json.loads(path.read_text())
+            if time.time() - cached["fetched_at"] < ttl:
+                return cached["tags"]
+        except (ValueError, KeyError):
+            pass
+
+    tags = {}
+    paginator = client().get_paginator("describe_images")
+    for page in paginator.paginate(repositoryName=repository_name):
+        for image in page["imageDetails"]:
+            for tag in image.get("imageTags", []):
+                tags[tag] = {
+                    "digest": image["imageDigest"],
+                    "pushed_at": image["imagePushedAt"].isoformat(),
+                    "size": image.get("imageSizeInBytes", 0),
+                }
+
+    # Write atomically in case another process is reading it
+    partial = path.with_name(f"{path.name}.{os.getpid()}")
+    partial.write_text(json.dumps({"fetched_at": time.time(), "tags": tags}))
+    partial.replace(path)
+
+    return tags
+
+
+def invalidate(repository_name: str):
+    """Forget the cached tag index, e.g. after pushing to the repository."""
+
+    _index_path(repository_name).unlink(missing_ok=True)
+
+
+def get_image_tags(repository_name: str, refresh: bool = False) -> list[str]:
+    return list(index(repository_name, refresh=refresh))
+
+
+def get_image_digests(repository_name: str, refresh: bool = False) -> dict[str, str]:
+    """Map each tag in the repository to the digest of the image it points to."""
+
+    tags = index(repository_name, refresh=refresh)
+    return {tag: image["digest"] for tag, image in tags.items()}
+
+
+def get_image_digest(repository_name: str, tag: str) -> str | None:
+    """The digest of the tagged image, or None if the tag doesn't exist."""
+
+    try:
+        response = client().describe_images(
+            repositoryName=repository_name,
+            imageIds=[{"imageTag": tag}],
+        )
+    except (
+        client().exceptions.ImageNotFoundException,
+        client().exceptions.RepositoryNotFoundException,
+    ):
+        return None
+
+    for image in response["imageDetails"]:
+        return image["imageDigest"]
+    return None
+
+
+def get_image(repository_name: str, tag: str) -> dict | None:
+    """Fetch the manifest of a tagged image, or None if the tag doesn't exist."""
+
+    response = client().batch_get_image(
+        repositoryName=repository_name,
+        imageIds=[{"imageTag": tag}],
+    )
+
+    for image in response["images"]:
+        return image
+    return None
+
+
+def retag(repository_name: str, source_tag: str, target_tag: str) -> bool:
+    """
+    Point target_tag at the image currently tagged source_tag without pulling
+    or pushing any layers. Returns False if the source tag doesn't exist.
+    """
+
+    image = get_image(repository_name, source_tag)
+    if not image:
+        return False
+
+    extra = {}
+    if image.get("imageManifestMediaType"):
+        extra["imageManifestMediaType"] = image["imageManifestMediaType"]
+
+    try:
+        client().put_image(
+            repositoryName=repository_name,
+            imageManifest=image["imageManifest"],
+            imageTag=target_tag,
+            **extra,
+        )
+    except client().exceptions.ImageAlreadyExistsException:
+        # The target tag already points at this exact image.
+        pass
+
+    invalidate(repository_name)
+    return True
+
+
+# Tags that are never expired: the ones Git.artifact_tag gives main and beta
+# builds without a prefix, and beta builds with one. A prefix's bare tag, which
+# it gives main builds, is kept by passing the prefix to prune.
+KEEP_TAGS = ["latest", "beta", "*-beta"]
+
+# The last part of a tag that identifies a build of a branch rather than the
+# branch itself: a build number, commit SHA or content hash
+BUILD_ID = re.compile(r"-(\d+|[0-9a-f]{7,40})$")
+
+
+def tag_group(tag: str) -> str:
+    """The branch a tag was built from: the tag without any trailing build id."""
+
+    return BUILD_ID.sub("", tag)
+
+
+def keep_patterns(keep: list[str], prefix: str | None = None) -> list[str]:
+    """The tags to keep, including the main and beta tags of a prefix."""
+
+    return [*keep, prefix, f"{prefix}-beta"] if prefix else list(keep)
+
+
+def expired_tags(
+    tags: dict[str, dict],
+    keep: list[str] = KEEP_TAGS,
+    keep_recent: int = 5,
+    max_age_days: float = 30,
+    now: datetime | None = None,
+) -> list[str]:
+    """
+    Apply the retention rules to an index of tags and return the ones to
+    delete. Tags matching a glob in keep and the keep_recent newest tags of
+    each branch are always retained. Anything else is expired once it's
+    max_age_days old.
+    """
+
+    now = now or datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=max_age_days)
+
+    groups: dict[str, list[tuple[datetime, str]]] = {}
+    for tag, image in tags.items():
+        if any(fnmatch.fnmatchcase(tag, pattern) for pattern in keep):
+            continue
+        pushed_at = datetime.fromisoformat(image["pushed_at"])
+        groups.setdefault(tag_group(tag), []).append((pushed_at, tag))
+
+    expired = []
+    for group in groups.values():
+        group.sort(reverse=True)
+        expired.extend(
+            tag for pushed_at, tag in group[keep_recent:] if pushed_at < cutoff
+        )
+
+    return sorted(expired)
+
+
+# Manifests that list other manifests: multi-platform images and the
+# attestations buildx pushes alongside them
+INDEX_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+
+
+def referenced_digests(repository_name: str, index_digests: list[str]) -> set[str]:
+    """The digests of the manifests the given image indexes point to."""
+
+    referenced = set()
+    for start in range(0, len(index_digests), DELETE_BATCH_SIZE):
+        response = client().batch_get_image(
+            repositoryName=repository_name,
+            imageIds=[
+                {"imageDigest": digest}
+                for digest in index_digests[start : start + DELETE_BATCH_SIZE]
+            ],
+            acceptedMediaTypes=INDEX_MEDIA_TYPES,
+        )
+        for image in response["images"]:
+            manifest = json.loads(image["imageManifest"])
+            referenced.update(
+                entry["digest"] for entry in manifest.get("manifests", [])
+            )
+
+    return referenced
+
+
+def untagged_images(repository_name: str, max_age_days: float = 30) -> list[str]:
+    """
+    The digests of untagged images that are at least max_age_days old. The
+    per-platform and attestation manifests of a tagged multi-platform image
+    are untagged too, but deleting them would break it, so they're left alone.
+    """
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    paginator = client().get_paginator("describe_images")
+
+    untagged, indexes = [], []
+    for page in paginator.paginate(repositoryName=repository_name):
+        for image in page["imageDetails"]:
+            if image.get("imageTags"):
+                if image.get("imageManifestMediaType") in INDEX_MEDIA_TYPES:
+                    indexes.append(image["imageDigest"])
+            elif image["imagePushedAt"] < cutoff:
+                untagged.append(image["imageDigest"])
+
+    referenced = referenced_digests(repository_name, indexes)
+    return [digest for digest in untagged if digest not in referenced]
+
+
+def delete_images(
+    repository_name: str,
+    image_ids: list[dict[str, str]],
+    dry_run: bool = False,
+) -> int:
+    """
+    Delete images by tag or digest in as few batch_delete_image requests as
+    possible. Returns how many were deleted, or with dry_run, would be.
+    """
+
+    if dry_run:
+        for image_id in image_ids:
+            log.info("Would delete %s", image_id)
+        return len(image_ids)
+
+    deleted = 0
+    for start in range(0, len(image_ids), DELETE_BATCH_SIZE):
+        batch = image_ids[start : start + DELETE_BATCH_SIZE]
+        response = client().batch_delete_image(
+            repositoryName=repository_name, imageIds=batch
+        )
+        deleted += len(response.get("imageIds", []))
+
+        for failure in response.get("failures", []):
+            log.warning(
+                "Failed to delete %s: %s",
+                failure.get("imageId"),
+                failure.get("failureReason"),
+            )
+
+    invalidate(repository_name)
+    return deleted
+
+
+def prune(
+    repository_name: str,
+    keep: list[str] = KEEP_TAGS,
+    prefix: str | None = None,
+    keep_recent: int = 5,
+    max_age_days: float = 30,
+    untagged: bool = False,
+    dry_run: bool = False,
+) -> int:
+    """
+    Delete the tags the retention rules expire and, with untagged, untagged
+    images older than max_age_days that no tagged image uses. Given the
+    prefix builds are tagged with (see Git.artifact_tag), its main and beta
+    tags are kept too.
+    """
+
+    log.start("Pruning %s", repository_name)
+
+    tags = index(repository_name, refresh=True)
+    keep = keep_patterns(keep, prefix)
+    expired = expired_tags(tags, keep, keep_recent, max_age_days)
+    image_ids = [{"imageTag": tag} for tag in expired]
+    log.info("%s of %s tags have expired", len(expired), len(tags))
+
+    if untagged:
+        digests = untagged_images(repository_name, max_age_days)
+        image_ids.extend({"imageDigest": digest} for digest in digests)
+        log.info("%s untagged images have expired", len(digests))
 
+    deleted = delete_images(repository_name, image_ids, dry_run=dry_run)
 
-def get_image_tags(repository_name: str) -> list[str]:
-    response = ecr.describe_images(repositoryName=repository_name)
-    return [
-        tag for image in response["imageDetails"] for tag in image.get("imageTags", [])
-    ]
+    log.end("%s %s images", "Would delete" if dry_run else "Deleted", deleted)
+    return deleted
@@ -4,19 +4,52 @@ Compile an email and deliver it via Amazon SES
 
 import os
 import re
+import gzip
+import uuid
+import shutil
+import time
+import tempfile
+from typing import IO
 from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 from email.message import EmailMessage
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import boto3
+from pydantic import BaseModel
 
-from .logging import log
+from mads.lib.ratelimit import TokenBucket
+from . import aws, s3
+from .logging import log, human_size
 
 SES_SEND_IDENTITY = os.environ.get("SES_SEND_IDENTITY")
 
+# SES rejects messages larger than this, after encoding
+MAX_MESSAGE_SIZE = 10 * 1024**2
+
+# Attachments larger than this after compression are uploaded to
+# $MADS_EMAIL_ATTACHMENT_URL (an s3:// prefix) and linked instead
+OFFLOAD_SIZE = int(os.environ.get("MADS_EMAIL_OFFLOAD_SIZE", 5 * 1024**2))
+ATTACHMENT_URL = os.environ.get("MADS_EMAIL_ATTACHMENT_URL")
+# How long links to uploaded attachments last. A week is the longest a
+# presigned URL can, but one signed with temporary credentials, like a
+# CodeBuild role's, stops working when they expire, so set a shorter time there.
+LINK_EXPIRES_IN = int(os.environ.get("MADS_EMAIL_LINK_EXPIRES_IN", 7 * 24 * 60 * 60))
+
+# How many messages send_bulk sends at once, and how often a throttled message
+# is tried before giving up
+SEND_CONCURRENCY = int(os.environ.get("MADS_EMAIL_CONCURRENCY", 8))
+SEND_ATTEMPTS = 5
+
+# Files that are already compressed aren't worth compressing again
+COMPRESSED_SUFFIXES = {
+    ".gz", ".tgz", ".zst", ".bz2", ".xz", ".zip", ".whl", ".parquet",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".pdf", ".mp4",
+}  # fmt: skip
+
 
 def strip_html(string):
     """Remove links and change HTML line breaks to plaintext."""
@@ -32,10 +65,10 @@ def strip_html(string):
     )
 
     # Don't allow double blank lines
-    re.sub(r"\n{2,}", "\n\n", string)
+    string = re.sub(r"\n{2,}", "\n\n", string)
 
-    # Then look for links to replace
-    re.sub(r'<a href="([^>]+)">.*</a>', r"\1", string)
+    # Then replace links with their text and URL
+    string = re.sub(r'<a href="([^"]+)">(.*?)</a>', r"\2 (\1)", string)
 
     # Then finally, strip any other tags
     return re.sub(r"<[^>]+>", "", string)
@@ -57,30 +90,151 @@ def wrap_html(string):
     )
 
 
-def send_email(**kwargs):
+class EmailResult(BaseModel):
+    """The outcome of sending one message with send_bulk."""
+
+    to: list[str] = []
+    subject: str = ""
+    message_id: str | None = None
+    error: str | None = None
+    attempts: int = 0
+
+
+def send_email(**kwargs) -> str | None:
     """Send an email"""
 
     message = build_email(**kwargs)
-    deliver_email(message)
+    return deliver_email(message)
+
+
+def send_rate() -> float:
+    """The most messages per second the SES account may send."""
 
+    return aws.client("ses").get_send_quota()["MaxSendRate"]
 
-def deliver_email(message: EmailMessage):
-    """Deliver a constructed email via SES."""
+
+def render_messages(template: dict, rows: list[dict]) -> list[dict]:
+    """
+    Fill in a message template for each row, e.g. a template of
+    {"to": "{email}", "subject": "Your {course} build"} and rows from a CSV.
+    """
+
+    def render(value, row: dict):
+        if isinstance(value, str):
+            return value.format_map(row)
+        if isinstance(value, list):
+            return [render(item, row) for item in value]
+        return value
+
+    return [
+        normalize_message({key: render(value, row) for key, value in template.items()})
+        for row in rows
+    ]
+
+
+def normalize_message(message: dict) -> dict:
+    """
+    Turn a message's addresses and attachments into lists, e.g. a to of
+    "a@example.com, b@example.com" from a CSV. Raises ValueError for anything
+    else that isn't a list.
+    """
+
+    message = dict(message)
+    for field in ("to", "cc", "bcc", "attachments"):
+        value = message.get(field)
+        if isinstance(value, str):
+            if field == "attachments":
+                message[field] = [value]
+            else:
+                message[field] = [part.strip() for part in value.split(",")]
+        elif field in message and not isinstance(value, list):
+            raise ValueError(f"{field} must be a string or a list, not {value!r}")
+
+    return message
+
+
+def send_bulk(
+    messages: list[dict],
+    concurrency: int = SEND_CONCURRENCY,
+    rate: float | None = None,
+) -> list[EmailResult]:
+    """
+    Send many messages concurrently over the shared SES client, no faster
+    than rate per second (the account's send rate by default). Throttled
+    messages are retried with backoff. Returns a result for each message, in
+    order; one failure doesn't stop the rest.
+    """
+
+    from botocore.exceptions import ClientError
+
+    bucket = TokenBucket(rate or send_rate())
+    log.start("Sending %s emails at up to %s/s", len(messages), bucket.rate)
+
+    def send(kwargs: dict) -> EmailResult:
+        result = EmailResult()
+
+        # A bad message is reported like any other failure
+        try:
+            kwargs = normalize_message(kwargs)
+            result.to, result.subject = kwargs["to"], kwargs["subject"]
+        except (KeyError, ValueError) as e:
+            result.error = f"{type(e).__name__}: {e}"
+            return result
+
+        while True:
+            bucket.acquire()
+            result.attempts += 1
+            try:
+                result.message_id = send_email(**kwargs)
+                return result
+            except ClientError as e:
+                error = e.response["Error"]
+                throttled = error["Code"] in ("Throttling", "ThrottlingException")
+
+                # Running out of the daily quota won't fix itself
+                if throttled and "daily" not in error.get("Message", "").lower():
+                    if result.attempts < SEND_ATTEMPTS:
+                        time.sleep(2**result.attempts / bucket.rate)
+                        continue
+
+                result.error = f"{error['Code']}: {error.get('Message', '')}"
+                return result
+            except Exception as e:
+                result.error = f"{type(e).__name__}: {e}"
+                return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, messages))
+
+    failed = [result for result in results if result.error]
+    for result in failed:
+        log.warning("Failed to email %s: %s", ", ".join(result.to), result.error)
+
+    log.end("Sent %s emails, %s failed", len(results) - len(failed), len(failed))
+    return results
+
+
+def deliver_email(message: EmailMessage) -> str | None:
+    """Deliver a constructed email via SES and return its message ID."""
 
     if not SES_SEND_IDENTITY:
         log.warning("No $SES_SEND_IDENTITY set. Skipping email delivery.")
         return
 
-    client = boto3.client("ses")
-    res = client.send_raw_email(
+    data = message.as_bytes()
+    if len(data) > MAX_MESSAGE_SIZE:
+        log.warning("The email is %s, which SES may reject", human_size(len(data)))
+
+    res = aws.client("ses").send_raw_email(
         Source=SES_SEND_IDENTITY,
         Destinations=message["to"].split(", "),
         RawMessage={
-            "Data": message.as_string(),
+            "Data": data,
         },
     )
 
     log.info("Send email result: %s", res)
+    return res["MessageId"]
 
 
 def build_email(**kwargs) -> EmailMessage:
@@ -89,58 +243,170 @@ def build_email(**kwargs) -> EmailMessage:
     log.info("Building email")
     log.indent()
 
-    message = EmailMessage()
-
-    # Start with addressees. To is required, but the others are optional.
-    message["To"] = kwargs["to"]
-    log.info("To: %s", ", ".join(kwargs["to"]))
-
-    if "cc" in kwargs:
-        message["CC"] = kwargs["cc"]
-        log.info("CC: %s", ", ".join(kwargs["bcc"]))
-    if "bcc" in kwargs:
-        message["BCC"] = kwargs["bcc"]
-        log.info("BCC: %s", ", ".join(kwargs["bcc"]))
-
-    # From is hard-coded. All message from the CI come from this address.
-    name = kwargs.get("from_name", "MADS Course Builds")
-    message["From"] = f"{name} <{SES_SEND_IDENTITY}>"
-    log.info("From: %s", message["From"])
-
-    # Subject is also required.
-    message["Subject"] = kwargs["subject"]
-    log.info("Subject: %s", kwargs["subject"])
-
-    message.make_mixed()
-
-    # Attach the main body of the message
-    if "body" in kwargs:
-        body = MIMEMultipart("alternative")
-        body.attach(MIMEText(strip_html(kwargs["body"]), "plain", "utf-8"))
-        body.attach(MIMEText(wrap_html(kwargs["body"]), "html", "utf-8"))
-        message.attach(body)
-
-        log.info("Body:")
-        log.indent()
-        log.info(strip_html(kwargs.get("body", "")))
+    try:
+        message = EmailMessage()
+
+        # Start with addressees. To is required, but the others are optional.
+        message["To"] = kwargs["to"]
+        log.info("To: %s", ", ".join(kwargs["to"]))
+
+        if "cc" in kwargs:
+            message["CC"] = kwargs["cc"]
+            log.info("CC: %s", ", ".join(kwargs["cc"]))
+        if "bcc" in kwargs:
+            message["BCC"] = kwargs["bcc"]
+            log.info("BCC: %s", ", ".join(kwargs["bcc"]))
+
+        # From is hard-coded. All message from the CI come from this address.
+        name = kwargs.get("from_name", "MADS Course Builds")
+        message["From"] = f"{name} <{SES_SEND_IDENTITY}>"
+        log.info("From: %s", message["From"])
+
+        # Subject is also required.
+        message["Subject"] = kwargs["subject"]
+        log.info("Subject: %s", kwargs["subject"])
+
+        message.make_mixed()
+
+        # Compress the attachments first, since the large ones become links in the body
+        compressed = [
+            compress_attachment(path) for path in kwargs.get("attachments", [])
+        ]
+
+        # Keep the smallest attachments that fit alongside both copies of the body
+        fits = set()
+        budget = MAX_MESSAGE_SIZE - encoded_size(len(kwargs.get("body", "")) * 2)
+        for i, (name, data, size) in sorted(
+            enumerate(compressed), key=lambda att: att[1][2]
+        ):
+            if size <= OFFLOAD_SIZE and encoded_size(size) <= budget:
+                fits.add(i)
+                budget -= encoded_size(size)
+
+        # Then attach and link them in the order they were given
+        attachments, links = [], []
+        for i, (name, data, size) in enumerate(compressed):
+            if i in fits:
+                attachments.append((name, data, size))
+            else:
+                url = offload_attachment(name, data, LINK_EXPIRES_IN)
+                links.append((name, url, size))
+
+        body_html = kwargs.get("body", "")
+        if links:
+            body_html += links_html(links, LINK_EXPIRES_IN)
+
+        # Attach the main body of the message
+        if body_html:
+            body = MIMEMultipart("alternative")
+            body.attach(MIMEText(strip_html(body_html), "plain", "utf-8"))
+            body.attach(MIMEText(wrap_html(body_html), "html", "utf-8"))
+            message.attach(body)
+
+            log.info("Body:")
+            log.indent()
+            log.info(strip_html(body_html))
+            log.outdent()
+
+        # Attach each of the attachments to the message
+        if attachments:
+            log.info("Attachments:")
+            log.indent("*")
+
+            try:
+                for name, data, size in attachments:
+                    with data:
+                        content = MIMEApplication(data.read())
+                    content.add_header(
+                        "Content-Disposition", "attachment", filename=name
+                    )
+                    message.attach(content)
+                    log.info("%s (%s)", name, human_size(size))
+            finally:
+                log.outdent()
+
+        log.info("")
+    finally:
+        # Don't leave the indent behind if a message fails to build
         log.outdent()
 
-    # Attach each of the attachments to the message
-    if "attachments" in kwargs:
-        log.info("Attachments:")
-        log.indent("*")
+    return message
 
-        for att in kwargs.get("attachments", []):
-            with open(att, "rb") as file:
-                content = MIMEApplication(file.read())
-                content.add_header(
-                    "Content-Disposition", "attachment", filename=Path(att).name
-                )
-                message.attach(content)
-                log.info(Path(att).name)
 
-        log.outdent()
+def encoded_size(size: int) -> int:
+    """How big size bytes become in base64, with a line break every 76 characters."""
+
+    return (size + 56) // 57 * 78
+
+
+def compress_attachment(path: str | Path) -> tuple[str, IO[bytes], int]:
+    """
+    Gzip a file into a temporary file, unless it's compressed already. The
+    result only spills to disk once it's large. Returns the attachment's name,
+    the open file positioned at its start, and its size.
+    """
+
+    path = Path(path)
+    data = tempfile.SpooledTemporaryFile(max_size=1024**2)
+
+    with open(path, "rb") as file:
+        if path.suffix.lower() in COMPRESSED_SUFFIXES:
+            name = path.name
+            shutil.copyfileobj(file, data, 1024**2)
+        else:
+            name = path.name + ".gz"
+            with gzip.GzipFile(filename=path.name, fileobj=data, mode="wb") as gz:
+                shutil.copyfileobj(file, gz, 1024**2)
+
+    size = data.tell()
+    data.seek(0)
+    return name, data, size
+
+
+def offload_attachment(
+    name: str, data: IO[bytes], expires_in: int = LINK_EXPIRES_IN
+) -> str | None:
+    """
+    Upload an attachment that's too large to send to $MADS_EMAIL_ATTACHMENT_URL
+    and return a link to it that lasts expires_in seconds, or None if there's
+    nowhere to put it.
+    """
+
+    with data:
+        if not ATTACHMENT_URL:
+            log.warning(
+                "%s is too large to attach and $MADS_EMAIL_ATTACHMENT_URL isn't set",
+                name,
+            )
+            return None
+
+        bucket, prefix = s3.parse_url(ATTACHMENT_URL.rstrip("/"))
+        key = f"{prefix}/{datetime.now():%Y-%m-%d}/{uuid.uuid4().hex}/{name}"
+        key = key.lstrip("/")
+
+        log.info("Uploading %s to s3://%s/%s", name, bucket, key)
+        s3.upload_stream(data, bucket, key)
+
+    return s3.presign(bucket, key, expires_in=expires_in)[key]
+
+
+def links_html(
+    links: list[tuple[str, str | None, int]], expires_in: int = LINK_EXPIRES_IN
+) -> str:
+    """Describe the attachments uploaded instead, whose links last expires_in seconds."""
+
+    expires = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+    items = "".join(
+        (
+            f'<li><a href="{url}">{name}</a> ({human_size(size)})</li>'
+            if url
+            else f"<li>{name} ({human_size(size)}) was too large to send</li>"
+        )
+        for name, url, size in links
+    )
 
-    log.info("")
-    log.outdent()
-    return message
+    return (
+        "<p>Some attachments were too large to include in this email. "
+        f"They can be downloaded until {expires:%B %-d, %Y at %H:%M} UTC:</p>"
+        f"<ul>{items}</ul>"
+    )
@@ -3,19 +3,58 @@ Submit GitHub status checks.
 """
 
 import os
+import re
 import jwt
+import json
 import time
-from functools import cache
+import hashlib
+import threading
+import mimetypes
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import Tuple
 from pathlib import Path
 
+from pydantic import BaseModel
 from ruamel.yaml import YAML
 from ghapi.all import GhApi
 
-from .logging import log
+from mads.environ import Runner
+from mads.lib.cache import cache_dir
+from .logging import log, human_size
 from .shell import shell
 
+# App credentials used when none are given: either a Secrets Manager secret
+# holding all three, or each of them directly
+APP_ID = os.environ.get("GITHUB_APP_ID")
+INSTALLATION_ID = os.environ.get("GITHUB_APP_INSTALLATION_ID")
+PRIVATE_KEY = os.environ.get("GITHUB_APP_PRIVATE_KEY")
+SECRET_ID = os.environ.get("GITHUB_APP_SECRET_ID")
+
+# Installation tokens are reused until this many seconds before they expire,
+# and shared through a file by every mads command in a CI build unless
+# $MADS_GITHUB_TOKEN_CACHE is 0
+TOKEN_REFRESH_MARGIN = 5 * 60
+TOKEN_CACHE = os.environ.get("MADS_GITHUB_TOKEN_CACHE", "1") != "0"
+
+# The Checks API accepts at most this many annotations per request, and this
+# much summary text
+ANNOTATIONS_PER_REQUEST = 50
+MAX_SUMMARY_LENGTH = 65535
+
+# Requests left in the hour at which the client waits for the limit to reset,
+# how often a request hitting a secondary rate limit is retried, and how many
+# GET responses are kept for conditional requests
+RATE_LIMIT_RESERVE = int(os.environ.get("MADS_GITHUB_RATE_LIMIT_RESERVE", 50))
+SECONDARY_LIMIT_RETRIES = 4
+ETAG_CACHE_SIZE = 1024
+
+_lock = threading.RLock()
+_tokens: dict[str, dict] = {}
+_client: tuple[str, "GitHub"] | None = None
+
 STATUS_MESSAGES = {
     "pending": "⏳ Build started for project {}",
     "success": "✅ Build succeeded for project {}",
@@ -24,6 +63,17 @@ STATUS_MESSAGES = {
 }
 
 
+class Annotation(BaseModel):
+    """A message about a line of a file, shown on a check run."""
+
+    path: str
+    start_line: int
+    end_line: int
+    annotation_level: str = "failure"
+    message: str
+    title: str | None = None
+
+
 class CheckState(str, Enum):
     """The state of a GitHub check."""
 
@@ -34,15 +84,12 @@ class CheckState(str, Enum):
     FINISHED = "finished"
 
 
-@cache
 def aws_private_key(secret_id: str) -> Tuple[int, int, str]:
     """Load the GitHub private key from secrets manager."""
 
-    import boto3
+    from .secrets import get_secret
 
-    secrets = boto3.client("secretsmanager")
-    secret = secrets.get_secret_value(SecretId=secret_id)
-    data = YAML(typ="safe").load(secret["SecretString"])
+    data = YAML(typ="safe").load(get_secret(secret_id))
     return (
         data["app_id"],
         data["installation_id"],
@@ -50,43 +97,259 @@ def aws_private_key(secret_id: str) -> Tuple[int, int, str]:
     )
 
 
+class GitHub(GhApi):
+    """
+    A GhApi client that stays within GitHub's rate limits. It tracks the
+    X-RateLimit headers and waits for the reset rather than spend the last
+    RATE_LIMIT_RESERVE requests, retries secondary rate limits with backoff,
+    and repeats GETs with If-None-Match, since 304s don't count against the
+    limit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_lock = threading.Lock()
+        self.rate_remaining: int | None = None
+        self.rate_reset = 0.0
+        self.etag_lock = threading.Lock()
+        self.etags: OrderedDict[tuple, tuple[str, object]] = OrderedDict()
+
+        # GhApi keeps the last response's headers on the client, so a request
+        # and the reading of its headers can't overlap with another's
+        self.call_lock = threading.Lock()
+
+    def __call__(
+        self,
+        path,
+        verb=None,
+        headers=None,
+        route=None,
+        query=None,
+        data=None,
+        **kwargs,
+    ):
+        from urllib.error import HTTPError
+
+        verb = verb or ("POST" if data else "GET")
+        headers = dict(headers or {})
+
+        cache_key, cached = None, None
+        if verb == "GET":
+            cache_key = (path, repr(sorted((route or {}).items())), repr(query))
+            with self.etag_lock:
+                cached = self.etags.get(cache_key)
+            if cached:
+                headers["If-None-Match"] = cached[0]
+
+        for attempt in range(SECONDARY_LIMIT_RETRIES + 1):
+            self._wait_for_limit()
+
+            try:
+                with self.call_lock:
+                    result = super().__call__(
+                        path,
+                        verb,
+                        headers=headers,
+                        route=dict(route) if route else None,
+                        query=query,
+                        data=data,
+                        **kwargs,
+                    )
+                    received = self.recv_hdrs
+            except HTTPError as e:
+                self._track(e.headers)
+
+                # Answer with the body of the ETag that was sent, even if
+                # another thread has since cached a newer one
+                if e.code == 304 and cached:
+                    with self.etag_lock:
+                        if cache_key in self.etags:
+                            self.etags.move_to_end(cache_key)
+                    return cached[1]
+
+                delay = self._retry_delay(e, attempt)
+                if delay is not None and attempt < SECONDARY_LIMIT_RETRIES:
+                    log.warning("GitHub rate limited %s, retrying in %ss", path, delay)
+                    time.sleep(delay)
+                    continue
+
+                raise
+
+            self._track(received)
+
+            if cache_key and (etag := received.get("ETag")):
+                with self.etag_lock:
+                    self.etags[cache_key] = (etag, result)
+                    self.etags.move_to_end(cache_key)
+                    while len(self.etags) > ETAG_CACHE_SIZE:
+                        self.etags.popitem(last=False)
+
+            return result
+
+    def _track(self, headers):
+        """Remember the rate limit from a response's headers."""
+
+        if headers and headers.get("X-RateLimit-Remaining") is not None:
+            with self.rate_lock:
+                self.rate_remaining = int(headers["X-RateLimit-Remaining"])
+                self.rate_reset = float(headers.get("X-RateLimit-Reset", 0))
+
+    def _wait_for_limit(self):
+        """Wait for the rate limit to reset if it's nearly spent."""
+
+        with self.rate_lock:
+            if self.rate_remaining is None or self.rate_remaining > RATE_LIMIT_RESERVE:
+                return
+
+            wait = self.rate_reset - time.time() + 1
+            if wait > 0:
+                log.warning(
+                    "%s GitHub requests left, waiting %ss for the limit to reset",
+                    self.rate_remaining,
+                    int(wait),
+                )
+                time.sleep(wait)
+
+            self.rate_remaining = None
+
+    def _retry_delay(self, error, attempt: int) -> float | None:
+        """How long to wait before retrying a rate limited request, if at all."""
+
+        headers = error.headers or {}
+        limited = (
+            error.code == 429
+            or headers.get("Retry-After") is not None
+            or headers.get("X-RateLimit-Remaining") == "0"
+            or "rate limit" in str(error).lower()
+        )
+        if error.code not in (403, 429) or not limited:
+            return None
+
+        if headers.get("Retry-After") is not None:
+            return float(headers["Retry-After"])
+        if headers.get("X-RateLimit-Remaining") == "0":
+            return max(float(headers.get("X-RateLimit-Reset", 0)) - time.time(), 0) + 1
+
+        # GitHub asks for at least a minute, growing exponentially
+        return 60 * 2**attempt
+
+
+def _token_file() -> Path | None:
+    """The file installation tokens are shared through for this build, if any."""
+
+    runner = Runner.current()
+    if not TOKEN_CACHE or runner.name == "local":
+        return None
+
+    build = hashlib.sha256(f"{runner.name}:{runner.run_id}".encode()).hexdigest()
+    return cache_dir("github").joinpath(f"tokens-{build[:16]}.json")
+
+
+def _cached_token(key: str) -> str | None:
+    """Find a token that isn't about to expire, in memory or the build's file."""
+
+    entry = _tokens.get(key)
+
+    if entry is None and (path := _token_file()) and path.exists():
+        entry = json.loads(path.read_text()).get(key)
+
+    if entry and entry["expires_at"] - time.time() > TOKEN_REFRESH_MARGIN:
+        _tokens[key] = entry
+        return entry["token"]
+
+    return None
+
+
+def _save_token(key: str, token: str, expires_at: float):
+    """Remember a token, and share it with the rest of the build."""
+
+    _tokens[key] = {"token": token, "expires_at": expires_at}
+
+    if path := _token_file():
+        tokens = json.loads(path.read_text()) if path.exists() else {}
+        tokens[key] = _tokens[key]
+
+        # Only this user may read the tokens, even for a moment
+        partial = path.with_name(f".{path.name}.{os.getpid()}")
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(partial, path)
+
+
 def token(
     app_id: int | None = None,
     installation_id: int | None = None,
     private_key: str | None = None,
     secret_id: str | None = None,
+    refresh: bool = False,
 ) -> str:
-    """Generate an installation token for the GitHub app."""
+    """
+    Return an installation token for the GitHub app. Tokens are reused until
+    shortly before they expire, unless refresh is set. Without credentials,
+    they're read from $GITHUB_APP_SECRET_ID or $GITHUB_APP_ID,
+    $GITHUB_APP_INSTALLATION_ID and $GITHUB_APP_PRIVATE_KEY.
+    """
+
+    if not any([app_id, installation_id, private_key, secret_id]):
+        app_id, installation_id, private_key = APP_ID, INSTALLATION_ID, PRIVATE_KEY
+        secret_id = SECRET_ID
+
+    key = secret_id or f"{app_id}:{installation_id}"
+
+    with _lock:
+        if not refresh and (cached := _cached_token(key)):
+            return cached
+
+        if secret_id:
+            app_id, installation_id, private_key = aws_private_key(secret_id)
+
+        here = locals()
+        missing = [
+            name
+            for name in ["app_id", "installation_id", "private_key"]
+            if not here[name]
+        ]
+        assert len(missing) == 0, f"Missing GitHub app credentials: {missing}"
+
+        payload = {
+            "iat": int(time.time()),
+            "exp": int(time.time()) + (10 * 60),
+            "iss": app_id,
+        }
+
+        jwt_token = jwt.encode(payload, private_key, algorithm="RS256")
+        token_client = GhApi(jwt_token=jwt_token)
+        response = token_client.apps.create_installation_access_token(installation_id)
+        log.info(
+            "Created GitHub access token. Will expire at %s", response["expires_at"]
+        )
 
-    if secret_id:
-        app_id, installation_id, private_key = aws_private_key(secret_id)
+        expires_at = datetime.fromisoformat(
+            response["expires_at"].replace("Z", "+00:00")
+        )
+        _save_token(key, response["token"], expires_at.timestamp())
+        return response["token"]
 
-    here = locals()
-    missing = [
-        key for key in ["app_id", "installation_id", "private_key"] if not here[key]
-    ]
-    assert len(missing) == 0, f"Missing GitHub app credentials: {missing}"
 
-    payload = {
-        "iat": int(time.time()),
-        "exp": int(time.time()) + (10 * 60),
-        "iss": app_id,
-    }
+def client() -> GhApi:
+    """The shared GitHub API client, authenticated with a current token."""
 
-    jwt_token = jwt.encode(payload, private_key, algorithm="RS256")
-    token_client = GhApi(jwt_token=jwt_token)
-    response = token_client.apps.create_installation_access_token(installation_id)
-    log.info(
-        "Created GitHub access token. Will expire in 10 minutes at %s",
-        response["expires_at"],
-    )
-    return response["token"]
+    global _client
 
+    current = token()
+    with _lock:
+        if _client is None or _client[0] != current:
+            api = GitHub(token=current)
 
-def client():
-    """Initialize a GitHub API client."""
+            # The installation's rate limit and cached responses outlive a token
+            if _client is not None:
+                old = _client[1]
+                api.rate_remaining, api.rate_reset = old.rate_remaining, old.rate_reset
+                api.etags = old.etags
+            _client = (current, api)
 
-    return GhApi(token=token())
+    return _client[1]
 
 
 def install(token: str):
@@ -102,6 +365,15 @@ def install(token: str):
     log.warning("Installed GitHub token to ~/.git-credentials")
 
 
+def _current_commit() -> tuple[str, str, str]:
+    """The owner, repository and commit the build is running for."""
+
+    commit = os.environ["CODEBUILD_RESOLVED_SOURCE_VERSION"]
+    org = os.environ["CODEBUILD_SOURCE_REPO_URL"].split("/")[-2]
+    repo = os.environ["CODEBUILD_SOURCE_REPO_URL"].split("/")[-1].split(".")[0]
+    return org, repo, commit
+
+
 def create_status(
     status: str,
     context: str | None = None,
@@ -109,9 +381,7 @@ def create_status(
 ):
     """Create a status check on GitHub."""
 
-    commit = os.environ["CODEBUILD_RESOLVED_SOURCE_VERSION"]
-    org = os.environ["CODEBUILD_SOURCE_REPO_URL"].split("/")[-2]
-    repo = os.environ["CODEBUILD_SOURCE_REPO_URL"].split("/")[-1].split(".")[0]
+    org, repo, commit = _current_commit()
 
     if status == "finished":
         status = (
@@ -153,3 +423,240 @@ def create_status(
             description,
         )
         log.error(response)
+
+
+def parse_annotations(output: str, root: str | Path | None = None) -> list[Annotation]:
+    """
+    Find file and line messages in tool output, in either the common
+    "path:line[:col]: [level:] message" form (flake8, ruff, mypy, compilers)
+    or as GitHub workflow commands ("::error file=path,line=1::message").
+    Paths are made relative to root, the current directory by default.
+    """
+
+    root = Path(root or Path.cwd()).absolute()
+    levels = {"error": "failure", "fatal": "failure", "warning": "warning"}
+    annotations = []
+
+    for line in output.splitlines():
+        if match := re.match(r"::(error|warning|notice) (.*?)::(.*)", line):
+            level, params, message = match.groups()
+            params = dict(
+                param.split("=", 1) for param in params.split(",") if "=" in param
+            )
+            if "file" not in params:
+                continue
+            path, start = params["file"], int(params.get("line", 1))
+            end = int(params.get("endLine", start))
+            title = params.get("title")
+        elif match := re.match(
+            r"([^\s:][^:]*\.\w+):(\d+):(?:\d+:)?\s*(?:(error|warning|note)\w*:)?\s*(.+)",
+            line,
+        ):
+            path, start, level, message = match.groups()
+            start = end = int(start)
+            level = level or "error"
+            title = None
+        else:
+            continue
+
+        path = Path(path)
+        if path.is_absolute() and path.is_relative_to(root):
+            path = path.relative_to(root)
+
+        annotations.append(
+            Annotation(
+                path=path.as_posix(),
+                start_line=start,
+                end_line=end,
+                annotation_level=levels.get(level, "notice"),
+                message=message.strip(),
+                title=title,
+            )
+        )
+
+    return annotations
+
+
+def report_check(
+    name: str,
+    conclusion: str | None = None,
+    title: str | None = None,
+    summary: str = "",
+    annotations: list[Annotation] = [],
+    details_url: str | None = None,
+) -> int:
+    """
+    Create or update the check run called name on the current commit. Without
+    a conclusion, the run is left in progress. Annotations are uploaded in
+    batches of 50, the most a request can carry, and the conclusion is only
+    set with the last batch. Returns the check run's id.
+    """
+
+    owner, repo, commit = _current_commit()
+    api = client()
+
+    title = title or name
+    if len(summary) > MAX_SUMMARY_LENGTH:
+        summary = summary[: MAX_SUMMARY_LENGTH - 20] + "\n\n…(truncated)"
+
+    batches = [
+        [annotation.model_dump(exclude_none=True) for annotation in batch]
+        for batch in (
+            annotations[i : i + ANNOTATIONS_PER_REQUEST]
+            for i in range(0, len(annotations), ANNOTATIONS_PER_REQUEST)
+        )
+    ] or [[]]
+
+    existing = api.checks.list_for_ref(owner, repo, commit, check_name=name)
+    runs = existing["check_runs"]
+
+    for i, batch in enumerate(batches):
+        last = i == len(batches) - 1
+        params = {
+            "output": {"title": title, "summary": summary, "annotations": batch},
+            "status": "completed" if conclusion and last else "in_progress",
+        }
+        if conclusion and last:
+            params["conclusion"] = conclusion
+        if details_url or os.environ.get("CODEBUILD_BUILD_URL"):
+            params["details_url"] = details_url or os.environ["CODEBUILD_BUILD_URL"]
+
+        if runs:
+            run = api.checks.update(owner, repo, runs[0]["id"], **params)
+        else:
+            run = api.checks.create(owner, repo, name=name, head_sha=commit, **params)
+            runs = [run]
+
+    log.info(
+        "Reported check %s (%s) with %s annotations",
+        name,
+        conclusion or "in progress",
+        len(annotations),
+    )
+    return runs[0]["id"]
+
+
+def release(tag: str, owner: str, repo: str) -> dict:
+    """Find the release for a tag, creating it if there isn't one."""
+
+    from urllib.error import HTTPError
+
+    api = client()
+    try:
+        return api.repos.get_release_by_tag(owner, repo, tag)
+    except HTTPError as e:
+        if e.code != 404:
+            raise
+
+    log.info("Creating release %s in %s/%s", tag, owner, repo)
+    return api.repos.create_release(owner, repo, tag_name=tag, name=tag)
+
+
+def _release_assets(owner: str, repo: str, release_id: int) -> dict[str, dict]:
+    """The assets already uploaded to a release, by name."""
+
+    api = client()
+    assets, page = {}, 1
+
+    while True:
+        batch = api.repos.list_release_assets(
+            owner, repo, release_id, per_page=100, page=page
+        )
+        assets.update({asset["name"]: asset for asset in batch})
+        if len(batch) < 100:
+            return assets
+        page += 1
+
+
+def _upload_asset(upload_url: str, path: Path) -> dict:
+    """Stream a file to a release's upload URL."""
+
+    from urllib.parse import quote
+    from urllib.request import Request, urlopen
+
+    url = upload_url.split("{")[0] + "?name=" + quote(path.name)
+    content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+    with open(path, "rb") as f:
+        request = Request(
+            url,
+            data=f,
+            method="POST",
+            headers={
+                "Authorization": f"token {token()}",
+                "Accept": "application/vnd.github+json",
+                "Content-Type": content_type,
+                "Content-Length": str(path.stat().st_size),
+            },
+        )
+        with urlopen(request) as response:
+            return json.load(response)
+
+
+def upload_release_assets(
+    tag: str,
+    paths: list[str | Path],
+    owner: str | None = None,
+    repo: str | None = None,
+    concurrency: int = 4,
+) -> dict:
+    """
+    Upload files to the release for a tag, creating the release if needed.
+    Files are streamed from disk, several at a time. Assets that already
+    exist with the same name and size are skipped; ones whose size differs
+    are replaced. Returns a summary of what was uploaded.
+    """
+
+    if not owner or not repo:
+        owner, repo, _ = _current_commit()
+
+    paths = [Path(path) for path in paths]
+    target = release(tag, owner, repo)
+    existing = _release_assets(owner, repo, target["id"])
+
+    uploads = []
+    for path in paths:
+        asset = existing.get(path.name)
+        if asset and asset["size"] == path.stat().st_size:
+            log.info("Skipping %s, it's already uploaded", path.name)
+            continue
+        if asset:
+            client().repos.delete_release_asset(owner, repo, asset["id"])
+        uploads.append(path)
+
+    total = sum(path.stat().st_size for path in uploads)
+    log.start(
+        "Uploading %s assets (%s) to %s/%s %s",
+        len(uploads),
+        human_size(total),
+        owner,
+        repo,
+        tag,
+    )
+    start = time.time()
+
+    def upload(path: Path) -> dict:
+        asset = _upload_asset(target["upload_url"], path)
+        log.info("Uploaded %s (%s)", path.name, human_size(path.stat().st_size))
+        return asset
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, uploads))
+
+    seconds = time.time() - start
+    summary = {
+        "release": target.get("html_url"),
+        "uploaded": len(uploads),
+        "skipped": len(paths) - len(uploads),
+        "bytes": total,
+        "seconds": round(seconds, 3),
+        "throughput": round(total / seconds) if seconds else 0,
+    }
+
+    log.end(
+        "Uploaded %s assets at %s/s, skipped %s",
+        summary["uploaded"],
+        human_size(summary["throughput"]),
+        summary["skipped"],
+    )
+    return summary
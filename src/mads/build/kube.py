@@ -2,16 +2,239 @@
 Helper functions for interacting with Kubernetes.
 """
 
-from .shell import shell
+import os
+import time
+import shlex
+from pathlib import Path
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
 
+from pydantic import BaseModel
+from ruamel.yaml import YAML
 
-def setup(cluster):
-    """Configure kubectl to use the given EKS cluster."""
+from mads.environ import Runner
+from . import aws
+from .logging import log
+from .shell import shell, proc
 
-    shell(f"aws eks update-kubeconfig --name {cluster} --region us-east-1")
+# Used when neither the runner nor the environment says which region we're in
+DEFAULT_REGION = "us-east-1"
+
+# How long to wait for a deployment to become ready, and how many to restart at once
+ROLLOUT_TIMEOUT = 10 * 60
+ROLLOUT_CONCURRENCY = 8
+
+
+class Rollout(BaseModel):
+    """The progress of restarting one deployment."""
+
+    namespace: str
+    deployment: str
+    state: str = "pending"  # pending, restarting, waiting, ready or failed
+    message: str = ""
+    seconds: float = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.state == "ready"
+
+
+def kubeconfig_path() -> Path:
+    """The kubeconfig kubectl reads first."""
+
+    paths = os.environ.get("KUBECONFIG", "").split(os.pathsep)
+    return Path(paths[0] or "~/.kube/config").expanduser()
+
+
+def find_context(config: dict, cluster: str, region: str) -> str | None:
+    """Find a context for an EKS cluster, like those update-kubeconfig writes."""
+
+    arns = {
+        entry["name"]
+        for entry in config.get("clusters") or []
+        if entry["name"].startswith(f"arn:aws:eks:{region}:")
+        and entry["name"].endswith(f":cluster/{cluster}")
+    }
+
+    for entry in config.get("contexts") or []:
+        if entry["context"].get("cluster") in arns:
+            return entry["name"]
+
+    return None
+
+
+def _replace(entries: list, name: str, entry: dict):
+    """Replace the kubeconfig entry with a name, or add it."""
+
+    entries[:] = [e for e in entries if e.get("name") != name] + [entry]
+
+
+def setup(cluster: str, region: str | None = None) -> str:
+    """
+    Configure kubectl to use the given EKS cluster. An existing context for
+    the cluster is reused; otherwise one is written, the same as
+    `aws eks update-kubeconfig` would, from the cluster's description. The
+    region defaults to the runner's.
+    """
+
+    region = region or Runner.current().region or DEFAULT_REGION
+    path = kubeconfig_path()
+    yaml = YAML()
+
+    config = (yaml.load(path) if path.exists() else None) or {}
+    context = find_context(config, cluster, region)
+
+    if context is None:
+        log.info("Adding the %s cluster in %s to %s", cluster, region, path)
+
+        info = aws.client("eks", region_name=region).describe_cluster(name=cluster)
+        info = info["cluster"]
+        context = info["arn"]
+
+        config.setdefault("apiVersion", "v1")
+        config.setdefault("kind", "Config")
+        for key in ("clusters", "contexts", "users"):
+            config[key] = config.get(key) or []
+
+        _replace(
+            config["clusters"],
+            context,
+            {
+                "name": context,
+                "cluster": {
+                    "server": info["endpoint"],
+                    "certificate-authority-data": info["certificateAuthority"]["data"],
+                },
+            },
+        )
+        _replace(
+            config["users"],
+            context,
+            {
+                "name": context,
+                "user": {
+                    "exec": {
+                        "apiVersion": "client.authentication.k8s.io/v1beta1",
+                        "command": "aws",
+                        "args": [
+                            "--region",
+                            region,
+                            "eks",
+                            "get-token",
+                            "--cluster-name",
+                            cluster,
+                            "--output",
+                            "json",
+                        ],
+                    }
+                },
+            },
+        )
+        _replace(
+            config["contexts"],
+            context,
+            {"name": context, "context": {"cluster": context, "user": context}},
+        )
+    elif config.get("current-context") == context:
+        return context
+
+    config["current-context"] = context
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        yaml.dump(config, f)
+
+    return context
 
 
 def rollout(deployment, namespace):
     """Restart the given deployment."""
 
     shell(f"kubectl rollout restart deploy/{deployment} -n {namespace}")
+
+
+def parse_target(target: str, namespace: str | None = None) -> tuple[str, str]:
+    """Split a namespace/deployment target, with a default namespace."""
+
+    if "/" in target:
+        namespace, deployment = target.split("/", 1)
+    else:
+        deployment = target
+
+    assert namespace, f"No namespace for deployment {target}"
+    return namespace, deployment
+
+
+def rollout_and_wait(
+    rollout: Rollout,
+    timeout: int = ROLLOUT_TIMEOUT,
+    on_update: Callable[[], None] | None = None,
+) -> Rollout:
+    """Restart a deployment and wait for the new pods to become ready."""
+
+    def update(state: str, message: str = ""):
+        rollout.state = state
+        rollout.message = message or rollout.message
+        rollout.seconds = round(time.time() - start, 1)
+        if on_update:
+            on_update()
+
+    start = time.time()
+    target = f"deploy/{shlex.quote(rollout.deployment)}"
+    namespace = shlex.quote(rollout.namespace)
+
+    def decode(output: bytes) -> str:
+        return output.decode("utf-8", errors="replace").strip()
+
+    update("restarting")
+    res = proc(f"kubectl rollout restart {target} -n {namespace}", silent=True)
+    if res.returncode != 0:
+        update("failed", decode(res.stderr) or decode(res.stdout))
+        return rollout
+
+    update("waiting")
+    res = proc(
+        f"kubectl rollout status {target} -n {namespace} --timeout={timeout}s",
+        silent=True,
+    )
+    output = (decode(res.stdout) or decode(res.stderr)).splitlines()
+    update(
+        "ready" if res.returncode == 0 else "failed",
+        output[-1] if output else "",
+    )
+    return rollout
+
+
+def rollout_all(
+    targets: list[tuple[str, str]],
+    timeout: int = ROLLOUT_TIMEOUT,
+    concurrency: int = ROLLOUT_CONCURRENCY,
+    on_update: Callable[[list[Rollout]], None] | None = None,
+) -> list[Rollout]:
+    """
+    Restart many (namespace, deployment) pairs at once and wait for each to
+    finish rolling out. on_update is called with every rollout whenever one
+    of them changes state. Returns every rollout, in order.
+    """
+
+    rollouts = [Rollout(namespace=ns, deployment=name) for ns, name in targets]
+
+    def updated():
+        if on_update:
+            on_update(rollouts)
+
+    updated()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda r: rollout_and_wait(r, timeout, updated), rollouts))
+
+    for result in rollouts:
+        if not result.ok:
+            log.error(
+                "Rollout of %s/%s failed: %s",
+                result.namespace,
+                result.deployment,
+                result.message,
+            )
+
+    return rollouts
@@ -0,0 +1,157 @@
+"""
+Inspect the layers of a Docker image without extracting it to disk.
+"""
+
+import io
+import json
+import heapq
+import tarfile
+from typing import IO
+
+from pydantic import BaseModel
+
+from .shell import stream
+
+# Blobs at least this big are streamed as layers rather than read as metadata.
+METADATA_MAX_SIZE = 1024 * 1024
+
+
+class LayerFile(BaseModel):
+    """A file added by a layer."""
+
+    path: str
+    size: int
+
+
+class Layer(BaseModel):
+    """Size information about a single image layer."""
+
+    digest: str
+    instruction: str
+    size: int = 0
+    files: int = 0
+    deleted: int = 0
+    largest: list[LayerFile] = []
+
+
+def image_layers(image: str, top: int = 5) -> list[Layer]:
+    """
+    Stream `docker save` for the image and summarize each of its layers.
+    """
+
+    with stream(f"docker save {image}", silent=True) as tarball:
+        return read_layers(tarball, top=top)
+
+
+def read_layers(tarball: IO[bytes], top: int = 5) -> list[Layer]:
+    """
+    Summarize the layers of an image archive as produced by `docker save`.
+    The archive is read as a stream, so it never needs to be seekable.
+    """
+
+    metadata: dict[str, object] = {}
+    layers: dict[str, Layer] = {}
+
+    with tarfile.open(fileobj=tarball, mode="r|") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+
+            blob = archive.extractfile(member)
+
+            # Small blobs are usually the manifest and config, but tiny layers
+            # are tarballs too.
+            if member.size < METADATA_MAX_SIZE:
+                data = blob.read()
+                try:
+                    metadata[member.name] = json.loads(data)
+                    continue
+                except ValueError:
+                    blob = io.BytesIO(data)
+
+            try:
+                layers[member.name] = _read_layer(member.name, blob, top)
+                layers[member.name].size = member.size
+            except tarfile.TarError:
+                continue
+
+    # Drain any trailing padding so the writer doesn't see a broken pipe.
+    while tarball.read(io.DEFAULT_BUFFER_SIZE):
+        pass
+
+    manifest = metadata["manifest.json"][0]
+    config = metadata.get(manifest["Config"], {})
+
+    # Every history entry that isn't an empty layer produced a layer, in order.
+    instructions = [
+        _clean_instruction(entry.get("created_by", ""))
+        for entry in config.get("history", [])
+        if not entry.get("empty_layer")
+    ]
+
+    result = []
+    for i, name in enumerate(manifest["Layers"]):
+        layer = layers.get(name, Layer(digest=name, instruction="")).model_copy()
+        layer.digest = _digest(name, config, i)
+        if i < len(instructions):
+            layer.instruction = instructions[i]
+        result.append(layer)
+
+    return result
+
+
+def _read_layer(name: str, blob: IO[bytes], top: int) -> Layer:
+    """Tally the files in a single layer tarball."""
+
+    layer = Layer(digest=name, instruction="")
+    largest: list[tuple[int, str]] = []
+
+    with tarfile.open(fileobj=blob, mode="r|*") as contents:
+        for entry in contents:
+            filename = entry.name.split("/")[-1]
+
+            if filename.startswith(".wh."):
+                layer.deleted += 1
+                continue
+
+            if not entry.isfile():
+                continue
+
+            layer.files += 1
+
+            if top:
+                item = (entry.size, "/" + entry.name.removeprefix("./"))
+                if len(largest) < top:
+                    heapq.heappush(largest, item)
+                else:
+                    heapq.heappushpop(largest, item)
+
+    layer.largest = [
+        LayerFile(path=path, size=size) for size, path in sorted(largest, reverse=True)
+    ]
+    return layer
+
+
+def _digest(name: str, config: dict, index: int) -> str:
+    """Find the content digest of a layer, preferring the config's diff ids."""
+
+    diff_ids = config.get("rootfs", {}).get("diff_ids", [])
+    if index < len(diff_ids):
+        return diff_ids[index]
+
+    return name
+
+
+def _clean_instruction(created_by: str) -> str:
+    """Turn a history entry back into something resembling the Dockerfile."""
+
+    instruction = created_by.strip()
+    instruction = instruction.removeprefix("/bin/sh -c #(nop)").strip()
+    instruction = instruction.removesuffix("# buildkit").strip()
+
+    # Classic builder runs have no prefix, BuildKit runs repeat the shell.
+    instruction = instruction.removeprefix("RUN ")
+    if instruction.startswith("/bin/sh -c "):
+        instruction = "RUN " + instruction.removeprefix("/bin/sh -c ")
+
+    return instruction
@@ -7,7 +7,7 @@ import sys
 import time
 import logging
 import hashlib
-from typing import List, Union
+from typing import Callable, List, Union
 from pathlib import Path
 from datetime import datetime, timedelta
 from contextlib import contextmanager
@@ -92,8 +92,15 @@ class BuildLogger(logging.LoggerAdapter):
         mtime: bool = False,
         hash: bool = False,
         hidden: bool = False,
+        include: Callable[[Path], bool] | None = None,
+        annotate: Callable[[Path], str | None] | None = None,
     ):
-        """Print the file tree starting at the given directory."""
+        """
+        Print the file tree starting at the given directory.
+
+        If given, only paths for which include returns True are printed, and
+        annotate can add a note to each printed path.
+        """
 
         root: Path = pwd if isinstance(pwd, Path) else Path(pwd)
         self.info("[tree] %s", root.resolve())
@@ -109,10 +116,15 @@ class BuildLogger(logging.LoggerAdapter):
                 if child.name.startswith(".") and not hidden:
                     continue
 
-                if child.name in [".git", "build", ".pytest_cache", "__pycache__"]:
+                if include is not None:
+                    if not include(child):
+                        continue
+                elif child.name in [".git", "build", ".pytest_cache", "__pycache__"]:
                     self.info("%s -- skipping contents for brevity", child.name)
                     continue
 
+                note = annotate(child) if annotate else None
+
                 if child.is_file():
                     if size:
                         sizestr = human_size(child.stat().st_size)
@@ -136,7 +148,7 @@ class BuildLogger(logging.LoggerAdapter):
                     else:
                         hashstr = None
 
-                    attrs = [sizestr, mtimestr, hashstr]
+                    attrs = [sizestr, mtimestr, hashstr, note]
 
                     if any(attrs):
                         suffix = " (" + ", ".join(filter(None, attrs)) + ")"
@@ -146,7 +158,7 @@ class BuildLogger(logging.LoggerAdapter):
                 elif child.is_symlink():
                     suffix = " -> " + str(child.resolve())
                 elif child.is_dir():
-                    suffix = "/"
+                    suffix = f"/ ({note})" if note else "/"
                 else:
                     suffix = " (?)"
 
@@ -1,47 +1,214 @@
-"""Common tools for interacting with AWS S3."""
+"""Common tools for interacting with AWS S3, or the local store configured in
+mads.build.storage."""
 
-import boto3
+import os
+import re
+import math
+import mmap
+import time
+import shutil
+import fnmatch
+import hashlib
+import itertools
+import mimetypes
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
-s3 = boto3.client("s3")
+from . import aws, storage
+from .logging import log, human_size
+
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
+
+
+# Multipart transfer defaults for large streams
+PART_SIZE = 64 * 1024**2
+CONCURRENCY = 8
+
+# delete_objects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+# How much disk the objects kept by fetch may use before the least recently
+# used are evicted
+FETCH_CACHE_SIZE = int(os.environ.get("MADS_S3_CACHE_SIZE", 10 * 1024**3))
+
+
+def client():
+    """The shared S3 client."""
+
+    return aws.client("s3")
 
 
 def __getattr__(name):
-    return getattr(s3, name)
+    if name == "s3":
+        return client()
+    return getattr(client(), name)
 
 
-def find_keys(
+def _list_pages(
     bucket: str,
     prefix: str = "",
-    contains: list[str] = [],
-) -> list[str]:
-    list_objects = s3.get_paginator("list_objects_v2")
-    paginator = list_objects.paginate(Bucket=bucket, Prefix=prefix)
+    delimiter: str | None = None,
+    start_after: str | None = None,
+) -> Iterator[dict]:
+    """Lazily page through list_objects_v2."""
+
+    yield from storage.backend().list_pages(bucket, prefix, delimiter, start_after)
+
+
+def iter_objects(
+    bucket: str,
+    prefix: str = "",
+    start_after: str | None = None,
+) -> Iterator[dict]:
+    """
+    Lazily yield the listing entry (Key, Size, LastModified and, from S3,
+    ETag) of every object.
+    """
+
+    for page in _list_pages(bucket, prefix, start_after=start_after):
+        yield from page.get("Contents", [])
+
+
+def _literal_prefix(glob: str) -> str:
+    """The part of a glob before its first wildcard."""
+
+    match = re.search(r"[*?\[]", glob)
+    return glob[: match.start()] if match else glob
 
-    results = []
+
+def _match_segments(parts: list[str], globs: list[str]) -> bool:
+    """Match path segments against glob segments, where ** spans any number."""
+
+    if not globs:
+        return not parts
+    if globs[0] == "**":
+        return any(_match_segments(parts[i:], globs[1:]) for i in range(len(parts) + 1))
+    return (
+        bool(parts)
+        and fnmatch.fnmatchcase(parts[0], globs[0])
+        and _match_segments(parts[1:], globs[1:])
+    )
+
+
+def _may_contain_matches(parts: list[str], globs: list[str]) -> bool:
+    """Could any key under these directory segments match the glob segments?"""
+
+    if not parts:
+        return True
+    if not globs:
+        return False
+    if globs[0] == "**":
+        return True
+    return fnmatch.fnmatchcase(parts[0], globs[0]) and _may_contain_matches(
+        parts[1:], globs[1:]
+    )
+
+
+def key_matcher(
+    contains: str | list[str] = [],
+    glob: str | None = None,
+    regex: str | None = None,
+    delimiter: str | None = None,
+) -> Callable[[str], bool]:
+    """
+    Build a test for keys that contain every term in contains and match the
+    glob and regex, if given. With a delimiter, wildcards in the glob don't
+    cross it (except **).
+    """
 
     if contains and not isinstance(contains, list):
         contains = [contains]
 
-    if contains:
-        queries = [f"contains(Key, '{term}')" for term in contains]
-        search = f"Contents[?{' && '.join(queries)}].Key"
-        results = paginator.search(search)
-    else:
-        results = [
-            entry.get("Key") for page in paginator for entry in page.get("Contents", [])
-        ]
+    globs = glob.split(delimiter) if glob and delimiter else None
+    pattern = re.compile(regex) if regex else None
+
+    def matches(key: str) -> bool:
+        if not all(term in key for term in contains):
+            return False
+        if globs is not None:
+            if not _match_segments(key.split(delimiter), globs):
+                return False
+        elif glob is not None and not fnmatch.fnmatchcase(key, glob):
+            return False
+        return pattern is None or pattern.search(key) is not None
+
+    return matches
+
+
+def iter_keys(
+    bucket: str,
+    prefix: str = "",
+    contains: str | list[str] = [],
+    glob: str | None = None,
+    regex: str | None = None,
+    delimiter: str | None = None,
+    start_after: str | None = None,
+    max_results: int | None = None,
+    cache: bool = False,
+) -> Iterator[str]:
+    """
+    Lazily yield the keys under a prefix that contain every term in contains
+    and match the glob and regex, if given. Keys are filtered one page at a
+    time, so listing stops as soon as max_results keys are found or the
+    caller stops iterating.
+
+    The glob is matched against the whole key, and its literal leading part
+    narrows the listing prefix. With a delimiter, wildcards in the glob don't
+    cross it (except **), and the listing walks the hierarchy one level at a
+    time, skipping any sub-prefix the glob can't match.
+
+    With cache, the keys are queried from a local index of the listing
+    instead. See mads.build.s3index.
+    """
+
+    if glob and _literal_prefix(glob).startswith(prefix):
+        prefix = _literal_prefix(glob)
+
+    if cache:
+        from . import s3index
+
+        keys = s3index.iter_keys(bucket, prefix, start_after, contains)
+        matches = key_matcher(contains, glob, regex, delimiter)
+        yield from itertools.islice(filter(matches, keys), max_results)
+        return
+
+    globs = glob.split(delimiter) if glob and delimiter else None
+    matches = key_matcher(contains, glob, regex, delimiter)
 
-    return list(results)
+    def walk(prefix: str) -> Iterator[str]:
+        for page in _list_pages(bucket, prefix, delimiter, start_after):
+            for entry in page.get("Contents", []):
+                if matches(entry["Key"]):
+                    yield entry["Key"]
+
+            for common in page.get("CommonPrefixes", []):
+                subprefix = common["Prefix"]
+                parts = subprefix.removesuffix(delimiter).split(delimiter)
+                if globs is None or _may_contain_matches(parts, globs):
+                    yield from walk(subprefix)
+
+    yield from itertools.islice(walk(prefix), max_results)
+
+
+def find_keys(
+    bucket: str,
+    prefix: str = "",
+    contains: list[str] = [],
+    **kwargs,
+) -> list[str]:
+    return list(iter_keys(bucket, prefix, contains, **kwargs))
 
 
 def find_key(
     bucket: str,
     prefix: str = "",
     contains: list[str] = [],
+    **kwargs,
 ) -> str | None:
-    for key in find_keys(bucket, prefix, contains):
-        return key
-    return None
+    kwargs["max_results"] = 1
+    return next(iter_keys(bucket, prefix, contains, **kwargs), None)
 
 
 def presign(
@@ -52,19 +219,511 @@ def presign(
     if isinstance(keys, str):
         keys = [keys]
 
-    return {
-        key: s3.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket, "Key": key},
-            ExpiresIn=expires_in,
+    return {key: storage.backend().presign(bucket, key, expires_in) for key in keys}
+
+
+def _byte_range(start: int | None = None, end: int | None = None) -> str | None:
+    """
+    Build an HTTP Range header. end is exclusive, like a slice, and a negative
+    start with no end counts back from the end of the object.
+    """
+
+    if start is None and end is None:
+        return None
+    if start is not None and start < 0:
+        assert end is None, "A range from the end of the object can't have an end"
+        return f"bytes={start}"
+    return f"bytes={start or 0}-{'' if end is None else end - 1}"
+
+
+def get_range(
+    bucket: str,
+    key: str,
+    start: int | None = None,
+    end: int | None = None,
+    **kwargs,
+) -> dict:
+    """Get an object, or a byte range of it, with a streaming Body."""
+
+    if byte_range := _byte_range(start, end):
+        kwargs["Range"] = byte_range
+    return storage.backend().get_object(bucket, key, **kwargs)
+
+
+def read_key(
+    bucket: str,
+    key: str,
+    encoding: str | None = "utf-8",
+    start: int | None = None,
+    end: int | None = None,
+) -> str | bytes:
+    """
+    Read an object, or just a byte range of it, into memory. With no encoding,
+    return the raw bytes. For large objects, iterate with iter_chunks or
+    iter_lines, or download them, instead.
+    """
+
+    data = get_range(bucket, key, start, end)["Body"].read()
+    return data.decode(encoding) if encoding else data
+
+
+def read_range(bucket: str, key: str, start: int, end: int | None = None) -> bytes:
+    """Read a slice of an object, e.g. read_range(b, k, -8) for a parquet footer."""
+
+    return read_key(bucket, key, encoding=None, start=start, end=end)
+
+
+def iter_chunks(
+    bucket: str,
+    key: str,
+    chunk_size: int = 1024**2,
+    start: int | None = None,
+    end: int | None = None,
+) -> Iterator[bytes]:
+    """Stream an object, or a byte range of it, in chunks."""
+
+    body = get_range(bucket, key, start, end)["Body"]
+    try:
+        yield from body.iter_chunks(chunk_size)
+    finally:
+        body.close()
+
+
+def iter_lines(
+    bucket: str,
+    key: str,
+    encoding: str = "utf-8",
+    chunk_size: int = 1024**2,
+) -> Iterator[str]:
+    """Stream the lines of a text object without reading it all into memory."""
+
+    body = get_range(bucket, key)["Body"]
+    try:
+        for line in body.iter_lines(chunk_size):
+            yield line.decode(encoding)
+    finally:
+        body.close()
+
+
+def download(
+    bucket: str,
+    key: str,
+    dest: str | Path | bytearray | memoryview | mmap.mmap,
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+):
+    """
+    Download an object with concurrent ranged requests, writing each part
+    straight to its place in a local file or a writable buffer (bytearray,
+    memoryview or mmap) at least as large as the object. Every part is
+    pinned to the same ETag so a concurrent overwrite can't mix versions.
+    """
+
+    info = head(bucket, key)
+    size = info["ContentLength"]
+    ranges = [(pos, min(pos + part_size, size)) for pos in range(0, size, part_size)]
+
+    if isinstance(dest, (str, Path)):
+        fd = os.open(dest, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, size)
+
+        def write(pos: int, data: bytes):
+            os.pwrite(fd, data, pos)
+
+    else:
+        fd = None
+        assert len(dest) >= size, f"The buffer is too small for {size} bytes"
+        view = memoryview(dest)
+
+        def write(pos: int, data: bytes):
+            view[pos : pos + len(data)] = data
+
+    def fetch(byte_range: tuple[int, int]):
+        start, end = byte_range
+        body = get_range(bucket, key, start, end, IfMatch=info["ETag"])["Body"]
+        pos = start
+        for chunk in body.iter_chunks(1024**2):
+            write(pos, chunk)
+            pos += len(chunk)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(fetch, ranges))
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def mmap_key(
+    bucket: str,
+    key: str,
+    path: str | Path,
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+) -> mmap.mmap:
+    """
+    Download an object into a memory-mapped file at path with concurrent ranged
+    requests and return the map.
+    """
+
+    size = head(bucket, key)["ContentLength"]
+
+    if size == 0:
+        raise ValueError(f"s3://{bucket}/{key} is empty and can't be memory-mapped")
+
+    with open(path, "w+b") as f:
+        f.truncate(size)
+        buffer = mmap.mmap(f.fileno(), size)
+
+    download(bucket, key, buffer, part_size, concurrency)
+    buffer.flush()
+    return buffer
+
+
+def head(bucket: str, key: str) -> dict:
+    return storage.backend().head_object(bucket, key)
+
+
+def parse_url(url: str) -> tuple[str, str]:
+    """Split an s3://bucket/key URL into its bucket and key."""
+
+    assert url.startswith("s3://"), f"Not an S3 URL: {url}"
+    bucket, _, key = url.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def exists(bucket: str, key: str) -> bool:
+    from botocore.exceptions import ClientError
+
+    try:
+        head(bucket, key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def delete_keys(bucket: str, keys: list[str]):
+    """Delete objects in as few requests as possible. Missing keys are ignored."""
+
+    for batch in range(0, len(keys), DELETE_BATCH_SIZE):
+        storage.backend().delete_objects(
+            bucket, keys[batch : batch + DELETE_BATCH_SIZE]
+        )
+
+
+def fetch(bucket: str, key: str, max_size: int | None = None) -> Path:
+    """
+    Return a local copy of an object, downloading it only if it has changed
+    since it was last fetched. The copy is revalidated with a conditional
+    request on its ETag, and the least recently used copies are evicted once
+    they take up more than max_size (FETCH_CACHE_SIZE) bytes.
+    """
+
+    from botocore.exceptions import ClientError
+    from mads.lib.cache import cache_dir
+
+    name = hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()[:32]
+    folder = cache_dir("s3objects", name)
+    path = folder.joinpath(Path(key).name or "object")
+    etag_path = folder.joinpath(".etag")
+
+    kwargs = {}
+    if path.exists() and etag_path.exists():
+        kwargs["IfNoneMatch"] = etag_path.read_text()
+
+    try:
+        response = get_range(bucket, key, **kwargs)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("304", "NotModified"):
+            raise
+        log.debug("s3://%s/%s hasn't changed", bucket, key)
+        path.touch()
+        return path
+
+    log.info(
+        "Fetching s3://%s/%s (%s)",
+        bucket,
+        key,
+        human_size(response["ContentLength"]),
+    )
+
+    # Write the object before its ETag, so a crash can only leave an ETag
+    # that's out of date, which just causes another download.
+    partial = folder.joinpath(f".{path.name}.{os.getpid()}")
+    with open(partial, "wb") as f:
+        for chunk in response["Body"].iter_chunks(1024**2):
+            f.write(chunk)
+    os.replace(partial, path)
+
+    partial.write_text(response["ETag"])
+    os.replace(partial, etag_path)
+
+    evict(FETCH_CACHE_SIZE if max_size is None else max_size, keep=path)
+    return path
+
+
+def evict(max_size: int, keep: Path | None = None):
+    """Remove the least recently fetched objects until they fit in max_size."""
+
+    from mads.lib.cache import cache_dir
+
+    files = [
+        (path.stat().st_mtime, path.stat().st_size, path)
+        for folder in cache_dir("s3objects").iterdir()
+        for path in folder.iterdir()
+        if path.is_file() and not path.name.startswith(".")
+    ]
+    total = sum(size for _, size, _ in files)
+
+    for _, size, path in sorted(files, key=lambda file: file[0]):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+
+        log.debug("Evicting %s from the S3 cache", path.name)
+        shutil.rmtree(path.parent, ignore_errors=True)
+        total -= size
+
+
+def transfer_config(
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+) -> "TransferConfig":
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=concurrency,
+    )
+
+
+def upload_stream(
+    stream: IO[bytes],
+    bucket: str,
+    key: str,
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+):
+    """
+    Upload from a readable stream, such as a pipe, using a concurrent multipart
+    upload. The stream doesn't need to be seekable or have a known length.
+    """
+
+    storage.backend().upload_stream(
+        stream, bucket, key, transfer_config(part_size, concurrency)
+    )
+
+
+def download_stream(
+    bucket: str,
+    key: str,
+    stream: IO[bytes],
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+):
+    """
+    Download into a writable stream, such as a pipe, fetching parts
+    concurrently and writing them out in order.
+    """
+
+    storage.backend().download_stream(
+        bucket, key, stream, transfer_config(part_size, concurrency)
+    )
+
+
+def local_etag(path: Path, part_size: int = PART_SIZE, parts: int = 1) -> str:
+    """
+    Compute the ETag S3 would give a file uploaded in the given number of
+    parts: the MD5 of the file, or the MD5 of the part MD5s for multipart.
+    """
+
+    if parts <= 1:
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            while chunk := f.read(PART_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    digests = b""
+    with open(path, "rb") as f:
+        while chunk := f.read(part_size):
+            digests += hashlib.md5(chunk).digest()
+    return f"{hashlib.md5(digests).hexdigest()}-{parts}"
+
+
+def _same_etag(path: Path, size: int, etag: str, part_size: int) -> bool:
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return local_etag(path) == etag
+
+    # We can't know the part size of someone else's upload, but it's
+    # usually ours or a whole number of megabytes.
+    parts = int(etag.split("-")[1])
+    if math.ceil(size / part_size) != parts:
+        part_size = math.ceil(size / parts / 1024**2) * 1024**2
+    return local_etag(path, part_size, parts) == etag
+
+
+def _needs_transfer(
+    local: os.stat_result | None,
+    remote: dict | None,
+    bucket: str,
+    path: Path,
+    upload: bool,
+    check: str,
+    part_size: int,
+) -> bool:
+    """Decide whether a file differs between the local and remote sides."""
+
+    if local is None or remote is None:
+        return True
+    if local.st_size != remote["Size"]:
+        return True
+    if check == "size":
+        return False
+    if check == "etag":
+        # Local storage leaves ETags out of listings, since they cost a read
+        etag = remote.get("ETag") or head(bucket, remote["Key"])["ETag"]
+        return not _same_etag(path, local.st_size, etag, part_size)
+
+    # Otherwise, transfer whichever side is newer.
+    remote_mtime = remote["LastModified"].timestamp()
+    if upload:
+        return local.st_mtime > remote_mtime
+    return int(remote_mtime) > int(local.st_mtime)
+
+
+def sync(
+    source: str,
+    dest: str,
+    delete: bool = False,
+    check: str = "mtime",
+    part_size: int = PART_SIZE,
+    concurrency: int = CONCURRENCY,
+    dry_run: bool = False,
+) -> dict:
+    """
+    Sync a local directory to an s3:// prefix, or the other way around. Files
+    are skipped when their size matches and, depending on check, the source
+    isn't newer ("mtime") or the ETags match ("etag"). With delete, files that
+    aren't in the source are removed from the destination. All transfers
+    share one pool of concurrent multipart transfers.
+
+    Returns a summary of what was transferred.
+    """
+
+    assert check in ("size", "mtime", "etag"), f"Unknown check {check!r}"
+
+    upload = dest.startswith("s3://")
+    assert upload != source.startswith("s3://"), "Sync between a directory and S3"
+
+    bucket, prefix = parse_url(dest if upload else source)
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    root = Path(source if upload else dest)
+
+    log.start("Syncing %s to %s", source, dest)
+
+    # List both sides, keyed by path relative to the root
+    remote = {
+        entry["Key"].removeprefix(prefix): entry
+        for entry in iter_objects(bucket, prefix)
+        if not entry["Key"].endswith("/")
+    }
+    local = {
+        path.relative_to(root).as_posix(): path.stat()
+        for path in (root.rglob("*") if root.exists() else [])
+        if path.is_file()
+    }
+
+    sources, targets = (local, remote) if upload else (remote, local)
+    transfers = [
+        name
+        for name in sorted(sources)
+        if _needs_transfer(
+            local.get(name),
+            remote.get(name),
+            bucket,
+            root.joinpath(name),
+            upload,
+            check,
+            part_size,
         )
-        for key in keys
+    ]
+    deletions = sorted(set(targets) - set(sources)) if delete else []
+
+    summary = {
+        "source": source,
+        "dest": dest,
+        "transferred": len(transfers),
+        "skipped": len(sources) - len(transfers),
+        "deleted": len(deletions),
+        "bytes": sum(
+            local[name].st_size if upload else remote[name]["Size"]
+            for name in transfers
+        ),
     }
 
+    start = time.time()
 
-def read_key(bucket: str, key: str) -> str:
-    return s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode()
+    if dry_run:
+        for name in transfers:
+            log.info("Would transfer %s", name)
+        for name in deletions:
+            log.info("Would delete %s", name)
+    else:
+        config = transfer_config(part_size, concurrency)
+        with storage.backend().transfers(config) as manager:
+            futures = {}
+            for name in transfers:
+                path = root.joinpath(name)
+                if upload:
+                    content_type = mimetypes.guess_type(name)[0]
+                    futures[name] = manager.upload(
+                        str(path),
+                        bucket,
+                        prefix + name,
+                        extra_args=(
+                            {"ContentType": content_type} if content_type else None
+                        ),
+                    )
+                else:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    futures[name] = manager.download(bucket, prefix + name, str(path))
 
+            for name, future in futures.items():
+                future.result()
+                log.info("%s %s", "Uploaded" if upload else "Downloaded", name)
 
-def head(bucket: str, key: str) -> dict:
-    return s3.head_object(Bucket=bucket, Key=key)
+                # Match the remote timestamp so the next sync can skip it
+                if not upload:
+                    mtime = remote[name]["LastModified"].timestamp()
+                    os.utime(root.joinpath(name), (mtime, mtime))
+
+        if upload:
+            delete_keys(bucket, [prefix + name for name in deletions])
+        else:
+            for name in deletions:
+                root.joinpath(name).unlink()
+
+        for name in deletions:
+            log.info("Deleted %s", name)
+
+    seconds = time.time() - start
+    summary["seconds"] = round(seconds, 3)
+    summary["throughput"] = round(summary["bytes"] / seconds) if seconds else 0
+
+    log.end(
+        "Transferred %s files (%s) at %s/s, skipped %s, deleted %s",
+        summary["transferred"],
+        human_size(summary["bytes"]),
+        human_size(summary["throughput"]),
+        summary["skipped"],
+        summary["deleted"],
+    )
+
+    return summary
@@ -0,0 +1,159 @@
+"""
+A local SQLite index of S3 listings, so that repeated key queries against the
+same prefix run locally instead of listing the bucket again.
+
+S3 can't list only the objects modified since a given time, so the index is
+brought up to date by listing from the last key it knows (StartAfter). That
+picks up new keys that sort after the existing ones, which is how timestamped
+and sequential keys grow. Anything else, like overwritten or deleted keys, is
+picked up by a full listing once the index is FULL_REFRESH_TTL seconds old.
+"""
+
+import os
+import time
+import sqlite3
+from typing import Iterator
+
+from mads.lib.cache import cache_dir
+from . import s3
+from .logging import log
+
+# Seconds before checking for new keys, and before listing everything again
+REFRESH_TTL = int(os.environ.get("MADS_S3_INDEX_TTL", 5 * 60))
+FULL_REFRESH_TTL = int(os.environ.get("MADS_S3_INDEX_FULL_TTL", 24 * 60 * 60))
+
+# Sorts after every other key, to turn a prefix into a key range
+MAX_CHAR = "\U0010ffff"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER,
+    etag TEXT,
+    last_modified REAL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS listings (
+    prefix TEXT PRIMARY KEY,
+    last_key TEXT,
+    refreshed_at REAL,
+    listed_at REAL
+);
+"""
+
+
+def connect(bucket: str) -> sqlite3.Connection:
+    """Open the index for a bucket."""
+
+    db = sqlite3.connect(cache_dir("s3index").joinpath(f"{bucket}.sqlite"))
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def _store(db: sqlite3.Connection, entries: Iterator[dict]) -> str | None:
+    """Insert listing entries and return the last key."""
+
+    last_key = None
+    batch = []
+
+    for entry in entries:
+        last_key = entry["Key"]
+        batch.append(
+            (
+                entry["Key"],
+                entry.get("Size"),
+                entry.get("ETag"),
+                entry["LastModified"].timestamp() if "LastModified" in entry else None,
+            )
+        )
+        if len(batch) >= 1000:
+            db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", batch)
+            batch = []
+
+    db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", batch)
+    return last_key
+
+
+def refresh(
+    bucket: str,
+    prefix: str = "",
+    ttl: int | None = None,
+    full_ttl: int | None = None,
+):
+    """Bring the index of a prefix up to date, if it's older than the ttl."""
+
+    ttl = REFRESH_TTL if ttl is None else ttl
+    full_ttl = FULL_REFRESH_TTL if full_ttl is None else full_ttl
+    now = time.time()
+
+    with connect(bucket) as db:
+        # An index of a shorter prefix covers this one too
+        covering = db.execute(
+            "SELECT prefix, last_key, refreshed_at, listed_at FROM listings"
+            " WHERE substr(?, 1, length(prefix)) = prefix"
+            " ORDER BY length(prefix) DESC LIMIT 1",
+            (prefix,),
+        ).fetchone()
+
+        if covering and now - covering[2] < ttl:
+            return
+
+        if covering and now - covering[3] < full_ttl:
+            listed, last_key, _, listed_at = covering
+            log.debug("Updating the index of s3://%s/%s", bucket, listed)
+            entries = s3.iter_objects(bucket, listed, start_after=last_key)
+            last_key = _store(db, entries) or last_key
+        else:
+            listed, listed_at = prefix, now
+            log.debug("Indexing s3://%s/%s", bucket, listed)
+            db.execute(
+                "DELETE FROM objects WHERE key >= ? AND key < ?",
+                (listed, listed + MAX_CHAR),
+            )
+            last_key = _store(db, s3.iter_objects(bucket, listed))
+
+        db.execute(
+            "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+            (listed, last_key, now, listed_at),
+        )
+
+
+def invalidate(bucket: str, prefix: str = ""):
+    """Forget the index of everything under a prefix."""
+
+    with connect(bucket) as db:
+        db.execute(
+            "DELETE FROM listings WHERE prefix >= ? AND prefix < ?",
+            (prefix, prefix + MAX_CHAR),
+        )
+
+
+def iter_keys(
+    bucket: str,
+    prefix: str = "",
+    start_after: str | None = None,
+    contains: str | list[str] = [],
+) -> Iterator[str]:
+    """
+    Yield the indexed keys under a prefix, in order, that contain every term
+    in contains. The index is refreshed first if it's out of date.
+    """
+
+    if contains and not isinstance(contains, list):
+        contains = [contains]
+
+    refresh(bucket, prefix)
+
+    query = "SELECT key FROM objects WHERE key >= ? AND key < ? AND key > ?"
+    params = [prefix, prefix + MAX_CHAR, start_after or ""]
+    for term in contains:
+        query += " AND instr(key, ?) > 0"
+        params.append(term)
+
+    db = connect(bucket)
+    try:
+        for (key,) in db.execute(query + " ORDER BY key", params):
+            yield key
+    finally:
+        db.close()
@@ -0,0 +1,158 @@
+"""
+Look up Secrets Manager secrets, caching them for the rest of a CI build.
+
+Every mads command in a build runs in its own process, so secrets are cached
+on disk as well as in memory. The files are encrypted with a key derived from
+the build's run id and a random salt only this user can read, and expire
+after MADS_SECRET_TTL seconds.
+"""
+
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from mads.environ import Runner
+from mads.lib.cache import cache_dir
+from . import aws
+from .logging import log
+
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
+
+# How long, in seconds, a secret is used before it's looked up again
+SECRET_TTL = int(os.environ.get("MADS_SECRET_TTL", 15 * 60))
+
+_lock = threading.Lock()
+_secrets: dict[str, tuple[float, str | bytes]] = {}
+
+
+def _write_private(path: Path, data: bytes):
+    """Write a file only this user can read, replacing it atomically."""
+
+    partial = path.with_name(f".{path.name}.{os.getpid()}")
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def _fernet(run: str) -> "Fernet":
+    """The cipher for a build's secrets."""
+
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    salt_file = cache_dir("secrets").joinpath(".salt")
+    if not salt_file.exists():
+        # Link rather than rename, so a concurrent process can't replace it
+        partial = salt_file.with_name(f".salt.{os.getpid()}")
+        _write_private(partial, os.urandom(32))
+        try:
+            os.link(partial, salt_file)
+        except FileExistsError:
+            pass
+        partial.unlink()
+
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt_file.read_bytes(),
+        info=f"mads-secrets:{run}".encode("utf-8"),
+    ).derive(b"mads")
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def _secret_file(secret_id: str) -> tuple[Path, str] | None:
+    """Where a secret is cached for this build, and the build's run, if any."""
+
+    runner = Runner.current()
+    if runner.name == "local":
+        return None
+
+    run = f"{runner.name}:{runner.run_id}"
+    name = hashlib.sha256(f"{run}:{secret_id}".encode("utf-8")).hexdigest()
+    return cache_dir("secrets").joinpath(name[:32]), run
+
+
+def _read_cached(secret_id: str, ttl: int) -> str | bytes | None:
+    """Find a secret cached within the ttl, in memory or on disk."""
+
+    from cryptography.fernet import InvalidToken
+
+    if secret_id in _secrets:
+        fetched_at, value = _secrets[secret_id]
+        if time.time() - fetched_at < ttl:
+            return value
+
+    location = _secret_file(secret_id)
+    if location is None or not location[0].exists():
+        return None
+
+    path, run = location
+    try:
+        data = _fernet(run).decrypt_at_time(path.read_bytes(), ttl, int(time.time()))
+    except InvalidToken:
+        path.unlink(missing_ok=True)
+        return None
+
+    entry = json.loads(data)
+    value = entry["string"] if "string" in entry else base64.b64decode(entry["binary"])
+    _secrets[secret_id] = (entry["fetched_at"], value)
+    return value
+
+
+def _prune(ttl: int):
+    """Remove cached secrets from earlier builds."""
+
+    for path in cache_dir("secrets").iterdir():
+        if not path.name.startswith(".") and time.time() - path.stat().st_mtime > ttl:
+            path.unlink(missing_ok=True)
+
+
+def get_secret(secret_id: str, ttl: int | None = None) -> str | bytes:
+    """
+    Return the current value of a secret, as a string or, for binary secrets,
+    bytes. Values are reused for ttl seconds, by default MADS_SECRET_TTL.
+    """
+
+    ttl = SECRET_TTL if ttl is None else ttl
+
+    with _lock:
+        if (value := _read_cached(secret_id, ttl)) is not None:
+            return value
+
+        log.debug("Fetching secret %s", secret_id)
+        response = aws.client("secretsmanager").get_secret_value(SecretId=secret_id)
+        now = int(time.time())
+
+        if "SecretString" in response:
+            value = response["SecretString"]
+            entry = {"fetched_at": now, "string": value}
+        else:
+            value = response["SecretBinary"]
+            entry = {"fetched_at": now, "binary": base64.b64encode(value).decode()}
+
+        _secrets[secret_id] = (now, value)
+
+        if location := _secret_file(secret_id):
+            path, run = location
+            token = _fernet(run).encrypt_at_time(json.dumps(entry).encode(), now)
+            _write_private(path, token)
+            _prune(ttl)
+
+        return value
+
+
+def invalidate(secret_id: str):
+    """Forget a cached secret, e.g. after it's rotated."""
+
+    with _lock:
+        _secrets.pop(secret_id, None)
+        if location := _secret_file(secret_id):
+            location[0].unlink(missing_ok=True)
@@ -8,8 +8,11 @@ import os
 import time
 import shlex
 import select
+import tempfile
 import subprocess
+from typing import IO, Iterator
 from pathlib import Path
+from contextlib import contextmanager
 
 from . import log
 from .logging import LSS_END
@@ -60,6 +63,67 @@ def proc(cmd: str, silent: bool = True, **kwargs) -> subprocess.CompletedProcess
     return res
 
 
+@contextmanager
+def stream(cmd: str, mode: str = "r", silent: bool = False) -> Iterator[IO[bytes]]:
+    """
+    Run a command and yield a binary pipe to its stdout (mode "r") or its
+    stdin (mode "w"), so large outputs never have to be held in memory.
+    """
+
+    assert mode in ("r", "w"), f"Unknown stream mode {mode!r}"
+
+    if not silent:
+        log.info("[shell] %s", cmd)
+        log.indent()
+
+    start = time.time()
+
+    try:
+        with tempfile.TemporaryFile() as output:
+            process = subprocess.Popen(
+                ["bash", "-o", "pipefail", "-c", cmd],
+                stdin=subprocess.PIPE if mode == "w" else subprocess.DEVNULL,
+                stdout=subprocess.PIPE if mode == "r" else output,
+                stderr=output,
+            )
+            pipe = process.stdout if mode == "r" else process.stdin
+
+            try:
+                yield pipe
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                pipe.close()
+
+            process.wait()
+            delta = time.time() - start
+
+            output.seek(0)
+            text = output.read().decode("utf-8", errors="replace")
+
+        if not silent:
+            for line in text.splitlines():
+                log.info("* %s", line.rstrip())
+    finally:
+        # Close out the logging indent, even if the body raised
+        if not silent:
+            log.outdent()
+
+    if not silent:
+        log.info(
+            "%s Completed with code %s after %0.2f seconds",
+            LSS_END,
+            process.returncode,
+            delta,
+        )
+        log.info("")
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=text)
+
+
 def _stream_process(cmd: str, silent: bool, **kwargs):
 
     kwargs.setdefault("encoding", "utf-8")
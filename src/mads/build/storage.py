@@ -0,0 +1,390 @@
+"""
+The object stores behind mads.build.s3. S3 is the default; setting
+$MADS_STORAGE_URL to a directory (or a file:// URL) keeps buckets as
+subdirectories of it instead, for runners without AWS access or to measure
+the I/O paths against a local or NFS disk.
+
+Backends speak in S3's terms (buckets, keys, listing pages, ETags) and raise
+botocore's ClientError with S3's error codes, so callers don't need to know
+which one they're using.
+"""
+
+import io
+import os
+import shutil
+import hashlib
+import threading
+import mimetypes
+from abc import ABC, abstractmethod
+from pathlib import Path, PurePosixPath
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import IO, ContextManager, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from . import aws
+
+# A directory to keep buckets in instead of S3
+STORAGE_URL = os.environ.get("MADS_STORAGE_URL")
+
+# Keys per page in local listings, like S3
+PAGE_SIZE = 1000
+
+_lock = threading.Lock()
+_backend = None
+
+
+class Storage(ABC):
+    """The operations mads.build.s3 needs from an object store."""
+
+    @abstractmethod
+    def list_pages(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str | None = None,
+        start_after: str | None = None,
+    ) -> Iterator[dict]:
+        """
+        Lazily yield pages of Contents and CommonPrefixes, in key order.
+        Entries may leave out the ETag if it's costly to compute.
+        """
+
+    @abstractmethod
+    def get_object(self, bucket: str, key: str, **kwargs) -> dict:
+        """Get an object with a streaming Body. Accepts Range, IfMatch and IfNoneMatch."""
+
+    @abstractmethod
+    def head_object(self, bucket: str, key: str) -> dict:
+        """Get an object's size, ETag, modification time and content type."""
+
+    @abstractmethod
+    def presign(self, bucket: str, key: str, expires_in: int) -> str:
+        """A URL the object can be downloaded from without credentials."""
+
+    @abstractmethod
+    def upload_stream(self, stream: IO[bytes], bucket: str, key: str, config=None):
+        """Write an object from a readable stream."""
+
+    @abstractmethod
+    def download_stream(self, bucket: str, key: str, stream: IO[bytes], config=None):
+        """Write an object into a writable stream."""
+
+    @abstractmethod
+    def delete_objects(self, bucket: str, keys: list[str]):
+        """Delete a batch of objects."""
+
+    @abstractmethod
+    def transfers(self, config=None) -> ContextManager:
+        """
+        Return a context manager yielding a manager for a batch of file
+        transfers, whose upload(path, bucket, key, extra_args) and
+        download(bucket, key, path) methods return futures. Transfers run
+        concurrently and are finished on exit.
+        """
+
+
+class S3Storage(Storage):
+    """Amazon S3, through the shared client."""
+
+    def client(self):
+        return aws.client("s3")
+
+    def list_pages(self, bucket, prefix="", delimiter=None, start_after=None):
+        params = {"Bucket": bucket, "Prefix": prefix}
+        if delimiter:
+            params["Delimiter"] = delimiter
+        if start_after:
+            params["StartAfter"] = start_after
+
+        yield from self.client().get_paginator("list_objects_v2").paginate(**params)
+
+    def get_object(self, bucket, key, **kwargs):
+        return self.client().get_object(Bucket=bucket, Key=key, **kwargs)
+
+    def head_object(self, bucket, key):
+        return self.client().head_object(Bucket=bucket, Key=key)
+
+    def presign(self, bucket, key, expires_in):
+        return self.client().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key},
+            ExpiresIn=expires_in,
+        )
+
+    def upload_stream(self, stream, bucket, key, config=None):
+        self.client().upload_fileobj(stream, bucket, key, Config=config)
+
+    def download_stream(self, bucket, key, stream, config=None):
+        self.client().download_fileobj(bucket, key, stream, Config=config)
+
+    def delete_objects(self, bucket, keys):
+        self.client().delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys]},
+        )
+
+    @contextmanager
+    def transfers(self, config=None):
+        from boto3.s3.transfer import create_transfer_manager
+
+        with create_transfer_manager(self.client(), config) as manager:
+            yield manager
+
+
+class LocalStorage(Storage):
+    """Buckets kept as directories under a root, with keys as file paths."""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root).expanduser()
+
+    def __repr__(self) -> str:
+        return f"LocalStorage({self.root})"
+
+    def path(self, bucket: str, key: str) -> Path:
+        """Where an object is kept. Keys can't reach outside their bucket."""
+
+        if (
+            not bucket
+            or "/" in bucket
+            or bucket in (".", "..")
+            or key.startswith("/")
+            or ".." in PurePosixPath(key).parts
+        ):
+            raise _error("LocalStorage", "InvalidKey", 400, f"Invalid key {key!r}")
+
+        folder = self.root.joinpath(bucket)
+        path = folder.joinpath(key)
+        if not path.resolve().is_relative_to(folder.resolve()):
+            raise _error("LocalStorage", "InvalidKey", 400, f"{key!r} leaves {bucket}")
+
+        return path
+
+    def _walk(self, folder: Path, key_prefix: str) -> Iterator[str]:
+        """Yield the keys under a folder in S3's order, which sorts / as a character."""
+
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            return
+
+        entries.sort(key=lambda entry: entry.name + ("/" if entry.is_dir() else ""))
+        for entry in entries:
+            if entry.is_dir():
+                yield from self._walk(Path(entry.path), key_prefix + entry.name + "/")
+            elif entry.is_file() and not entry.name.startswith(".mads-partial"):
+                yield key_prefix + entry.name
+
+    def _entry(self, bucket: str, key: str) -> dict:
+        """A listing entry. Its ETag is left out, since it means reading the file."""
+
+        # Keys found by walking the bucket don't need checking
+        stat = self.root.joinpath(bucket, key).stat()
+        return {
+            "Key": key,
+            "Size": stat.st_size,
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+    def list_pages(self, bucket, prefix="", delimiter=None, start_after=None):
+        folder = prefix.rpartition("/")[0]
+        keys = self._walk(self.path(bucket, folder), folder + "/" if folder else "")
+
+        page = {"Contents": [], "CommonPrefixes": []}
+        last_common = None
+        for key in keys:
+            if not key.startswith(prefix) or (start_after and key <= start_after):
+                continue
+
+            rest = key[len(prefix) :]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter)[0] + delimiter
+                if common == last_common:
+                    continue
+                page["CommonPrefixes"].append({"Prefix": common})
+                last_common = common
+            else:
+                page["Contents"].append(self._entry(bucket, key))
+
+            if len(page["Contents"]) + len(page["CommonPrefixes"]) >= PAGE_SIZE:
+                yield {**page, "IsTruncated": True}
+                page = {"Contents": [], "CommonPrefixes": []}
+
+        yield {**page, "IsTruncated": False}
+
+    def head_object(self, bucket, key):
+        path = self.path(bucket, key)
+        if not path.is_file():
+            raise _error("HeadObject", "404", 404, f"{bucket}/{key} not found")
+
+        stat = path.stat()
+        return {
+            "ContentLength": stat.st_size,
+            "ETag": _etag(path, stat.st_size, stat.st_mtime_ns),
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            "ContentType": mimetypes.guess_type(key)[0] or "binary/octet-stream",
+        }
+
+    def get_object(self, bucket, key, Range=None, IfMatch=None, IfNoneMatch=None):
+        from botocore.response import StreamingBody
+
+        path = self.path(bucket, key)
+        if not path.is_file():
+            raise _error("GetObject", "NoSuchKey", 404, f"{bucket}/{key} not found")
+
+        info = self.head_object(bucket, key)
+        size = info["ContentLength"]
+
+        if IfMatch and IfMatch != info["ETag"]:
+            raise _error("GetObject", "PreconditionFailed", 412, "ETag changed")
+        if IfNoneMatch and IfNoneMatch == info["ETag"]:
+            raise _error("GetObject", "304", 304, "Not Modified")
+
+        start, end = 0, size
+        if Range:
+            first, _, last = Range.removeprefix("bytes=").partition("-")
+            if not first:
+                start = max(size - int(last), 0)
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+
+        f = open(path, "rb")
+        f.seek(start)
+        length = max(end - start, 0)
+        body = io.BufferedReader(_Slice(f, length))
+
+        return {**info, "ContentLength": length, "Body": StreamingBody(body, length)}
+
+    def presign(self, bucket, key, expires_in):
+        return self.path(bucket, key).absolute().as_uri()
+
+    def upload_stream(self, stream, bucket, key, config=None):
+        path = self.path(bucket, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write beside the target and rename, so readers never see half a file
+        partial = path.with_name(f".mads-partial.{path.name}.{threading.get_ident()}")
+        with open(partial, "wb") as f:
+            shutil.copyfileobj(stream, f, 1024**2)
+        os.replace(partial, path)
+
+    def download_stream(self, bucket, key, stream, config=None):
+        body = self.get_object(bucket, key)["Body"]
+        try:
+            shutil.copyfileobj(body, stream, 1024**2)
+        finally:
+            body.close()
+
+    def delete_objects(self, bucket, keys):
+        for key in keys:
+            path = self.path(bucket, key)
+            path.unlink(missing_ok=True)
+
+            # Like S3, prefixes only exist while they have keys under them
+            for parent in path.parents:
+                if parent == self.root.joinpath(bucket):
+                    break
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+
+    @contextmanager
+    def transfers(self, config=None):
+        workers = config.max_request_concurrency if config else None
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            yield _LocalTransfers(self, pool)
+
+
+class _LocalTransfers:
+    """Concurrent file copies in and out of local storage."""
+
+    def __init__(self, storage: LocalStorage, pool: ThreadPoolExecutor):
+        self.storage = storage
+        self.pool = pool
+
+    def upload(self, path: str, bucket: str, key: str, extra_args=None):
+        return self.pool.submit(self._upload, path, bucket, key)
+
+    def download(self, bucket: str, key: str, path: str):
+        return self.pool.submit(self._download, bucket, key, path)
+
+    def _upload(self, path: str, bucket: str, key: str):
+        with open(path, "rb") as f:
+            self.storage.upload_stream(f, bucket, key)
+
+    def _download(self, bucket: str, key: str, path: str):
+        with open(path, "wb") as f:
+            self.storage.download_stream(bucket, key, f)
+
+
+class _Slice(io.RawIOBase):
+    """Read at most length bytes from a file, then close it."""
+
+    def __init__(self, f: IO[bytes], length: int):
+        self.f = f
+        self.remaining = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self.remaining)
+        data = self.f.read(size) if size else b""
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+@lru_cache(maxsize=4096)
+def _etag(path: Path, size: int, mtime_ns: int) -> str:
+    """The ETag S3 gives a single part upload: the quoted MD5 of the contents."""
+
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024**2):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
+
+
+def _error(operation: str, code: str, status: int, message: str):
+    from botocore.exceptions import ClientError
+
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        operation,
+    )
+
+
+def backend() -> Storage:
+    """The storage backend selected by $MADS_STORAGE_URL, S3 by default."""
+
+    global _backend
+
+    with _lock:
+        if _backend is None:
+            if STORAGE_URL and STORAGE_URL != "s3":
+                _backend = LocalStorage(STORAGE_URL.removeprefix("file://"))
+            else:
+                _backend = S3Storage()
+
+    return _backend
+
+
+def configure(url: str | None):
+    """Switch to the backend for a URL, or S3 for None."""
+
+    global STORAGE_URL, _backend
+
+    with _lock:
+        STORAGE_URL = url
+        _backend = None
@@ -3,20 +3,26 @@ All the commands that ship with MADS CLI
 """
 
 from . import (
+    cache,
     docker,
+    email,
     environ,
     github,
     kube,
+    s3,
     setup,
     tag,
     yq,
 )
 
 __all__ = [
+    "cache",
     "docker",
+    "email",
     "environ",
     "github",
     "kube",
+    "s3",
     "setup",
     "tag",
     "yq",
@@ -0,0 +1,40 @@
+"""Save and restore build caches in S3"""
+
+import argparse
+from typing import Annotated
+from mads.cli.command import Argspec, command, set_output
+
+
+def register_subcommand(parser: argparse.ArgumentParser):
+    """Register the cache command"""
+
+    cachecmd = parser.add_subparsers(title="Cache commands", help="Available commands")
+
+    @command(cachecmd)
+    def save(key: str, url: str | None = None, *paths: str):
+        """Save paths to the cache under a key like pip-{hash:requirements.txt}"""
+
+        from mads.build import cache
+
+        saved = cache.save(key, list(paths), url=url)
+        set_output(cache_saved=str(saved).lower())
+
+    @command(cachecmd)
+    def restore(
+        key: str,
+        fallback_prefix: Annotated[
+            list[str] | None,
+            Argspec(type=str, action="append", name="fallback-prefix"),
+        ] = None,
+        url: str | None = None,
+    ):
+        """Restore the cache for a key, or the newest under a fallback prefix"""
+
+        from mads.build import cache
+
+        restored = cache.restore(key, fallback_prefix or [], url=url)
+        set_output(
+            cache_hit=str(restored is not None).lower(), cache_key=restored or ""
+        )
+        if restored:
+            print(restored)
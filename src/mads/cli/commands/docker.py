@@ -34,6 +34,15 @@ def register_subcommand(parser: argparse.ArgumentParser):
 
         docker.try_pull(image_name, tag)
 
+    @command(dockercmd)
+    def push(image_name: str, tag: str):
+        """Push a docker image and forget the cached tags of its repository"""
+
+        from mads.build import docker
+
+        if not docker.push(image_name, tag):
+            die(f"Unable to push {image_name}:{tag}")
+
     @command(dockercmd)
     def pull_first(image_name: str, *tags: str):
         """Pull the first available image from the list"""
@@ -52,3 +61,213 @@ def register_subcommand(parser: argparse.ArgumentParser):
 
         tag = docker.determine_tag(use_branch=use_branch, default=default)
         print(tag)
+
+    @command(dockercmd)
+    def reuse(
+        image_name: str,
+        context: str = ".",
+        dockerfile: str | None = None,
+        tag: str | None = None,
+        *build_args: str,
+    ):
+        """Skip the build by retagging an image built from the same inputs"""
+
+        from mads.build import docker
+
+        args = dict(arg.split("=", 1) for arg in build_args)
+        content_tag = docker.content_tag(context, dockerfile, args)
+        tag = tag or docker.determine_tag()
+
+        reused = docker.reuse(image_name, content_tag, tag)
+        set_output(content_tag=content_tag, reused=str(reused).lower())
+        print(content_tag)
+
+    @command(dockercmd)
+    def layers(image: str, top: int = 5, json: bool = False):
+        """Report the size of each layer in an image and what it adds"""
+
+        from mads.build.layers import image_layers
+        from mads.build.logging import human_size
+
+        result = image_layers(image, top=top)
+
+        if json:
+            import json as jsonlib
+
+            print(jsonlib.dumps([layer.model_dump() for layer in result], indent=2))
+            return
+
+        from rich.table import Table
+        from rich.console import Console
+
+        table = Table(title=image, show_lines=True)
+        table.add_column("Size", justify="right", no_wrap=True)
+        table.add_column("Files", justify="right")
+        table.add_column("Instruction", overflow="fold")
+        table.add_column("Largest files", overflow="fold")
+
+        for layer in result:
+            table.add_row(
+                human_size(layer.size),
+                str(layer.files),
+                layer.instruction,
+                "\n".join(f"{human_size(f.size)}  {f.path}" for f in layer.largest),
+            )
+
+        total = sum(layer.size for layer in result)
+        table.caption = f"{len(result)} layers, {human_size(total)} uncompressed"
+
+        Console().print(table)
+
+    @command(dockercmd)
+    def prune(
+        free_gb: float | None = None,
+        image: str | None = None,
+        dry_run: bool = False,
+        *protect: str,
+    ):
+        """
+        Free disk space by evicting the least recently used images and cache,
+        except those tagged with a protected repo:tag or, given --image, the
+        current build's tags of it
+        """
+
+        from mads.build import docker
+        from mads.build.logging import human_size
+
+        reclaimed = docker.prune(
+            free_gb=float(free_gb) if free_gb else None,
+            protect=list(protect),
+            image_name=image,
+            dry_run=dry_run,
+        )
+        set_output(reclaimed=reclaimed)
+        if dry_run:
+            print(f"Would reclaim about {human_size(reclaimed)}")
+        else:
+            print(f"Reclaimed {human_size(reclaimed)}")
+
+    @command(dockercmd)
+    def context(
+        path: str = ".",
+        dockerfile: str | None = None,
+        min_size_mb: float = 10,
+        pack: str | None = None,
+    ):
+        """Report what the Dockerfile uses from its build context"""
+
+        from mads.build import context as ctx
+        from mads.build.logging import human_size
+
+        report = ctx.log_report(path, dockerfile, min_size=int(min_size_mb * 1024**2))
+
+        if pack:
+            ctx.pack(pack, path, dockerfile)
+            print(
+                f"Packed {human_size(report.referenced)} of {human_size(report.size)}"
+                f" into {pack}. Build it with: docker build - < {pack}"
+            )
+
+    @command(dockercmd)
+    def tags(
+        repository: str,
+        contains: str | None = None,
+        sort: str = "pushed",
+        limit: int = 0,
+        refresh: bool = False,
+        json: bool = False,
+    ):
+        """List the tags in an ECR repository, newest first"""
+
+        from mads.build import ecr
+        from mads.build.logging import human_size
+
+        sorts = {
+            "pushed": lambda item: item[1]["pushed_at"],
+            "size": lambda item: item[1]["size"],
+            "tag": lambda item: item[0],
+        }
+        if sort not in sorts:
+            die(f"Unknown sort {sort!r}. Choose from: {', '.join(sorts)}")
+
+        items = ecr.index(repository, refresh=refresh).items()
+        if contains:
+            items = [item for item in items if contains in item[0]]
+        items = sorted(items, key=sorts[sort], reverse=sort != "tag")
+        if limit:
+            items = items[:limit]
+
+        if json:
+            import json as jsonlib
+
+            print(jsonlib.dumps(dict(items), indent=2))
+            return
+
+        for tag, image in items:
+            print(
+                f"{tag:<40} {image['digest'][:19]}  {image['pushed_at'][:19]}"
+                f"  {human_size(image['size']):>10}"
+            )
+
+    @command(dockercmd)
+    def prune_remote(
+        repository: str,
+        prefix: str | None = None,
+        keep_recent: int = 5,
+        max_age_days: float = 30,
+        untagged: bool = False,
+        delete: bool = False,
+        *keep: str,
+    ):
+        """
+        List the stale tags in an ECR repository and, with --untagged, old
+        untagged images that no tagged image uses. Nothing is deleted without
+        --delete. Tags matching latest, beta, *-beta, the --prefix builds are
+        tagged with or any other KEEP glob are retained.
+        """
+
+        from mads.build import ecr
+
+        deleted = ecr.prune(
+            repository,
+            keep=[*ecr.KEEP_TAGS, *keep],
+            prefix=prefix,
+            keep_recent=keep_recent,
+            max_age_days=max_age_days,
+            untagged=untagged,
+            dry_run=not delete,
+        )
+        if delete:
+            print(f"Deleted {deleted} images from {repository}")
+        else:
+            print(
+                f"Would delete {deleted} images from {repository}. "
+                "Pass --delete to delete them."
+            )
+
+    cachecmd = dockercmd.add_parser(
+        "cache", help="Save and load compressed image tarballs"
+    )
+    cachecmd.set_defaults(func=lambda _: cachecmd.print_help())
+    cachesub = cachecmd.add_subparsers(
+        title="Image cache commands", help="Available commands"
+    )
+
+    @command(cachesub)
+    def save(image: str, dest: str | None = None, key: str | None = None):
+        """Save an image to the cache directory or S3 prefix"""
+
+        from mads.build import docker
+
+        key = docker.cache_save(image, dest=dest, key=key)
+        set_output(cache_key=key)
+        print(key)
+
+    @command(cachesub)
+    def load(key: str, dest: str | None = None):
+        """Load an image from the cache directory or S3 prefix"""
+
+        from mads.build import docker
+
+        if not docker.cache_load(key, dest=dest):
+            die(f"No cached image for {key}")
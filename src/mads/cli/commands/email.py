@@ -0,0 +1,85 @@
+"""Send build emails through SES"""
+
+import sys
+import argparse
+from mads.cli.command import command, die, set_output
+
+
+def register_subcommand(parser: argparse.ArgumentParser):
+    """Register the email command"""
+
+    emailcmd = parser.add_subparsers(title="Email commands", help="Available commands")
+
+    @command(emailcmd)
+    def send(to: str, subject: str, body: str = "", *attachments: str):
+        """Send one email to a comma-separated list of addresses"""
+
+        from mads.build.email import send_email
+
+        message_id = send_email(
+            to=[address.strip() for address in to.split(",")],
+            subject=subject,
+            body=body,
+            attachments=list(attachments),
+        )
+        set_output(message_id=message_id or "")
+
+    @command(emailcmd)
+    def bulk(
+        messages: str,
+        template: str | None = None,
+        concurrency: int = 8,
+        rate: str | None = None,
+        json: bool = False,
+    ):
+        """
+        Send a JSON list of messages, or with --template (a JSON message whose
+        fields use {column} placeholders), one message per row of a CSV or JSON
+        file
+        """
+
+        import csv
+        import json as jsonlib
+        from mads.build.email import render_messages, send_bulk
+
+        with open(messages) as f:
+            if messages.endswith(".csv"):
+                rows = list(csv.DictReader(f))
+            else:
+                rows = jsonlib.load(f)
+
+        if template:
+            with open(template) as f:
+                rows = render_messages(jsonlib.load(f), rows)
+
+        results = send_bulk(
+            rows,
+            concurrency=concurrency,
+            rate=float(rate) if rate else None,
+        )
+        failed = sum(1 for result in results if result.error)
+
+        if json:
+            print(jsonlib.dumps([result.model_dump() for result in results], indent=2))
+        else:
+            from rich.table import Table
+            from rich.console import Console
+
+            table = Table()
+            table.add_column("To")
+            table.add_column("Subject")
+            table.add_column("Result", overflow="fold")
+
+            for result in results:
+                table.add_row(
+                    ", ".join(result.to),
+                    result.subject,
+                    result.error or result.message_id or "skipped",
+                    style="red" if result.error else None,
+                )
+
+            Console(file=sys.stderr).print(table)
+
+        set_output(sent=len(results) - failed, failed=failed)
+        if failed:
+            die(f"{failed} of {len(results)} emails failed")
@@ -1,7 +1,7 @@
 """Helpers for interacting with GitHub"""
 
 import argparse
-from mads.cli.command import command
+from mads.cli.command import command, set_output
 from mads.build.github import CheckState
 
 
@@ -40,3 +40,69 @@ def register_subcommand(parser: argparse.ArgumentParser):
         from mads.build import github
 
         github.create_status(status, context, description)
+
+    @command(ghcmd)
+    def check(
+        name: str,
+        conclusion: str | None = None,
+        title: str | None = None,
+        summary: str | None = None,
+        summary_file: str | None = None,
+        *annotate: str,
+    ):
+        """
+        Create or update a check run on the current commit, annotated with
+        file:line messages found in the given output files (- for stdin)
+        """
+
+        import sys
+        from mads.build import github
+
+        if summary_file:
+            with open(summary_file) as f:
+                summary = f.read()
+
+        annotations = []
+        for path in annotate:
+            if path == "-":
+                output = sys.stdin.read()
+            else:
+                with open(path) as f:
+                    output = f.read()
+            annotations.extend(github.parse_annotations(output))
+
+        check_run_id = github.report_check(
+            name,
+            conclusion=conclusion,
+            title=title,
+            summary=summary or "",
+            annotations=annotations,
+        )
+        set_output(check_run_id=check_run_id)
+
+    releasecmd = ghcmd.add_parser("release", help="Manage GitHub releases")
+    releasecmd.set_defaults(func=lambda _: releasecmd.print_help())
+    releasesub = releasecmd.add_subparsers(
+        title="Release commands", help="Available commands"
+    )
+
+    @command(releasesub)
+    def upload(
+        tag: str,
+        repo: str | None = None,
+        concurrency: int = 4,
+        *files: str,
+    ):
+        """Upload files to the release for a tag, creating it if needed"""
+
+        import json
+        from mads.build import github
+
+        owner = None
+        if repo:
+            owner, repo = repo.split("/")
+
+        summary = github.upload_release_assets(
+            tag, list(files), owner=owner, repo=repo, concurrency=concurrency
+        )
+        print(json.dumps(summary, indent=2))
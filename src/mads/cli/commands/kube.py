@@ -1,7 +1,8 @@
 """Helpers for interacting with Kubernetes"""
 
+import sys
 import argparse
-from mads.cli.command import command
+from mads.cli.command import command, die, set_output
 
 
 def register_subcommand(parser: argparse.ArgumentParser):
@@ -12,10 +13,72 @@ def register_subcommand(parser: argparse.ArgumentParser):
     )
 
     @command(k8scmd)
-    def rollout(cluster: str, deployment: str, namespace: str):
-        """Restart the given deployment."""
+    def rollout(
+        cluster: str,
+        region: str | None = None,
+        namespace: str | None = None,
+        timeout: int = 600,
+        concurrency: int = 8,
+        *targets: str,
+    ):
+        """
+        Restart deployments, given as namespace/deployment (or deployment with
+        --namespace), and wait for them to roll out. The older form of a single
+        DEPLOYMENT NAMESPACE pair is still accepted, with a warning.
+        """
 
-        from mads.build import kube
+        from rich.live import Live
+        from rich.table import Table
+        from rich.console import Console
+        from mads.build import kube, log
 
-        kube.setup(cluster)
-        kube.rollout(deployment, namespace)
+        # Two bare names can't be targets without --namespace, so they can only
+        # be the old form. Say how they were read, since it's easy to mistake.
+        if not namespace and len(targets) == 2 and "/" not in "".join(targets):
+            deployment, namespace = targets
+            targets = [deployment]
+            log.warning(
+                f"Read `{deployment} {namespace}` as deployment {deployment} in "
+                f"namespace {namespace}. This form is deprecated; pass "
+                f"{namespace}/{deployment} or --namespace {namespace} {deployment}"
+            )
+        if not targets:
+            die("No deployments to roll out")
+        if not namespace and any("/" not in target for target in targets):
+            die("Give deployments as namespace/deployment, or pass --namespace")
+
+        pairs = [kube.parse_target(target, namespace) for target in targets]
+
+        kube.setup(cluster, region)
+
+        styles = {"ready": "green", "failed": "red"}
+
+        def render(rollouts: list[kube.Rollout]) -> Table:
+            table = Table(title=f"Rollouts on {cluster}")
+            table.add_column("Deployment")
+            table.add_column("State")
+            table.add_column("Time", justify="right")
+            table.add_column("Message", overflow="fold")
+
+            for r in rollouts:
+                table.add_row(
+                    f"{r.namespace}/{r.deployment}",
+                    r.state,
+                    f"{r.seconds:.0f}s",
+                    r.message,
+                    style=styles.get(r.state),
+                )
+            return table
+
+        with Live(console=Console(file=sys.stderr)) as live:
+            results = kube.rollout_all(
+                pairs,
+                timeout=timeout,
+                concurrency=concurrency,
+                on_update=lambda rollouts: live.update(render(rollouts)),
+            )
+
+        failed = [r for r in results if not r.ok]
+        set_output(rolled_out=len(results) - len(failed), failed=len(failed))
+        if failed:
+            die(f"{len(failed)} of {len(results)} rollouts failed")
@@ -0,0 +1,36 @@
+"""Helpers for interacting with S3"""
+
+import json
+import argparse
+from mads.cli.command import command
+
+
+def register_subcommand(parser: argparse.ArgumentParser):
+    """Register the s3 command"""
+
+    s3cmd = parser.add_subparsers(title="S3 commands", help="Available commands")
+
+    @command(s3cmd)
+    def sync(
+        source: str,
+        dest: str,
+        delete: bool = False,
+        check: str = "mtime",
+        part_size_mb: int = 64,
+        concurrency: int = 16,
+        dry_run: bool = False,
+    ):
+        """Sync a directory to or from an s3:// prefix"""
+
+        from mads.build import s3
+
+        summary = s3.sync(
+            source,
+            dest,
+            delete=delete,
+            check=check,
+            part_size=part_size_mb * 1024**2,
+            concurrency=concurrency,
+            dry_run=dry_run,
+        )
+        print(json.dumps(summary, indent=2))
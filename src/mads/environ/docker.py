@@ -24,3 +24,6 @@ class Docker(BaseSettings):
     # Environment config
     cache_to: Path | None = None
     cache_from: Path | None = None
+
+    # Where `mads docker cache` keeps image tarballs: a directory or s3:// URL
+    image_cache: str | None = None
@@ -41,8 +41,10 @@ class CodeBuild(Runner):
         return self.build_arn.split(":")[4]
 
     @property
-    def region(self) -> str:
+    def region(self) -> str | None:
         """Return the region from the build ARN"""
+        if not self.build_arn:
+            return super().region
         return self.build_arn.split(":")[3]
 
     @property
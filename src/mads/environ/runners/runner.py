@@ -5,6 +5,7 @@ For example, we could be running in a GitHub Action, a CodeBuild Build, or outsi
 CI runner entirely.
 """
 
+import os
 from typing import ClassVar, Type
 from pydantic import field_validator
 from pydantic_settings import BaseSettings
@@ -40,6 +41,11 @@ class Runner(BaseSettings):
     def url(self) -> str | None:
         pass
 
+    @property
+    def region(self) -> str | None:
+        """The AWS region we're running in, if we know it"""
+        return os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+
     _runners: ClassVar[list] = []
 
     io_settings: ClassVar[dict] = {}
@@ -70,6 +76,13 @@ class Runner(BaseSettings):
             return None
         return v.split("/")[-1].replace(".git", "")
 
+    # Before validators run last to first, so this has to come after the others
+    @field_validator("*", mode="before")
+    def may_be_property(cls, v):
+        """Runners may replace fields with properties, which show up as defaults"""
+
+        return None if isinstance(v, property) else v
+
     @property
     def trigger_description(self) -> str:
         """Return a description of what triggered this run"""
@@ -0,0 +1,19 @@
+"""Locations for data we cache between runs"""
+
+import os
+from pathlib import Path
+
+
+def cache_dir(*parts: str) -> Path:
+    """
+    Return a directory to cache data in, creating it if needed. This is
+    $MADS_CACHE_DIR if set, otherwise mads/ under $XDG_CACHE_HOME or ~/.cache.
+    """
+
+    root = os.environ.get("MADS_CACHE_DIR")
+    if not root:
+        root = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).joinpath("mads")
+
+    path = Path(root).expanduser().joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
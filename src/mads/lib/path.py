@@ -64,7 +64,19 @@ class PathFinder:
         )
 
     def get(self, name: str) -> Path | None:
-        """Find a file within the paths, or return None if it's not found"""
+        """Find a file within the paths, or return None if it's not found.
+        An s3:// URL is fetched into the local cache instead."""
+
+        if name.startswith("s3://"):
+            from botocore.exceptions import ClientError
+            from mads.build import s3
+
+            try:
+                return s3.fetch(*s3.parse_url(name))
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                    return None
+                raise
 
         for path in self.paths:
             path = path.joinpath(name)
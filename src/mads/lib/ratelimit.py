@@ -0,0 +1,42 @@
+"""Limit how often something happens across threads"""
+
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    A token bucket shared between threads. Tokens refill at rate per second,
+    up to burst, and acquire blocks until one is available.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None):
+        assert rate > 0, "The rate must be positive"
+
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"TokenBucket(rate={self.rate}, burst={self.burst})"
+
+    def acquire(self, tokens: float = 1):
+        """Wait until enough tokens are available, then take them."""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
@@ -49,9 +49,29 @@ def test_github_actions(env):
     )
 
 
-# def test_codebuild():
-#     """Test the CodeBuild runner"""
+def test_codebuild(env):
+    """Test the CodeBuild runner"""
 
-#     runner = CodeBuild()
+    env.update(
+        {
+            "CODEBUILD_BUILD_ID": "mads-cli:123",
+            "CODEBUILD_BUILD_ARN": "arn:aws:codebuild:us-west-2:123456789012:build/mads-cli:123",
+            "CODEBUILD_SOURCE_REPO_URL": "https://github.com/umsi-mads/mads-cli.git",
+            "CODEBUILD_SOURCE_VERSION": "main",
+        }
+    )
+    runner = CodeBuild()
+
+    assert runner.name == "codebuild"
+    assert runner.repo == "mads-cli"
+    assert runner.run_id == "mads-cli:123"
+    assert runner.region == "us-west-2"
+
+
+def test_region_from_environment(env):
+    """Test that runners without their own region use the AWS environment"""
+
+    env.pop("AWS_REGION", None)
+    env["AWS_DEFAULT_REGION"] = "us-east-2"
 
-#     assert runner.name == "codebuild"
+    assert LocalRunner().region == "us-east-2"
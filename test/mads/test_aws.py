@@ -0,0 +1,38 @@
+import sys
+import subprocess
+
+from mads.build import aws
+
+
+def test_build_modules_do_not_import_boto3():
+    """Test that importing the build helpers doesn't load boto3"""
+
+    code = (
+        "import sys\n"
+        "import mads.cli.args, mads.build.docker, mads.build.s3, mads.build.email\n"
+        "print(any(name.startswith(('boto3', 'botocore')) for name in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == "False"
+
+
+def test_clients_are_shared():
+    """Test that each service gets one client, recreated after configure"""
+
+    client = aws.client("s3", region_name="us-east-1")
+    assert aws.client("s3", region_name="us-east-1") is client
+    assert client.meta.config.max_pool_connections == aws.MAX_POOL_CONNECTIONS
+
+    original = aws.MAX_POOL_CONNECTIONS
+    aws.configure(max_pool_connections=20)
+    try:
+        assert aws.client("s3", region_name="us-east-1") is not client
+        assert (
+            aws.client("s3", region_name="us-east-1").meta.config.max_pool_connections
+            == 20
+        )
+    finally:
+        aws.configure(max_pool_connections=original)
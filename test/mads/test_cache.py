@@ -0,0 +1,88 @@
+import platform
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from mads.build import cache, storage
+from mads.build.cache import hash_files, render_key
+
+
+def test_render_key(tmp_path, monkeypatch):
+    """Test that cache keys change with the files they hash"""
+
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("requirements.txt").write_text("pandas==2.0\n")
+
+    key = render_key("pip-{os}-{hash:requirements*.txt}")
+    assert key == f"pip-{platform.system().lower()}-{hash_files('requirements*.txt')}"
+    assert render_key("pip-{os}-{hash:requirements*.txt}") == key
+
+    tmp_path.joinpath("requirements.txt").write_text("pandas==2.1\n")
+    assert render_key("pip-{os}-{hash:requirements*.txt}") != key
+
+
+def test_hash_requires_matching_files(tmp_path, monkeypatch):
+    """Test that a pattern matching nothing isn't silently hashed as empty"""
+
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("requirements.txt").write_text("pandas==2.0\n")
+
+    # An optional file may be missing, as long as something matches
+    assert hash_files("requirements.txt", "poetry.lock") == hash_files(
+        "requirements.txt"
+    )
+
+    with pytest.raises(ValueError):
+        render_key("pip-{hash:requirments.txt}")
+
+
+@pytest.fixture
+def buckets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage.configure(str(tmp_path.joinpath("buckets")))
+    yield tmp_path.joinpath("buckets")
+    storage.configure(None)
+
+
+def test_save_and_restore(tmp_path, buckets, monkeypatch):
+    """Test that a saved cache is restored, by key or by fallback prefix"""
+
+    # A runner without a repository falls back on the checkout's name
+    runner = SimpleNamespace(repo=None, name="local")
+    monkeypatch.setattr(cache, "Runner", SimpleNamespace(current=lambda: runner))
+
+    deps = tmp_path.joinpath("deps")
+    deps.joinpath("pkg").mkdir(parents=True)
+    deps.joinpath("pkg/__init__.py").write_text("VERSION = 1\n")
+
+    assert cache.save("pip-1", [str(deps)], url="s3://ci/cache")
+    assert buckets.joinpath(f"ci/cache/{tmp_path.name}/pip-1.tar.zst").exists()
+
+    # Entries are immutable
+    assert not cache.save("pip-1", [str(deps)], url="s3://ci/cache")
+
+    deps.joinpath("pkg/__init__.py").unlink()
+    assert cache.restore("pip-1", url="s3://ci/cache") == "pip-1"
+    assert deps.joinpath("pkg/__init__.py").read_text() == "VERSION = 1\n"
+
+    assert cache.restore("pip-2", ["pip-"], url="s3://ci/cache") == "pip-1"
+    assert cache.restore("npm-1", ["npm-"], url="s3://ci/cache") is None
+
+
+def test_failed_save_leaves_no_entry(tmp_path, buckets, monkeypatch):
+    """Test that a save whose pipeline fails can be retried under the same key"""
+
+    runner = SimpleNamespace(repo="course", name="local")
+    monkeypatch.setattr(cache, "Runner", SimpleNamespace(current=lambda: runner))
+
+    # Write part of a tarball, then fail, like tar hitting an unreadable file
+    stream = cache.stream
+    monkeypatch.setattr(
+        cache, "stream", lambda cmd, *args: stream("echo partial; exit 1", *args)
+    )
+
+    with pytest.raises(subprocess.CalledProcessError):
+        cache.save("pip-1", [str(tmp_path)], url="s3://ci/cache")
+
+    assert not list(buckets.rglob("*.tar.zst"))
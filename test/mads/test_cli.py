@@ -1,6 +1,9 @@
 """Test the CLI interface"""
 
+import pytest
+
 from mads import cli
+from mads.build import kube, log
 from mads.environ import Git
 
 
@@ -32,3 +35,29 @@ def test_determine_tag_default(capsys):
         None: "beta",
     }.get(git.branch, "beta")
     assert capsys.readouterr().out == f"{expected}\n"
+
+
+def test_kube_rollout_legacy_form(monkeypatch, tmp_path):
+    """Test that the old DEPLOYMENT NAMESPACE form still works, with a warning"""
+
+    rolled_out, warnings = [], []
+    monkeypatch.setenv("GITHUB_OUTPUT", str(tmp_path.joinpath("output")))
+    monkeypatch.setattr(kube, "setup", lambda cluster, region: None)
+    monkeypatch.setattr(log, "warning", lambda msg, *args: warnings.append(msg))
+
+    def rollout_all(pairs, **kwargs):
+        rolled_out.extend(pairs)
+        return [
+            kube.Rollout(namespace=n, deployment=d, state="ready") for n, d in pairs
+        ]
+
+    monkeypatch.setattr(kube, "rollout_all", rollout_all)
+
+    cli.main(["kube", "rollout", "courses", "api", "prod"])
+    assert rolled_out == [("prod", "api")]
+    assert "as deployment api in namespace prod" in warnings[0]
+
+    # Any other bare names need a namespace
+    with pytest.raises(SystemExit):
+        cli.main(["kube", "rollout", "courses", "api", "web", "worker"])
+    assert rolled_out == [("prod", "api")]
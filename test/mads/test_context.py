@@ -0,0 +1,118 @@
+import tarfile
+
+from mads.build.context import (
+    DockerIgnore,
+    walk,
+    content_hash,
+    dockerfile_sources,
+    analyze,
+    pack,
+)
+
+
+def test_dockerignore_patterns():
+    """Test that .dockerignore patterns follow Docker's matching rules"""
+
+    ignore = DockerIgnore(
+        [
+            "# comments are skipped",
+            "*.log",
+            "/data",
+            "**/__pycache__",
+            "docs/*.md",
+            "!docs/README.md",
+        ]
+    )
+
+    assert ignore.ignored("build.log")
+    assert not ignore.ignored("src/build.log")
+    assert ignore.ignored("data")
+    assert ignore.ignored("data/big/file.csv")
+    assert ignore.ignored("src/pkg/__pycache__/mod.pyc")
+    assert ignore.ignored("docs/guide.md")
+    assert not ignore.ignored("docs/README.md")
+    assert not ignore.ignored("docs/sub/guide.md")
+
+
+def test_walk_respects_dockerignore(tmp_path):
+    """Test that walk only yields files sent to the daemon"""
+
+    tmp_path.joinpath(".dockerignore").write_text("data\n")
+    tmp_path.joinpath("Dockerfile").write_text("FROM scratch\n")
+    tmp_path.joinpath("data").mkdir()
+    tmp_path.joinpath("data/big.csv").write_text("1,2,3\n")
+    tmp_path.joinpath("src").mkdir()
+    tmp_path.joinpath("src/app.py").write_text("print('hi')\n")
+
+    files = [path.as_posix() for path in walk(tmp_path)]
+
+    assert files == [".dockerignore", "Dockerfile", "src/app.py"]
+
+
+def test_content_hash(tmp_path):
+    """Test that the content hash only changes when build inputs change"""
+
+    tmp_path.joinpath(".dockerignore").write_text("*.log\n")
+    tmp_path.joinpath("Dockerfile").write_text("FROM scratch\n")
+    tmp_path.joinpath("app.py").write_text("print('hi')\n")
+
+    original = content_hash(tmp_path)
+    assert content_hash(tmp_path) == original
+
+    # Ignored files don't affect the hash
+    tmp_path.joinpath("build.log").write_text("noise\n")
+    assert content_hash(tmp_path) == original
+
+    # Build args do
+    assert content_hash(tmp_path, build_args={"VERSION": "1"}) != original
+
+    # And so do the files in the context
+    tmp_path.joinpath("app.py").write_text("print('bye')\n")
+    assert content_hash(tmp_path) != original
+
+
+def test_dockerfile_sources(tmp_path):
+    """Test that COPY, ADD and bind mount sources are found"""
+
+    dockerfile = tmp_path.joinpath("Dockerfile")
+    dockerfile.write_text(
+        "FROM python:3.11 AS base\n"
+        "# COPY commented.txt /\n"
+        "COPY --chown=1000 requirements.txt \\\n"
+        "     setup.cfg /app/\n"
+        'ADD ["src", "/app/src"]\n'
+        "ADD https://example.com/file.tgz /tmp/\n"
+        "COPY --from=base /app /app\n"
+        "COPY ${NAME}.cfg /etc/\n"
+        "RUN --mount=type=bind,source=scripts,target=/scripts sh /scripts/go\n"
+    )
+
+    assert dockerfile_sources(dockerfile) == [
+        "requirements.txt",
+        "setup.cfg",
+        "src",
+        "*.cfg",
+        "scripts",
+    ]
+
+
+def test_analyze_and_pack(tmp_path):
+    """Test that unreferenced paths are reported and left out of the pack"""
+
+    tmp_path.joinpath("Dockerfile").write_text("FROM scratch\nCOPY src /src\n")
+    tmp_path.joinpath("src").mkdir()
+    tmp_path.joinpath("src/app.py").write_text("print('hi')\n")
+    tmp_path.joinpath("data").mkdir()
+    tmp_path.joinpath("data/big.csv").write_text("1,2,3\n" * 100)
+
+    report = analyze(tmp_path)
+
+    assert report.dirs["src"].referenced == report.dirs["src"].size
+    assert report.dirs["data"].referenced == 0
+    assert report.referenced < report.size
+
+    output = tmp_path.joinpath("context.tar.gz")
+    pack(output, tmp_path)
+
+    with tarfile.open(output) as tarball:
+        assert sorted(tarball.getnames()) == ["Dockerfile", "src/app.py"]
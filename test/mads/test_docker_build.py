@@ -0,0 +1,255 @@
+import io
+import os
+import json
+import subprocess
+from types import SimpleNamespace
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from mads.build import docker, storage
+
+GB = 1024**3
+
+
+def image(tag: str, days_ago: float, size: int = 2 * GB) -> dict:
+    return {
+        "id": f"sha256:{tag}",
+        "tags": [tag],
+        "size": size,
+        "last_used": datetime.now(timezone.utc) - timedelta(days=days_ago),
+    }
+
+
+def fake_host(monkeypatch, images: list[dict], free: int) -> list[str]:
+    """Pretend Docker has these images and free space, and record removals."""
+
+    disk = {"free": free}
+    sizes = {image["tags"][0]: image["size"] for image in images}
+    removed = []
+
+    def proc(cmd: str, *args, **kwargs):
+        if cmd.startswith("docker image rm "):
+            ref = cmd.split()[-1]
+            removed.append(ref)
+            disk["free"] += sizes[ref]
+        return SimpleNamespace(returncode=0, stdout=b"", stderr=b"")
+
+    monkeypatch.setattr(docker, "data_root", lambda: "/")
+    monkeypatch.setattr(docker, "local_images", lambda: images)
+    monkeypatch.setattr(docker, "determine_tag", lambda use_branch=False: "latest")
+    monkeypatch.setattr(docker, "proc", proc)
+    monkeypatch.setattr(
+        docker.psutil, "disk_usage", lambda _: SimpleNamespace(free=disk["free"])
+    )
+    return removed
+
+
+def test_prune_protects_full_references(monkeypatch):
+    """Test that only the build's own repo:tag is protected, oldest evicted first"""
+
+    images = [
+        image("course:latest", 60),
+        image("other:latest", 50),
+        image("other:dev", 40),
+        image("course:feature-1", 20),
+        image("course:feature-2", 10),
+    ]
+    removed = fake_host(monkeypatch, images, free=1 * GB)
+
+    reclaimed = docker.prune(free_gb=6, image_name="course")
+
+    # Unrelated :latest images aren't protected, and eviction stops as soon
+    # as the target is met
+    assert removed == ["other:latest", "other:dev", "course:feature-1"]
+    assert reclaimed == 6 * GB
+
+
+def test_prune_dry_run_estimates(monkeypatch):
+    """Test that a dry run removes nothing and reports what it would reclaim"""
+
+    images = [image("old:1", 30), image("old:2", 20), image("old:3", 10)]
+    removed = fake_host(monkeypatch, images, free=1 * GB)
+
+    assert docker.prune(free_gb=4, dry_run=True) == 4 * GB
+    assert removed == []
+
+
+@pytest.fixture
+def fake_stream(monkeypatch):
+    """Stand in for the docker save and load pipelines with in-memory pipes."""
+
+    loaded = []
+
+    @contextmanager
+    def stream(cmd: str, mode: str = "r", silent: bool = False):
+        if mode == "r":
+            yield io.BytesIO(f"tarball from `{cmd}`".encode())
+        else:
+            pipe = io.BytesIO()
+            yield pipe
+            loaded.append(pipe.getvalue().decode())
+
+    monkeypatch.setattr(docker, "stream", stream)
+    monkeypatch.setattr(docker.shutil, "which", lambda name: f"/usr/bin/{name}")
+    return loaded
+
+
+@pytest.mark.parametrize("dest", ["dir", "s3"])
+def test_cache_round_trip(dest, tmp_path, fake_stream):
+    """Test that a saved image is loaded back from a directory or S3"""
+
+    storage.configure(str(tmp_path.joinpath("buckets")))
+    try:
+        url = "s3://cache/images" if dest == "s3" else str(tmp_path.joinpath("images"))
+
+        assert not docker.cache_load("course/latest", url)
+
+        key = docker.cache_save("123.dkr.ecr.aws/course:latest", url)
+        assert key == "course/latest"
+
+        assert docker.cache_load(key, url)
+        assert fake_stream == [
+            "tarball from `docker save 123.dkr.ecr.aws/course:latest "
+            "| zstd -T0 -3 -q -c`"
+        ]
+    finally:
+        storage.configure(None)
+
+
+@pytest.mark.parametrize("dest", ["dir", "s3"])
+def test_failed_save_publishes_nothing(dest, tmp_path, monkeypatch):
+    """Test that a failing docker save doesn't leave a corrupt tarball behind"""
+
+    bin_dir = tmp_path.joinpath("bin")
+    bin_dir.mkdir()
+    bin_dir.joinpath("docker").write_text("#!/bin/sh\necho partial\nexit 1\n")
+    bin_dir.joinpath("docker").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    buckets = tmp_path.joinpath("buckets")
+    storage.configure(str(buckets))
+    try:
+        url = "s3://cache/images" if dest == "s3" else str(tmp_path.joinpath("images"))
+
+        with pytest.raises(subprocess.CalledProcessError):
+            docker.cache_save("course:latest", url)
+
+        assert not docker.cache_load("course/latest", url)
+        assert not [path for path in tmp_path.rglob("*.tar.zst*") if path.is_file()]
+    finally:
+        storage.configure(None)
+
+
+def fake_docker(
+    monkeypatch, local: dict[str, list[str]], remote: set[str]
+) -> list[str]:
+    """
+    Pretend local images have these repo digests and the registry has these
+    references, and record the docker commands run.
+    """
+
+    commands = []
+
+    def proc(cmd: str, *args, **kwargs):
+        commands.append(cmd)
+        ref = cmd.split()[-1]
+        if cmd.startswith("docker image inspect"):
+            if ref not in local:
+                return SimpleNamespace(returncode=1, stdout=b"", stderr=b"")
+            digests = [f"{ref.split(':')[0]}@{digest}" for digest in local[ref]]
+            return SimpleNamespace(returncode=0, stdout=json.dumps(digests).encode())
+        if cmd.startswith("docker pull"):
+            return SimpleNamespace(returncode=0 if ref in remote else 1)
+        return SimpleNamespace(returncode=0)
+
+    monkeypatch.setattr(docker, "proc", proc)
+    monkeypatch.setattr(docker, "PULLS", {"pulled": 0, "skipped": 0})
+    return commands
+
+
+def test_pull_skips_current_images(monkeypatch):
+    """Test that an image is only pulled when its local digest is out of date"""
+
+    commands = fake_docker(
+        monkeypatch,
+        local={"repo/course:latest": ["sha256:aaa"]},
+        remote={"repo/course:latest"},
+    )
+
+    assert docker.pull("repo/course", "latest", digest="sha256:aaa")
+    assert not any(cmd.startswith("docker pull") for cmd in commands)
+
+    assert docker.pull("repo/course", "latest", digest="sha256:bbb")
+    assert commands[-1] == "docker pull repo/course:latest"
+
+    assert docker.PULLS == {"pulled": 1, "skipped": 1}
+
+
+def test_pull_looks_up_the_digest(monkeypatch):
+    """Test that pull asks ECR for the digest when it isn't given one"""
+
+    commands = fake_docker(
+        monkeypatch,
+        local={"repo/course:beta": ["sha256:aaa"]},
+        remote=set(),
+    )
+    monkeypatch.setattr(
+        docker.ecr,
+        "get_image_digest",
+        lambda repository, tag: "sha256:aaa" if repository == "course" else None,
+    )
+
+    assert docker.pull("repo/course", "beta")
+    assert not any(cmd.startswith("docker pull") for cmd in commands)
+
+
+def test_try_pull_retags_latest(monkeypatch):
+    """Test that try_pull falls back on latest and tags it as the requested tag"""
+
+    commands = fake_docker(monkeypatch, local={}, remote={"repo/course:latest"})
+    monkeypatch.setattr(docker.ecr, "get_image_digest", lambda repository, tag: None)
+
+    assert docker.try_pull("repo/course", "feature-x")
+    assert commands[-1] == "docker tag repo/course:latest repo/course:feature-x"
+    assert docker.PULLS == {"pulled": 1, "skipped": 0}
+
+
+def test_pull_first_uses_the_cached_index(monkeypatch):
+    """Test that pull_first only lists tags again when the preferred one is missing"""
+
+    fake_docker(
+        monkeypatch,
+        local={},
+        remote={"repo/course:latest", "repo/course:feature-1"},
+    )
+    listings = []
+
+    def get_image_digests(repository, refresh=False):
+        listings.append(refresh)
+        if refresh:
+            return {"feature-1": "sha256:new", "latest": "sha256:old"}
+        return {"latest": "sha256:old"}
+
+    monkeypatch.setattr(docker.ecr, "get_image_digests", get_image_digests)
+
+    assert docker.pull_first("repo/course", "latest") == "repo/course:latest"
+    assert listings == [False]
+
+    assert docker.pull_first("repo/course", "feature-1", "latest") == (
+        "repo/course:feature-1"
+    )
+    assert listings == [False, False, True]
+
+
+def test_push_invalidates_the_index(monkeypatch):
+    """Test that pushing forgets the repository's cached tags"""
+
+    commands = fake_docker(monkeypatch, local={}, remote=set())
+    invalidated = []
+    monkeypatch.setattr(docker.ecr, "invalidate", invalidated.append)
+
+    assert docker.push("123.dkr.ecr.aws/course", "latest")
+    assert commands == ["docker push 123.dkr.ecr.aws/course:latest"]
+    assert invalidated == ["course"]
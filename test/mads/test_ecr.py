@@ -0,0 +1,222 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.stub import Stubber
+
+from mads.build import ecr
+
+
+def describe_images_response(*tags: str) -> dict:
+    return {
+        "imageDetails": [
+            {
+                "imageDigest": f"sha256:{tag}",
+                "imageTags": [tag],
+                "imagePushedAt": datetime(2024, 1, 1, tzinfo=timezone.utc),
+                "imageSizeInBytes": 100,
+            }
+            for tag in tags
+        ]
+    }
+
+
+def test_index_is_cached(env, tmp_path, monkeypatch):
+    """Test that the tag index is only fetched again after it's invalidated"""
+
+    env["MADS_CACHE_DIR"] = str(tmp_path)
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(ecr, "registry", lambda: ("123456789012", "us-east-1"))
+
+    with Stubber(ecr.ecr) as stub:
+        stub.add_response(
+            "describe_images",
+            describe_images_response("latest", "beta"),
+            {"repositoryName": "course"},
+        )
+
+        assert ecr.get_image_digests("course") == {
+            "latest": "sha256:latest",
+            "beta": "sha256:beta",
+        }
+
+        # Served from disk, so no request is made
+        assert ecr.get_image_tags("course") == ["latest", "beta"]
+        stub.assert_no_pending_responses()
+
+        stub.add_response(
+            "describe_images",
+            describe_images_response("latest"),
+            {"repositoryName": "course"},
+        )
+
+        ecr.invalidate("course")
+        assert ecr.get_image_tags("course") == ["latest"]
+
+        # Pull decisions list the tags again whatever the cache holds
+        stub.add_response(
+            "describe_images",
+            describe_images_response("latest", "feature-1"),
+            {"repositoryName": "course"},
+        )
+        assert ecr.get_image_digests("course", refresh=True) == {
+            "latest": "sha256:latest",
+            "feature-1": "sha256:feature-1",
+        }
+
+        # The same repository in another account or region has its own index
+        monkeypatch.setattr(ecr, "registry", lambda: ("210987654321", "us-east-1"))
+        stub.add_response(
+            "describe_images",
+            describe_images_response("beta"),
+            {"repositoryName": "course"},
+        )
+        assert ecr.get_image_tags("course") == ["beta"]
+        stub.assert_no_pending_responses()
+
+
+def test_expired_tags():
+    """Test the retention rules for pruning tags"""
+
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+    def pushed(days_ago: int) -> dict:
+        return {"pushed_at": (now - timedelta(days=days_ago)).isoformat()}
+
+    tags = {
+        "latest": pushed(400),
+        "beta": pushed(400),
+        "feature-a-1": pushed(100),
+        "feature-a-2": pushed(90),
+        "feature-a-3": pushed(80),
+        "feature-b-1": pushed(100),
+        "fix-c-1": pushed(5),
+        "fix-c-2": pushed(2),
+    }
+
+    expired = ecr.expired_tags(tags, keep_recent=1, max_age_days=30, now=now)
+
+    # latest/beta are always kept, as is the newest of each branch, and
+    # nothing younger than the max age is expired.
+    assert expired == ["feature-a-1", "feature-a-2"]
+
+
+def test_artifact_tags_are_kept():
+    """Test that prefixed main and beta tags survive, and each branch is its own group"""
+
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+    def pushed(days_ago: int) -> dict:
+        return {"pushed_at": (now - timedelta(days=days_ago)).isoformat()}
+
+    tags = {
+        "course501": pushed(60),
+        "course501-beta": pushed(50),
+        **{f"course501-feat{i}": pushed(i) for i in range(1, 6)},
+        "course501-old": pushed(90),
+        "course501-fix-1": pushed(80),
+        "course501-fix-2": pushed(70),
+    }
+
+    keep = ecr.keep_patterns(ecr.KEEP_TAGS, "course501")
+    expired = ecr.expired_tags(tags, keep, keep_recent=1, max_age_days=30, now=now)
+
+    assert expired == ["course501-fix-1"]
+    assert ecr.tag_group("course501-feat1") == "course501-feat1"
+    assert ecr.tag_group("content-0123456789abcdef") == "content"
+
+
+def test_get_image_digest(env):
+    """Test that a tag's digest is looked up directly, or None if it's missing"""
+
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    with Stubber(ecr.ecr) as stub:
+        stub.add_response(
+            "describe_images",
+            describe_images_response("latest"),
+            {"repositoryName": "course", "imageIds": [{"imageTag": "latest"}]},
+        )
+        stub.add_client_error(
+            "describe_images",
+            service_error_code="ImageNotFoundException",
+            expected_params={
+                "repositoryName": "course",
+                "imageIds": [{"imageTag": "gone"}],
+            },
+        )
+
+        assert ecr.get_image_digest("course", "latest") == "sha256:latest"
+        assert ecr.get_image_digest("course", "gone") is None
+        stub.assert_no_pending_responses()
+
+
+def test_untagged_images_keep_index_children(env):
+    """Test that untagged manifests of a tagged multi-platform image are kept"""
+
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    old = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    index_type = "application/vnd.oci.image.index.v1+json"
+
+    with Stubber(ecr.ecr) as stub:
+        stub.add_response(
+            "describe_images",
+            {
+                "imageDetails": [
+                    {
+                        "imageDigest": "sha256:index",
+                        "imageTags": ["latest"],
+                        "imagePushedAt": old,
+                        "imageManifestMediaType": index_type,
+                    },
+                    {"imageDigest": "sha256:amd64", "imagePushedAt": old},
+                    {"imageDigest": "sha256:attestation", "imagePushedAt": old},
+                    {"imageDigest": "sha256:orphan", "imagePushedAt": old},
+                    {
+                        "imageDigest": "sha256:recent",
+                        "imagePushedAt": datetime.now(timezone.utc),
+                    },
+                ]
+            },
+            {"repositoryName": "course"},
+        )
+        stub.add_response(
+            "batch_get_image",
+            {
+                "images": [
+                    {
+                        "imageId": {"imageDigest": "sha256:index"},
+                        "imageManifest": json.dumps(
+                            {
+                                "mediaType": index_type,
+                                "manifests": [
+                                    {"digest": "sha256:amd64"},
+                                    {"digest": "sha256:attestation"},
+                                ],
+                            }
+                        ),
+                    }
+                ],
+                "failures": [],
+            },
+            {
+                "repositoryName": "course",
+                "imageIds": [{"imageDigest": "sha256:index"}],
+                "acceptedMediaTypes": ecr.INDEX_MEDIA_TYPES,
+            },
+        )
+
+        assert ecr.untagged_images("course", max_age_days=30) == ["sha256:orphan"]
+        stub.assert_no_pending_responses()
+
+
+def test_prune_dry_run_counts(env, monkeypatch):
+    """Test that a dry run reports what it would delete, and skips untagged images"""
+
+    monkeypatch.setattr(ecr, "index", lambda *args, **kwargs: {"old-1": {}})
+    monkeypatch.setattr(ecr, "expired_tags", lambda *args: ["old-1"])
+    monkeypatch.setattr(
+        ecr, "untagged_images", lambda *args: pytest.fail("Untagged images listed")
+    )
+
+    assert ecr.prune("course", dry_run=True) == 1
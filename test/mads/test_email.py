@@ -0,0 +1,192 @@
+import gzip
+from datetime import datetime, timedelta, timezone
+
+from botocore.stub import Stubber
+
+from mads.build import aws, email, storage
+
+
+def test_attachments_are_compressed(tmp_path):
+    """Test that text attachments are gzipped and binary ones left alone"""
+
+    log = tmp_path.joinpath("build.log")
+    log.write_text("step ok\n" * 10_000)
+    image = tmp_path.joinpath("plot.png")
+    image.write_bytes(b"\x89PNG")
+
+    message = email.build_email(
+        to=["student@example.com"],
+        subject="Build",
+        body="<p>Done</p>",
+        attachments=[log, image],
+    )
+
+    parts = {
+        part.get_filename(): part.get_payload(decode=True)
+        for part in message.walk()
+        if part.get_filename()
+    }
+    assert gzip.decompress(parts["build.log.gz"]) == log.read_bytes()
+    assert parts["plot.png"] == b"\x89PNG"
+
+
+def test_large_attachments_are_linked(tmp_path, monkeypatch):
+    """Test that attachments over the limit are uploaded and linked instead"""
+
+    storage.configure(str(tmp_path.joinpath("store")))
+    monkeypatch.setattr(email, "OFFLOAD_SIZE", 10)
+    monkeypatch.setattr(email, "ATTACHMENT_URL", "s3://bucket/email")
+
+    try:
+        report = tmp_path.joinpath("report.zip")
+        report.write_bytes(b"x" * 100)
+
+        message = email.build_email(
+            to=["student@example.com"],
+            subject="Build",
+            body="<p>Done</p>",
+            attachments=[report],
+        )
+    finally:
+        storage.configure(None)
+
+    assert not any(part.get_filename() for part in message.walk())
+    html = next(
+        part.get_payload(decode=True).decode()
+        for part in message.walk()
+        if part.get_content_type() == "text/html"
+    )
+    assert "report.zip</a>" in html
+
+    # The plain text part keeps the link too
+    text = next(
+        part.get_payload(decode=True).decode()
+        for part in message.walk()
+        if part.get_content_type() == "text/plain"
+    )
+    [uploaded] = tmp_path.glob("store/bucket/email/*/*/report.zip")
+    assert f"report.zip ({uploaded.as_uri()})" in text
+
+
+def test_attachment_order_is_kept(tmp_path, monkeypatch):
+    """Test that attachments and links keep the order they were given in"""
+
+    storage.configure(str(tmp_path.joinpath("store")))
+    monkeypatch.setattr(email, "OFFLOAD_SIZE", 50)
+    monkeypatch.setattr(email, "ATTACHMENT_URL", "s3://bucket/email")
+
+    try:
+        paths = []
+        for name, size in [("c.zip", 40), ("big.zip", 100), ("a.zip", 10)]:
+            paths.append(tmp_path.joinpath(name))
+            paths[-1].write_bytes(b"x" * size)
+        paths.append(tmp_path.joinpath("huge.zip"))
+        paths[-1].write_bytes(b"x" * 200)
+
+        message = email.build_email(
+            to=["student@example.com"],
+            subject="Build",
+            body="<p>Done</p>",
+            attachments=paths,
+        )
+    finally:
+        storage.configure(None)
+
+    assert [part.get_filename() for part in message.walk() if part.get_filename()] == [
+        "c.zip",
+        "a.zip",
+    ]
+    html = next(
+        part.get_payload(decode=True).decode()
+        for part in message.walk()
+        if part.get_content_type() == "text/html"
+    )
+    assert html.index("big.zip</a>") < html.index("huge.zip</a>")
+
+
+def test_links_state_their_expiry():
+    """Test that the stated expiry follows the lifetime the links were given"""
+
+    expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    html = email.links_html([("report.zip", "https://example.com", 100)], 3600)
+
+    assert f"{expires:%B %-d, %Y at %H}" in html
+
+
+def test_render_messages():
+    """Test that a template is filled in for each row"""
+
+    template = {"to": "{email}", "subject": "{course} build", "body": "Hi {name}"}
+    rows = [{"email": "a@example.com", "course": "SIADS 501", "name": "A"}]
+
+    assert email.render_messages(template, rows) == [
+        {"to": ["a@example.com"], "subject": "SIADS 501 build", "body": "Hi A"}
+    ]
+
+
+def test_send_bulk_retries_throttling(monkeypatch):
+    """Test that throttled messages are retried and failures reported"""
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(email, "SES_SEND_IDENTITY", "builds@example.com")
+
+    messages = [
+        {"to": ["a@example.com"], "subject": "One", "body": "1"},
+        {"to": ["b@example.com"], "subject": "Two", "body": "2"},
+    ]
+
+    with Stubber(aws.client("ses")) as stub:
+        stub.add_client_error(
+            "send_raw_email", "Throttling", "Maximum sending rate exceeded."
+        )
+        stub.add_response("send_raw_email", {"MessageId": "one"})
+        stub.add_client_error("send_raw_email", "MessageRejected", "Bad address")
+
+        results = email.send_bulk(messages, concurrency=1, rate=100)
+        stub.assert_no_pending_responses()
+
+    assert [result.message_id for result in results] == ["one", None]
+    assert [result.attempts for result in results] == [2, 1]
+    assert results[1].error == "MessageRejected: Bad address"
+
+
+def test_send_bulk_reports_bad_messages(monkeypatch):
+    """Test that a malformed message fails on its own without stopping the rest"""
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(email, "SES_SEND_IDENTITY", "builds@example.com")
+
+    messages = [
+        {"to": "a@example.com, b@example.com", "subject": "One", "body": "1"},
+        {"to": ["c@example.com"], "body": "No subject"},
+        {"to": ["d@example.com"], "subject": "Three", "body": "3"},
+    ]
+
+    with Stubber(aws.client("ses")) as stub:
+        stub.add_response("send_raw_email", {"MessageId": "one"})
+        stub.add_response("send_raw_email", {"MessageId": "three"})
+
+        results = email.send_bulk(messages, concurrency=1, rate=100)
+        stub.assert_no_pending_responses()
+
+    assert [result.message_id for result in results] == ["one", None, "three"]
+    assert results[0].to == ["a@example.com", "b@example.com"]
+    assert results[1].error == "KeyError: 'subject'"
+
+
+def test_build_email_outdents_on_error(tmp_path):
+    """Test that a message that fails to build doesn't leave the log indented"""
+
+    from mads.build import log
+
+    depth = len(log._indent)
+    try:
+        email.build_email(
+            to=["student@example.com"],
+            subject="Build",
+            attachments=[tmp_path.joinpath("missing.log")],
+        )
+    except FileNotFoundError:
+        pass
+
+    assert len(log._indent) == depth
@@ -0,0 +1,246 @@
+import stat
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from mads.build import github
+
+
+class FakeGhApi:
+    """Stands in for GhApi, counting the installation tokens it mints"""
+
+    minted = 0
+
+    def __init__(self, jwt_token=None, token=None):
+        self.token = token
+        self.apps = self
+
+    def create_installation_access_token(self, installation_id):
+        FakeGhApi.minted += 1
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        return {
+            "token": f"token-{FakeGhApi.minted}",
+            "expires_at": expires.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+
+@pytest.fixture
+def app(env, tmp_path, monkeypatch):
+    env.update(
+        {
+            "MADS_CACHE_DIR": str(tmp_path),
+            "GITHUB_ACTIONS": "true",
+            "GITHUB_RUN_ID": "1",
+            "GITHUB_REPOSITORY": "umsi-mads/mads-cli",
+            "GITHUB_REF_NAME": "main",
+            "GITHUB_EVENT_NAME": "push",
+        }
+    )
+    FakeGhApi.minted = 0
+    monkeypatch.setattr(github, "GhApi", FakeGhApi)
+    monkeypatch.setattr(github.jwt, "encode", lambda *args, **kwargs: "jwt")
+    monkeypatch.setattr(github, "_tokens", {})
+    monkeypatch.setattr(github, "_client", None)
+    monkeypatch.setattr(github, "APP_ID", "1")
+    monkeypatch.setattr(github, "INSTALLATION_ID", "2")
+    monkeypatch.setattr(github, "PRIVATE_KEY", "key")
+
+
+def test_tokens_are_reused(app):
+    """Test that tokens and the client are reused until near expiry"""
+
+    client = github.client()
+    assert github.client() is client
+    assert github.token() == "token-1"
+    assert FakeGhApi.minted == 1
+
+    assert github.token(refresh=True) == "token-2"
+    assert github.client() is not client
+
+
+def test_tokens_are_shared_within_a_build(app, tmp_path, env):
+    """Test that another process in the same build reuses the token file"""
+
+    assert github.token() == "token-1"
+
+    # A new process starts with nothing in memory
+    github._tokens.clear()
+    assert github.token() == "token-1"
+    assert FakeGhApi.minted == 1
+
+    (token_file,) = tmp_path.joinpath("github").iterdir()
+    assert stat.S_IMODE(token_file.stat().st_mode) == 0o600
+
+    # A different build gets its own token
+    github._tokens.clear()
+    env["GITHUB_RUN_ID"] = "2"
+    assert github.token() == "token-2"
+
+
+def test_parse_annotations(tmp_path):
+    """Test that lint, compiler and workflow command messages are found"""
+
+    output = "\n".join(
+        [
+            f"{tmp_path}/src/app.py:12:5: E501 line too long",
+            "src/types.py:3: error: Incompatible types  [assignment]",
+            "::warning file=notebooks/a.ipynb,line=7,title=Cell::Slow cell",
+            "collected 3 items",
+        ]
+    )
+
+    annotations = github.parse_annotations(output, root=tmp_path)
+
+    assert [(a.path, a.start_line, a.annotation_level) for a in annotations] == [
+        ("src/app.py", 12, "failure"),
+        ("src/types.py", 3, "failure"),
+        ("notebooks/a.ipynb", 7, "warning"),
+    ]
+    assert annotations[1].message == "Incompatible types  [assignment]"
+    assert annotations[2].title == "Cell"
+
+
+def test_report_check_batches_annotations(env, monkeypatch):
+    """Test that annotations are sent 50 at a time and the run completed last"""
+
+    env.update(
+        {
+            "CODEBUILD_RESOLVED_SOURCE_VERSION": "abc123",
+            "CODEBUILD_SOURCE_REPO_URL": "https://github.com/umsi-mads/mads-cli.git",
+            "CODEBUILD_BUILD_URL": "https://example.com/build",
+        }
+    )
+    calls = []
+
+    class Checks:
+        def list_for_ref(self, owner, repo, ref, check_name):
+            return {"check_runs": []}
+
+        def create(self, owner, repo, **params):
+            calls.append(("create", params))
+            return {"id": 7}
+
+        def update(self, owner, repo, check_run_id, **params):
+            calls.append(("update", params))
+            return {"id": check_run_id}
+
+    api = type("Api", (), {"checks": Checks()})()
+    monkeypatch.setattr(github, "client", lambda: api)
+
+    annotations = [
+        github.Annotation(path="a.py", start_line=i, end_line=i, message="bad")
+        for i in range(120)
+    ]
+    assert github.report_check("Lint", "failure", annotations=annotations) == 7
+
+    assert [call for call, _ in calls] == ["create", "update", "update"]
+    assert [len(params["output"]["annotations"]) for _, params in calls] == [50, 50, 20]
+    assert [params.get("conclusion") for _, params in calls] == [None, None, "failure"]
+
+
+def test_client_respects_rate_limits(monkeypatch):
+    """Test conditional GETs, secondary limit retries and waiting for a reset"""
+
+    from urllib.error import HTTPError
+
+    sleeps, requests = [], []
+    monkeypatch.setattr(github.time, "sleep", sleeps.append)
+    reset = str(int(time.time()) + 100)
+
+    def respond(api, path, verb, headers=None, **kwargs):
+        requests.append((verb, path, headers.get("If-None-Match")))
+
+        if path == "/limited" and len(requests) == 1:
+            raise HTTPError(
+                path, 403, "secondary rate limit", {"Retry-After": "3"}, None
+            )
+        if headers.get("If-None-Match") == '"v1"':
+            raise HTTPError(path, 304, "Not Modified", {}, None)
+
+        api.recv_hdrs = {
+            "ETag": '"v1"',
+            "X-RateLimit-Remaining": "1" if path == "/last" else "4000",
+            "X-RateLimit-Reset": reset,
+        }
+        return {"path": path}
+
+    monkeypatch.setattr(github.GhApi, "__call__", respond)
+    monkeypatch.setattr(github.GhApi, "recv_hdrs", {}, raising=False)
+    api = github.GitHub(token="token")
+
+    assert api("/limited") == {"path": "/limited"}
+    assert sleeps == [3.0]
+
+    # The second GET is answered from the cache after a 304
+    assert api("/repos") == {"path": "/repos"}
+    assert api("/repos") == {"path": "/repos"}
+    assert requests[-1] == ("GET", "/repos", '"v1"')
+
+    # Nearly out of requests, the next one waits for the reset
+    api("/last", "POST", data={})
+    api("/next", "POST", data={})
+    assert 95 < sleeps[-1] <= 101
+
+
+def test_client_is_thread_safe(monkeypatch):
+    """Test that concurrent requests cache each response under its own ETag"""
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def respond(api, path, verb, headers=None, **kwargs):
+        api.recv_hdrs = {"ETag": f'"{path}"'}
+        time.sleep(0.001)  # Let another request replace the headers
+        return {"path": path}
+
+    monkeypatch.setattr(github.GhApi, "__call__", respond)
+    monkeypatch.setattr(github.GhApi, "recv_hdrs", {}, raising=False)
+
+    api = github.GitHub(token="token")
+    paths = [f"/repos/{i}" for i in range(64)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(api, paths))
+
+    assert results == [{"path": path} for path in paths]
+    assert all(
+        etag == f'"{key[0]}"' and result == {"path": key[0]}
+        for key, (etag, result) in api.etags.items()
+    )
+
+
+def test_upload_release_assets(tmp_path, monkeypatch):
+    """Test that matching assets are skipped and the rest streamed up"""
+
+    import io
+    import json
+    import urllib.request
+
+    bundle = tmp_path.joinpath("bundle.tar.gz")
+    bundle.write_bytes(b"x" * 100)
+    notes = tmp_path.joinpath("notes.txt")
+    notes.write_text("hello")
+
+    class Repos:
+        def get_release_by_tag(self, owner, repo, tag):
+            return {"id": 1, "upload_url": "https://uploads/assets{?name,label}"}
+
+        def list_release_assets(self, owner, repo, release_id, per_page, page):
+            return [{"id": 9, "name": "bundle.tar.gz", "size": 100}]
+
+    uploads = []
+
+    def urlopen(request):
+        uploads.append((request.full_url, request.data.read()))
+        return io.BytesIO(json.dumps({"id": 10}).encode())
+
+    monkeypatch.setattr(github, "client", lambda: type("Api", (), {"repos": Repos()}))
+    monkeypatch.setattr(github, "token", lambda: "token")
+    monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+
+    summary = github.upload_release_assets(
+        "v1", [bundle, notes], owner="umsi-mads", repo="mads-cli"
+    )
+
+    assert uploads == [("https://uploads/assets?name=notes.txt", b"hello")]
+    assert summary["uploaded"] == 1
+    assert summary["skipped"] == 1
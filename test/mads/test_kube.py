@@ -0,0 +1,71 @@
+import subprocess
+
+from mads.build import kube
+
+
+def test_rollout_all(monkeypatch):
+    """Test that every deployment is restarted and watched, and failures kept"""
+
+    commands = []
+
+    def proc(cmd, silent=True):
+        commands.append(cmd)
+        failed = "broken" in cmd and "status" in cmd
+        return subprocess.CompletedProcess(
+            cmd,
+            1 if failed else 0,
+            stdout=b"" if failed else b'deployment "x" successfully rolled out\n',
+            stderr=b"error: timed out waiting for the condition\n" if failed else b"",
+        )
+
+    monkeypatch.setattr(kube, "proc", proc)
+    updates = []
+
+    results = kube.rollout_all(
+        [kube.parse_target("courses/api"), kube.parse_target("broken", "courses")],
+        timeout=30,
+        on_update=lambda rollouts: updates.append([r.state for r in rollouts]),
+    )
+
+    assert [(r.deployment, r.state) for r in results] == [
+        ("api", "ready"),
+        ("broken", "failed"),
+    ]
+    assert results[0].message == 'deployment "x" successfully rolled out'
+    assert results[1].message == "error: timed out waiting for the condition"
+    assert "kubectl rollout status deploy/api -n courses --timeout=30s" in commands
+    assert updates[0] == ["pending", "pending"]
+    assert updates[-1] == ["ready", "failed"]
+
+
+def test_setup_writes_kubeconfig_once(env, tmp_path):
+    """Test that the kubeconfig is only written when the context is missing"""
+
+    from botocore.stub import Stubber
+    from ruamel.yaml import YAML
+    from mads.build import aws
+
+    env["KUBECONFIG"] = str(tmp_path.joinpath("config"))
+    arn = "arn:aws:eks:us-west-2:123456789012:cluster/courses"
+
+    with Stubber(aws.client("eks", region_name="us-west-2")) as stub:
+        stub.add_response(
+            "describe_cluster",
+            {
+                "cluster": {
+                    "arn": arn,
+                    "endpoint": "https://example.eks.amazonaws.com",
+                    "certificateAuthority": {"data": "Y2VydA=="},
+                }
+            },
+            {"name": "courses"},
+        )
+
+        assert kube.setup("courses", "us-west-2") == arn
+        assert kube.setup("courses", "us-west-2") == arn
+        stub.assert_no_pending_responses()
+
+    config = YAML().load(tmp_path.joinpath("config"))
+    assert config["current-context"] == arn
+    assert config["users"][0]["user"]["exec"]["args"][-3] == "courses"
+    assert tmp_path.joinpath("config").stat().st_mode & 0o777 == 0o600
@@ -0,0 +1,60 @@
+import io
+import json
+import tarfile
+
+from mads.build.layers import read_layers
+
+
+def add_file(archive: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    archive.addfile(info, io.BytesIO(data))
+
+
+def make_layer(files: dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as layer:
+        for name, data in files.items():
+            add_file(layer, name, data)
+    return buffer.getvalue()
+
+
+def test_read_layers():
+    """Test that layers are matched to their instructions and largest files"""
+
+    config = {
+        "rootfs": {"diff_ids": ["sha256:aaa", "sha256:bbb"]},
+        "history": [
+            {"created_by": "/bin/sh -c #(nop) ADD file:123 in / "},
+            {"created_by": "/bin/sh -c #(nop)  ENV A=1", "empty_layer": True},
+            {"created_by": "RUN /bin/sh -c pip install pandas # buildkit"},
+        ],
+    }
+    manifest = [{"Config": "config.json", "Layers": ["one.tar", "two.tar"]}]
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        add_file(archive, "one.tar", make_layer({"etc/os-release": b"x" * 10}))
+        add_file(
+            archive,
+            "two.tar",
+            make_layer(
+                {
+                    "usr/lib/small.py": b"x" * 5,
+                    "usr/lib/big.so": b"x" * 500,
+                    "usr/lib/.wh.old.so": b"",
+                }
+            ),
+        )
+        add_file(archive, "config.json", json.dumps(config).encode())
+        add_file(archive, "manifest.json", json.dumps(manifest).encode())
+
+    buffer.seek(0)
+    layers = read_layers(buffer, top=1)
+
+    assert [layer.digest for layer in layers] == ["sha256:aaa", "sha256:bbb"]
+    assert layers[0].instruction == "ADD file:123 in /"
+    assert layers[1].instruction == "RUN pip install pandas"
+    assert layers[1].files == 2
+    assert layers[1].deleted == 1
+    assert [(f.path, f.size) for f in layers[1].largest] == [("/usr/lib/big.so", 500)]
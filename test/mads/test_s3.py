@@ -0,0 +1,280 @@
+import io
+
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from mads.build import s3
+
+
+def page(*keys: str, prefixes: list[str] = [], token: str | None = None) -> dict:
+    response = {
+        "Contents": [{"Key": key} for key in keys],
+        "CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes],
+        "IsTruncated": token is not None,
+    }
+    if token:
+        response["NextContinuationToken"] = token
+    return response
+
+
+def test_find_key_stops_at_first_match():
+    """Test that find_key doesn't list pages beyond the first match"""
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "list_objects_v2",
+            page("runs/1/log.txt", "runs/1/report.html", token="next"),
+            {"Bucket": "bucket", "Prefix": "runs/"},
+        )
+
+        # Only the first page is stubbed, so a second request would fail
+        assert s3.find_key("bucket", "runs/", ["report"]) == "runs/1/report.html"
+        stub.assert_no_pending_responses()
+
+
+def test_iter_keys_walks_delimited_prefixes():
+    """Test that hierarchical listing skips prefixes the glob can't match"""
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "list_objects_v2",
+            page("data/2025.md", prefixes=["data/2023/", "data/2024/"]),
+            {"Bucket": "bucket", "Prefix": "data/202", "Delimiter": "/"},
+        )
+        stub.add_response(
+            "list_objects_v2",
+            page("data/2024/a.csv", "data/2024/b.json"),
+            {"Bucket": "bucket", "Prefix": "data/2024/", "Delimiter": "/"},
+        )
+
+        keys = s3.find_keys("bucket", "data/", glob="data/202[4]/*.csv", delimiter="/")
+
+        assert keys == ["data/2024/a.csv"]
+        stub.assert_no_pending_responses()
+
+
+def test_cached_keys_are_queried_locally(tmp_path, monkeypatch):
+    """Test that a cached listing is reused and only extended from its last key"""
+
+    monkeypatch.setenv("MADS_CACHE_DIR", str(tmp_path))
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "list_objects_v2",
+            page("logs/1.txt", "logs/2.txt"),
+            {"Bucket": "bucket", "Prefix": "logs/"},
+        )
+
+        keys = s3.find_keys("bucket", "logs/", cache=True)
+        assert keys == ["logs/1.txt", "logs/2.txt"]
+
+        # Within the ttl, nothing is listed at all
+        keys = s3.find_keys("bucket", "logs/", ["2"], cache=True)
+        assert keys == ["logs/2.txt"]
+        stub.assert_no_pending_responses()
+
+        # Afterward, only keys after the last known one are listed
+        monkeypatch.setattr("mads.build.s3index.REFRESH_TTL", -1)
+        stub.add_response(
+            "list_objects_v2",
+            page("logs/3.txt"),
+            {"Bucket": "bucket", "Prefix": "logs/", "StartAfter": "logs/2.txt"},
+        )
+
+        keys = s3.find_keys("bucket", "logs/", glob="*.txt", cache=True)
+        assert keys == ["logs/1.txt", "logs/2.txt", "logs/3.txt"]
+        stub.assert_no_pending_responses()
+
+
+def test_sync_dry_run(tmp_path):
+    """Test that sync only transfers changed files and deletes extras"""
+
+    tmp_path.joinpath("same.txt").write_text("same")
+    tmp_path.joinpath("changed.txt").write_text("changed")
+    tmp_path.joinpath("new.txt").write_text("new")
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "list_objects_v2",
+            {
+                "Contents": [
+                    {
+                        "Key": "site/same.txt",
+                        "Size": 4,
+                        "ETag": f'"{s3.local_etag(tmp_path / "same.txt")}"',
+                    },
+                    {"Key": "site/changed.txt", "Size": 7, "ETag": '"abc"'},
+                    {"Key": "site/old.txt", "Size": 3, "ETag": '"def"'},
+                ],
+                "IsTruncated": False,
+            },
+            {"Bucket": "bucket", "Prefix": "site/"},
+        )
+
+        summary = s3.sync(
+            str(tmp_path), "s3://bucket/site", delete=True, check="etag", dry_run=True
+        )
+
+    assert summary["transferred"] == 2
+    assert summary["skipped"] == 1
+    assert summary["deleted"] == 1
+    assert summary["bytes"] == len("changed") + len("new")
+
+
+def test_ranged_download(tmp_path):
+    """Test that a download in parts is reassembled in place"""
+
+    data = b"0123456789"
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "head_object",
+            {"ContentLength": len(data), "ETag": '"abc"'},
+            {"Bucket": "bucket", "Key": "data.bin"},
+        )
+        for start, end in [(0, 4), (4, 8), (8, 10)]:
+            stub.add_response(
+                "get_object",
+                {"Body": StreamingBody(io.BytesIO(data[start:end]), end - start)},
+                {
+                    "Bucket": "bucket",
+                    "Key": "data.bin",
+                    "Range": f"bytes={start}-{end - 1}",
+                    "IfMatch": '"abc"',
+                },
+            )
+
+        dest = tmp_path.joinpath("data.bin")
+        s3.download("bucket", "data.bin", dest, part_size=4, concurrency=1)
+
+    assert dest.read_bytes() == data
+
+
+def test_fetch_revalidates_cached_objects(tmp_path, monkeypatch):
+    """Test that fetch only downloads an object again when its ETag changes"""
+
+    monkeypatch.setenv("MADS_CACHE_DIR", str(tmp_path))
+    data = b"a,b\n1,2\n"
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "get_object",
+            {
+                "Body": StreamingBody(io.BytesIO(data), len(data)),
+                "ContentLength": len(data),
+                "ETag": '"abc"',
+            },
+            {"Bucket": "bucket", "Key": "ref/data.csv"},
+        )
+        stub.add_client_error(
+            "get_object",
+            service_error_code="304",
+            http_status_code=304,
+            expected_params={
+                "Bucket": "bucket",
+                "Key": "ref/data.csv",
+                "IfNoneMatch": '"abc"',
+            },
+        )
+
+        first = s3.fetch("bucket", "ref/data.csv")
+        second = s3.fetch("bucket", "ref/data.csv")
+        stub.assert_no_pending_responses()
+
+    assert first == second
+    assert first.name == "data.csv"
+    assert first.read_bytes() == data
+
+    # Anything but the latest fetch is evicted when over the size limit
+    s3.evict(0, keep=first)
+    assert first.exists()
+    s3.evict(0)
+    assert not first.exists()
+
+
+def test_parse_url():
+    """Test that S3 URLs split into a bucket and key"""
+
+    assert s3.parse_url("s3://bucket/images/course.tar.zst") == (
+        "bucket",
+        "images/course.tar.zst",
+    )
+    assert s3.parse_url("s3://bucket") == ("bucket", "")
+
+    with pytest.raises(AssertionError):
+        s3.parse_url("/tmp/images")
+
+
+def test_exists():
+    """Test that exists is False only for missing objects"""
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "head_object",
+            {"ContentLength": 1},
+            {"Bucket": "bucket", "Key": "there"},
+        )
+        stub.add_client_error(
+            "head_object",
+            service_error_code="404",
+            http_status_code=404,
+            expected_params={"Bucket": "bucket", "Key": "missing"},
+        )
+        stub.add_client_error(
+            "head_object",
+            service_error_code="403",
+            http_status_code=403,
+            expected_params={"Bucket": "bucket", "Key": "private"},
+        )
+
+        assert s3.exists("bucket", "there")
+        assert not s3.exists("bucket", "missing")
+        with pytest.raises(ClientError):
+            s3.exists("bucket", "private")
+
+
+def test_stream_round_trip():
+    """Test that a stream is uploaded and downloaded through the S3 client"""
+
+    data = b"not a real tarball"
+    uploaded = io.BytesIO()
+
+    with Stubber(s3.s3) as stub:
+        # The checksum parameters vary with the botocore version
+        stub.add_response("put_object", {"ETag": '"abc"'})
+        s3.upload_stream(io.BytesIO(data), "bucket", "images/course.tar.zst")
+        stub.assert_no_pending_responses()
+
+        stub.add_response(
+            "head_object",
+            {"ContentLength": len(data), "ETag": '"abc"'},
+            {"Bucket": "bucket", "Key": "images/course.tar.zst"},
+        )
+        stub.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(data), len(data)), "ETag": '"abc"'},
+            {"Bucket": "bucket", "Key": "images/course.tar.zst"},
+        )
+        s3.download_stream("bucket", "images/course.tar.zst", uploaded)
+        stub.assert_no_pending_responses()
+
+    assert uploaded.getvalue() == data
+
+
+def test_client_methods_pass_through():
+    """Test that client methods mads doesn't wrap are still reachable on the module"""
+
+    data = b"hello"
+
+    with Stubber(s3.s3) as stub:
+        stub.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(data), len(data))},
+            {"Bucket": "bucket", "Key": "a.txt"},
+        )
+
+        response = s3.get_object(Bucket="bucket", Key="a.txt")
+
+    assert response["Body"].read() == data
@@ -0,0 +1,60 @@
+import stat
+
+import pytest
+from botocore.stub import Stubber
+
+from mads.build import aws, secrets
+
+
+@pytest.fixture
+def build(env, tmp_path, monkeypatch):
+    env.update(
+        {
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "MADS_CACHE_DIR": str(tmp_path),
+            "GITHUB_ACTIONS": "true",
+            "GITHUB_RUN_ID": "1",
+            "GITHUB_REPOSITORY": "umsi-mads/mads-cli",
+            "GITHUB_REF_NAME": "main",
+            "GITHUB_EVENT_NAME": "push",
+        }
+    )
+    monkeypatch.setattr(secrets, "_secrets", {})
+
+
+def test_secrets_are_cached_across_processes(build, tmp_path, monkeypatch):
+    """Test that a secret is fetched once per build and stored encrypted"""
+
+    with Stubber(aws.client("secretsmanager")) as stub:
+        stub.add_response(
+            "get_secret_value",
+            {"SecretString": "hunter2"},
+            {"SecretId": "github-app"},
+        )
+
+        assert secrets.get_secret("github-app") == "hunter2"
+
+        # Another process in the same build reads the file instead
+        secrets._secrets.clear()
+        assert secrets.get_secret("github-app") == "hunter2"
+        stub.assert_no_pending_responses()
+
+    (cached,) = [
+        path for path in tmp_path.joinpath("secrets").iterdir() if path.name[0] != "."
+    ]
+    assert b"hunter2" not in cached.read_bytes()
+    assert stat.S_IMODE(cached.stat().st_mode) == 0o600
+
+    # Once the ttl passes, it's fetched again
+    now = secrets.time.time()
+    monkeypatch.setattr(secrets.time, "time", lambda: now + secrets.SECRET_TTL + 1)
+    secrets._secrets.clear()
+
+    with Stubber(aws.client("secretsmanager")) as stub:
+        stub.add_response(
+            "get_secret_value",
+            {"SecretBinary": b"\x00\x01"},
+            {"SecretId": "github-app"},
+        )
+        assert secrets.get_secret("github-app") == b"\x00\x01"
+        stub.assert_no_pending_responses()
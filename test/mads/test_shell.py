@@ -27,3 +27,19 @@ def test_proc():
 
     result = proc("echo hello")
     assert result.returncode == 0
+
+
+def test_stream_outdents_on_error():
+    """Test that stream restores the log indent when its body raises"""
+
+    from mads.build import log
+    from mads.build.shell import stream
+
+    depth = len(log._indent)
+    try:
+        with stream("cat > /dev/null", "w"):
+            raise ValueError("interrupted")
+    except ValueError:
+        pass
+
+    assert len(log._indent) == depth
@@ -0,0 +1,112 @@
+import io
+
+import pytest
+from botocore.exceptions import ClientError
+
+from mads.build import s3, storage
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    monkeypatch.setenv("MADS_CACHE_DIR", str(tmp_path.joinpath("cache")))
+    storage.configure(str(tmp_path))
+    yield tmp_path
+    storage.configure(None)
+
+
+def test_s3_helpers_use_local_storage(local):
+    """Test that the S3 helpers work against a local directory"""
+
+    s3.upload_stream(io.BytesIO(b"hello world"), "bucket", "data/a.txt")
+    s3.upload_stream(io.BytesIO(b"{}"), "bucket", "data/sub/b.json")
+    s3.upload_stream(io.BytesIO(b""), "bucket", "data-other.txt")
+
+    assert local.joinpath("bucket/data/a.txt").read_bytes() == b"hello world"
+
+    assert s3.find_keys("bucket", "data") == [
+        "data-other.txt",
+        "data/a.txt",
+        "data/sub/b.json",
+    ]
+    assert s3.find_keys("bucket", "data/", glob="data/*/*.json", delimiter="/") == [
+        "data/sub/b.json"
+    ]
+
+    assert s3.read_key("bucket", "data/a.txt") == "hello world"
+    assert s3.read_range("bucket", "data/a.txt", -5) == b"world"
+    assert s3.read_range("bucket", "data/a.txt", 0, 5) == b"hello"
+    assert (
+        s3.head("bucket", "data/a.txt")["ETag"]
+        == f'"{s3.local_etag(local / "bucket/data/a.txt")}"'
+    )
+    assert s3.exists("bucket", "data/a.txt")
+    assert not s3.exists("bucket", "missing.txt")
+
+    dest = local.joinpath("a.txt")
+    s3.download("bucket", "data/a.txt", dest, part_size=4)
+    assert dest.read_bytes() == b"hello world"
+
+    # fetch revalidates without copying again
+    assert s3.fetch("bucket", "data/a.txt").read_bytes() == b"hello world"
+
+
+def test_sync_with_local_storage(local, tmp_path_factory):
+    """Test that sync uploads, skips and deletes against local storage"""
+
+    source = tmp_path_factory.mktemp("source")
+    source.joinpath("keep.txt").write_text("keep")
+    source.joinpath("nested").mkdir()
+    source.joinpath("nested/new.txt").write_text("new")
+    s3.upload_stream(io.BytesIO(b"keep"), "bucket", "site/keep.txt")
+    s3.upload_stream(io.BytesIO(b"old"), "bucket", "site/old/gone.txt")
+
+    summary = s3.sync(str(source), "s3://bucket/site", delete=True, check="etag")
+
+    assert summary["transferred"] == 1
+    assert summary["skipped"] == 1
+    assert summary["deleted"] == 1
+    assert s3.find_keys("bucket", "site/") == ["site/keep.txt", "site/nested/new.txt"]
+    assert not local.joinpath("bucket/site/old").exists()
+
+
+def test_listing_doesnt_read_files(local, monkeypatch):
+    """Test that listing only stats files, leaving the MD5 to head and get"""
+
+    s3.upload_stream(io.BytesIO(b"x" * 1024), "bucket", "data/a.bin")
+    monkeypatch.setattr(storage, "_etag", lambda *args: pytest.fail("File was read"))
+
+    assert s3.find_key("bucket", "data/") == "data/a.bin"
+    assert [entry["Size"] for entry in s3.iter_objects("bucket", "data/")] == [1024]
+
+
+@pytest.mark.parametrize("key", ["/etc/passwd", "../other/a.txt", "a/../../b"])
+def test_keys_stay_in_their_bucket(local, key):
+    """Test that keys can't reach outside their bucket's directory"""
+
+    with pytest.raises(ClientError) as e:
+        s3.read_key("bucket", key)
+
+    assert e.value.response["Error"]["Code"] == "InvalidKey"
+
+
+def test_symlinks_stay_in_their_bucket(local, tmp_path_factory):
+    """Test that a key can't follow a link out of its bucket"""
+
+    outside = tmp_path_factory.mktemp("outside")
+    outside.joinpath("secret.txt").write_text("secret")
+    local.joinpath("bucket").mkdir()
+    local.joinpath("bucket/link").symlink_to(outside)
+
+    with pytest.raises(ClientError):
+        s3.read_key("bucket", "link/secret.txt")
+
+
+def test_incomplete_backends_fail_early():
+    """Test that a backend missing an operation can't be created"""
+
+    class ListOnly(storage.Storage):
+        def list_pages(self, bucket, prefix="", delimiter=None, start_after=None):
+            yield {"Contents": []}
+
+    with pytest.raises(TypeError):
+        ListOnly()